@@ -0,0 +1,222 @@
+"""
+API准入控制
+
+限制同时处理的问答请求数，超出部分进入有界等待队列；队列已满或等待超时时
+立即以503拒绝，超过按API密钥配置的令牌桶速率时以429拒绝，两者都带Retry-After，
+使服务在突发流量下平稳降级，而不是堆积到客户端超时。
+"""
+
+import os
+import time
+import math
+import asyncio
+import hashlib
+import secrets
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from app.metrics import ADMISSION_WAIT
+from app.stats import percentile
+
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "4"))
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "32"))
+MAX_QUEUE_WAIT_SECONDS = float(os.getenv("MAX_QUEUE_WAIT_SECONDS", "30"))
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "60"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+# 已登记的API密钥（逗号分隔），只有这些密钥按密钥单独限流，其余请求按客户端地址限流
+API_KEYS = frozenset(key.strip() for key in os.getenv("API_KEYS", "").split(",") if key.strip())
+
+class AdmissionRejected(Exception):
+    """请求被准入控制拒绝"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class TokenBucket:
+    """令牌桶：按固定速率补充令牌，容量即允许的突发请求数"""
+
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def try_consume(self, cost: float = 1.0) -> float:
+        """尝试消耗令牌，成功返回0，否则返回需要等待的秒数
+
+        超过容量的请求（如大批量问答）在桶满时放行，超出部分记为欠账（令牌为负），
+        之后的请求要等欠账补足后才能通过，长期速率仍受限制。
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        required = min(cost, self.capacity)
+        if self.tokens >= required:
+            self.tokens -= cost
+            return 0.0
+        return (required - self.tokens) / self.rate
+
+    def refund(self, cost: float = 1.0):
+        """退还已消耗的令牌（请求最终未被处理时）"""
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+class RateLimiter:
+    """按API密钥（无密钥时按客户端地址）维护令牌桶"""
+
+    def __init__(self, per_minute: float = RATE_LIMIT_PER_MINUTE, burst: int = RATE_LIMIT_BURST, max_clients: int = 10000):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def check(self, client_key: str, cost: float = 1.0):
+        """超过速率时抛出429"""
+        if not self.enabled:
+            return
+
+        bucket = self._buckets.get(client_key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[client_key] = bucket
+            # 只保留最近活跃的客户端，避免内存无限增长
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client_key)
+
+        wait_seconds = bucket.try_consume(cost)
+        if wait_seconds > 0:
+            self.rejected += 1
+            raise AdmissionRejected(429, "请求过于频繁，请稍后重试", wait_seconds)
+
+    def refund(self, client_key: str, cost: float = 1.0):
+        """退还令牌：通过速率检查后又因队列已满或排队超时被拒绝的请求不计入速率"""
+        bucket = self._buckets.get(client_key)
+        if self.enabled and bucket is not None:
+            bucket.refund(cost)
+
+class AdmissionController:
+    """并发上限 + 有界等待队列"""
+
+    def __init__(self,
+                 max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+                 max_queue_depth: int = MAX_QUEUE_DEPTH,
+                 max_wait_seconds: float = MAX_QUEUE_WAIT_SECONDS,
+                 rate_limiter: Optional[RateLimiter] = None):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_wait_seconds = max_wait_seconds
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self._wait_times = deque(maxlen=1000)
+        self._service_time_ewma = 1.0
+
+    def _estimated_wait(self) -> float:
+        """按平均处理时间估算排队者需要等待的时间，用作Retry-After"""
+        return self._service_time_ewma * (self.queue_depth + 1) / self.max_concurrency
+
+    async def acquire(self, client_key: str = "anonymous", cost: float = 1.0) -> float:
+        """获取处理名额，返回排队等待的秒数；被拒绝时抛出AdmissionRejected"""
+        self.rate_limiter.check(client_key, cost)
+
+        if self.queue_depth >= self.max_queue_depth and self._semaphore.locked():
+            self.rejected_queue_full += 1
+            self.rate_limiter.refund(client_key, cost)
+            raise AdmissionRejected(503, "服务繁忙，请求队列已满", self._estimated_wait())
+
+        start = time.monotonic()
+        self.queue_depth += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait_seconds)
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            self.rate_limiter.refund(client_key, cost)
+            raise AdmissionRejected(503, "服务繁忙，排队等待超时", self._estimated_wait())
+        finally:
+            self.queue_depth -= 1
+
+        wait_seconds = time.monotonic() - start
+        self._wait_times.append(wait_seconds)
+        ADMISSION_WAIT.observe(wait_seconds)
+        self.in_flight += 1
+        self.admitted += 1
+        return wait_seconds
+
+    def release(self, service_seconds: Optional[float] = None):
+        """释放处理名额，并更新平均处理时间"""
+        self.in_flight -= 1
+        self._semaphore.release()
+        if service_seconds is not None:
+            self._service_time_ewma = 0.9 * self._service_time_ewma + 0.1 * service_seconds
+
+    @asynccontextmanager
+    async def admit(self, client_key: str = "anonymous", cost: float = 1.0):
+        """准入上下文：进入时排队获取名额，退出时释放"""
+        await self.acquire(client_key, cost)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回准入控制指标"""
+        waits = sorted(self._wait_times)
+
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "max_concurrency": self.max_concurrency,
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "rejected_rate_limited": self.rate_limiter.rejected,
+            "queue_wait_seconds": {
+                "p50": percentile(waits, 0.5),
+                "p95": percentile(waits, 0.95),
+                "max": waits[-1] if waits else 0.0
+            },
+            "avg_service_seconds": self._service_time_ewma
+        }
+
+def is_registered_api_key(api_key: Optional[str]) -> bool:
+    """校验API密钥是否在API_KEYS中登记"""
+    if not api_key:
+        return False
+    return any(secrets.compare_digest(api_key, key) for key in API_KEYS)
+
+def client_key_from_request(request) -> str:
+    """已登记的X-API-Key按密钥区分客户端，否则使用客户端地址
+
+    未登记的密钥不能作为限流键，否则客户端每次换一个随机密钥就能拿到一个新的满令牌桶。
+    """
+    api_key = request.headers.get("x-api-key")
+    if is_registered_api_key(api_key):
+        return f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:16]}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+def rejection_response(exc: AdmissionRejected):
+    """把拒绝转换为带Retry-After的JSON响应"""
+    from fastapi.responses import JSONResponse
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail, "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
@@ -0,0 +1,146 @@
+"""
+生成长度限制
+
+根据已观测的回答长度为每个路由学习max_new_tokens上限，并提供停止序列
+和墙钟截止时间两种提前结束条件，用于约束长尾延迟。
+"""
+
+import os
+import json
+import math
+import time
+import threading
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+from app.stats import percentile
+
+FINETUNE_DATASET_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'finetune_dataset.jsonl'))
+
+class AnswerLengthStats:
+    """
+    按路由统计回答token长度，并据此给出生成上限。
+
+    上限 = 最近窗口内长度的分位数 × 余量系数，并限制在[min_tokens, max_tokens]之间；
+    样本不足时直接使用max_tokens。
+    """
+
+    def __init__(self,
+                 max_tokens: int = 512,
+                 min_tokens: int = 64,
+                 percentile: float = 0.95,
+                 headroom: float = 1.5,
+                 window: int = 1000,
+                 min_samples: int = 20):
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.percentile = percentile
+        self.headroom = headroom
+        self.window = window
+        self.min_samples = min_samples
+        self._lengths: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, route: str, num_tokens: int):
+        """记录一次回答的token长度"""
+        with self._lock:
+            lengths = self._lengths.setdefault(route, deque(maxlen=self.window))
+            lengths.append(num_tokens)
+
+    def record_many(self, route: str, lengths: Iterable[int]):
+        """批量记录回答长度"""
+        for num_tokens in lengths:
+            self.record(route, num_tokens)
+
+    def token_cap(self, route: str, fallback_route: Optional[str] = None) -> int:
+        """返回该路由当前的max_new_tokens上限，样本不足时使用fallback_route的上限"""
+        with self._lock:
+            lengths = sorted(self._lengths.get(route, ()))
+
+        if len(lengths) < self.min_samples:
+            if fallback_route and fallback_route != route:
+                return self.token_cap(fallback_route)
+            return self.max_tokens
+
+        cap = math.ceil(percentile(lengths, self.percentile) * self.headroom)
+        return max(self.min_tokens, min(self.max_tokens, cap))
+
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        """返回各路由的样本数和当前上限"""
+        with self._lock:
+            routes = {route: len(lengths) for route, lengths in self._lengths.items()}
+        return {route: {"samples": count, "token_cap": self.token_cap(route)} for route, count in routes.items()}
+
+def load_answer_lengths(count_tokens: Callable[[str], int],
+                        dataset_path: str = FINETUNE_DATASET_PATH) -> List[int]:
+    """从微调数据集中读取assistant回答并返回其token长度"""
+    lengths = []
+    if not os.path.exists(dataset_path):
+        return lengths
+
+    with open(dataset_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                messages = json.loads(line).get("messages", [])
+            except json.JSONDecodeError:
+                continue
+            for message in messages:
+                if message.get("role") == "assistant" and message.get("content"):
+                    lengths.append(count_tokens(message["content"]))
+    return lengths
+
+def _batch_result(input_ids, flags: List[bool]):
+    """单条序列返回bool，批量时返回逐条序列的布尔张量"""
+    if len(flags) == 1:
+        return flags[0]
+    return input_ids.new_tensor(flags).bool()
+
+class StopSequenceCriteria:
+    """生成序列末尾出现任一停止序列时结束生成（transformers StoppingCriteria协议）"""
+
+    def __init__(self, stop_token_sequences: Sequence[Sequence[int]], prompt_length: int):
+        self.stop_token_sequences = [list(seq) for seq in stop_token_sequences if seq]
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        flags = []
+        for row in input_ids:
+            generated = row[self.prompt_length:].tolist()
+            flags.append(any(
+                len(generated) >= len(seq) and generated[-len(seq):] == seq
+                for seq in self.stop_token_sequences
+            ))
+        return _batch_result(input_ids, flags)
+
+class DeadlineCriteria:
+    """超过墙钟截止时间后结束生成，保留已生成的部分回答"""
+
+    def __init__(self, timeout_seconds: float):
+        self.deadline = time.monotonic() + timeout_seconds
+        self.triggered = False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if time.monotonic() >= self.deadline:
+            self.triggered = True
+        return _batch_result(input_ids, [self.triggered] * len(input_ids))
+
+class FirstTokenTimer:
+    """记录首个新token生成的时间，用于区分预填充和解码耗时；从不结束生成"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # 停止条件在每步生成后调用，第一次调用时首个token已经产生
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        return _batch_result(input_ids, [False] * len(input_ids))
+
+    def split(self, finished_at: float):
+        """返回 (预填充秒数, 解码秒数)"""
+        first_token_at = self.first_token_at or finished_at
+        return first_token_at - self.started_at, finished_at - first_token_at
@@ -0,0 +1,383 @@
+"""
+LoRA推理进程池
+
+在多个独立进程中各加载一份LoRA模型副本，每个进程绑定到一组CPU核心，
+并把torch线程数设置为该组核心数，由调度器按未完成请求数把提示分发给
+最空闲的副本。对多核CPU服务器而言，多个小线程数副本并行推理的吞吐量
+通常高于单个大线程数副本。意外退出（如OOM）的副本按指数退避自动重启。
+"""
+
+import os
+import time
+import asyncio
+import itertools
+import threading
+import multiprocessing as mp
+import queue
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+def get_available_cores() -> List[int]:
+    """返回当前进程可用的CPU核心编号"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def plan_core_groups(num_workers: int,
+                     threads_per_worker: Optional[int] = None,
+                     available_cores: Optional[List[int]] = None) -> List[Optional[List[int]]]:
+    """
+    为每个工作进程分配互不重叠的CPU核心组。
+
+    核心数不足以为每个进程分配独立核心组时返回None，表示不做绑定。
+    """
+    cores = available_cores if available_cores is not None else get_available_cores()
+    if threads_per_worker is None:
+        threads_per_worker = max(1, len(cores) // num_workers)
+
+    if num_workers * threads_per_worker > len(cores):
+        return [None] * num_workers
+
+    return [
+        cores[i * threads_per_worker:(i + 1) * threads_per_worker]
+        for i in range(num_workers)
+    ]
+
+def _create_lora_model(**model_kwargs):
+    """在工作进程中创建LoRA模型（默认模型工厂）"""
+    from app.lora_model import LoRALanguageModel
+    return LoRALanguageModel(**model_kwargs)
+
+def _worker_main(worker_id: int,
+                 cores: Optional[List[int]],
+                 num_threads: int,
+                 model_factory: Callable,
+                 model_kwargs: Dict[str, Any],
+                 request_queue,
+                 response_queue):
+    """工作进程主循环：绑定核心、加载模型副本、处理推理请求"""
+    # 在导入torch之前限制OpenMP/MKL线程数
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    os.environ["MKL_NUM_THREADS"] = str(num_threads)
+
+    if cores and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError as e:
+            print(f"⚠️ 推理进程 {worker_id} 绑定CPU核心失败: {e}")
+
+    try:
+        try:
+            import torch
+            torch.set_num_threads(num_threads)
+        except ImportError:
+            pass
+        model = model_factory(**model_kwargs)
+    except Exception as e:
+        response_queue.put(("init_error", worker_id, f"{type(e).__name__}: {e}"))
+        return
+
+    response_queue.put(("ready", worker_id, None))
+
+    while True:
+        item = request_queue.get()
+        if item is None:
+            break
+
+        request_id, method, args = item
+        try:
+            result = getattr(model, method)(*args)
+            response_queue.put((request_id, True, result))
+        except Exception as e:
+            response_queue.put((request_id, False, f"{type(e).__name__}: {e}"))
+
+class InferencePool:
+    """
+    多副本LoRA推理进程池
+
+    与LoRALanguageModel保持相同的generate/agenerate接口，可直接交给
+    LoRALangChainWrapper使用。
+    """
+
+    def __init__(self,
+                 model_kwargs: Dict[str, Any],
+                 num_workers: int = 2,
+                 threads_per_worker: Optional[int] = None,
+                 model_factory: Callable = _create_lora_model,
+                 start_method: str = "spawn",
+                 startup_timeout: float = 600.0,
+                 restart_backoff: float = 1.0,
+                 max_restart_backoff: float = 60.0):
+
+        if num_workers < 1:
+            raise ValueError("num_workers 必须大于等于1")
+
+        self.model_kwargs = dict(model_kwargs)
+        self.base_model_name = self.model_kwargs.get("base_model_name")
+        self.lora_model_path = self.model_kwargs.get("lora_model_path")
+        self.num_workers = num_workers
+        self.model_factory = model_factory
+        self.startup_timeout = startup_timeout
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+
+        available_cores = get_available_cores()
+        if threads_per_worker is None:
+            threads_per_worker = max(1, len(available_cores) // num_workers)
+        self.threads_per_worker = threads_per_worker
+        self.core_groups = plan_core_groups(num_workers, threads_per_worker, available_cores)
+
+        self._ctx = mp.get_context(start_method)
+        self._response_queue = self._ctx.Queue()
+        self._request_queues = [None] * num_workers
+        self._processes = [None] * num_workers
+        # 副本加载完模型后才接收请求；重启的副本在发回ready前不参与调度
+        self._ready = [False] * num_workers
+        self._restart_failures = [0] * num_workers
+        self._restart_at: List[Optional[float]] = [None] * num_workers
+        self._started_at = [0.0] * num_workers
+        self.restarts = 0
+
+        # 调度状态
+        self._lock = threading.Lock()
+        self._pending: Dict[int, Future] = {}
+        self._request_worker: Dict[int, int] = {}
+        self._outstanding = [0] * num_workers
+        self._request_ids = itertools.count()
+        self._round_robin = itertools.count()
+        self._collector = None
+        self._closed = False
+
+    def _spawn_worker(self, worker_id: int):
+        """启动（或重启）一个工作进程，使用新的请求队列"""
+        request_queue = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(
+                worker_id,
+                self.core_groups[worker_id],
+                self.threads_per_worker,
+                self.model_factory,
+                self.model_kwargs,
+                request_queue,
+                self._response_queue
+            ),
+            name=f"lora-inference-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        self._request_queues[worker_id] = request_queue
+        self._processes[worker_id] = process
+        self._started_at[worker_id] = time.monotonic()
+
+    def start(self):
+        """启动所有工作进程并等待模型加载完成"""
+        print(f"正在启动推理进程池: {self.num_workers} 个副本，每个副本 {self.threads_per_worker} 线程")
+
+        for worker_id in range(self.num_workers):
+            self._spawn_worker(worker_id)
+
+        while not all(self._ready):
+            try:
+                status, worker_id, error = self._response_queue.get(timeout=self.startup_timeout)
+            except queue.Empty:
+                self.shutdown()
+                raise TimeoutError(f"推理进程池启动超时（{self.startup_timeout}秒）")
+
+            if status == "init_error":
+                self.shutdown()
+                raise RuntimeError(f"推理进程 {worker_id} 初始化失败: {error}")
+            self._ready[worker_id] = True
+            print(f"✅ 推理进程 {worker_id} 就绪，CPU核心: {self.core_groups[worker_id] or '未绑定'}")
+
+        self._collector = threading.Thread(target=self._collect_responses, name="lora-inference-collector", daemon=True)
+        self._collector.start()
+        return self
+
+    def _is_live(self, worker_id: int) -> bool:
+        process = self._processes[worker_id]
+        return self._ready[worker_id] and process is not None and process.is_alive()
+
+    def live_workers(self) -> List[int]:
+        """已加载模型且仍在运行的副本"""
+        return [worker_id for worker_id in range(self.num_workers) if self._is_live(worker_id)]
+
+    def _pick_worker(self) -> int:
+        """选择存活副本中未完成请求数最少的，数量相同时轮询；已退出或正在重启的副本不分配请求"""
+        offset = next(self._round_robin)
+        candidates = [(offset + i) % self.num_workers for i in range(self.num_workers)]
+        candidates = [worker_id for worker_id in candidates if self._is_live(worker_id)]
+        if not candidates:
+            raise RuntimeError("推理进程池中没有存活的进程")
+        return min(candidates, key=lambda worker_id: self._outstanding[worker_id])
+
+    def submit(self, method: str, *args) -> Future:
+        """向最空闲的副本提交一次推理调用"""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("推理进程池已关闭")
+            request_id = next(self._request_ids)
+            worker_id = self._pick_worker()
+            self._outstanding[worker_id] += 1
+            self._pending[request_id] = future
+            self._request_worker[request_id] = worker_id
+            request_queue = self._request_queues[worker_id]
+
+        request_queue.put((request_id, method, args))
+        return future
+
+    def _resolve(self, request_id: int, success: bool, payload: Any):
+        """完成一个请求对应的Future"""
+        with self._lock:
+            future = self._pending.pop(request_id, None)
+            worker_id = self._request_worker.pop(request_id, None)
+            if worker_id is not None:
+                self._outstanding[worker_id] -= 1
+
+        if future is None:
+            return
+        if success:
+            future.set_result(payload)
+        else:
+            future.set_exception(RuntimeError(payload))
+
+    def _collect_responses(self):
+        """后台线程：接收工作进程的结果，并处理进程意外退出"""
+        while not self._closed:
+            # 每轮都检查进程存活，持续有结果到达时也能及时让已退出进程上的请求失败
+            self._check_workers()
+            try:
+                message = self._response_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            # 重启的进程加载完模型后发回 ("ready"|"init_error", worker_id, error)
+            status, worker_id, error = message
+            if status == "ready":
+                self._ready[worker_id] = True
+                print(f"✅ 推理进程 {worker_id} 重启完成")
+            elif status == "init_error":
+                print(f"❌ 推理进程 {worker_id} 重启后初始化失败: {error}")
+            else:
+                self._resolve(*message)
+
+    def _check_workers(self):
+        """让已退出进程上的未完成请求立即失败，并按指数退避重启该进程"""
+        for worker_id, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            self._ready[worker_id] = False
+            with self._lock:
+                orphaned = [rid for rid, wid in self._request_worker.items() if wid == worker_id]
+            for request_id in orphaned:
+                self._resolve(request_id, False, f"推理进程 {worker_id} 已退出 (exitcode={process.exitcode})")
+            self._schedule_restart(worker_id, process)
+
+    def _schedule_restart(self, worker_id: int, process):
+        """退出后等待 restart_backoff × 2^连续失败次数 秒（不超过max_restart_backoff）再重启"""
+        now = time.monotonic()
+        if self._restart_at[worker_id] is None:
+            # 稳定运行过一段时间后才退出的进程重新从最短等待开始计算
+            if now - self._started_at[worker_id] > self.max_restart_backoff:
+                self._restart_failures[worker_id] = 0
+            delay = min(self.restart_backoff * 2 ** self._restart_failures[worker_id], self.max_restart_backoff)
+            self._restart_at[worker_id] = now + delay
+            print(f"⚠️ 推理进程 {worker_id} 已退出 (exitcode={process.exitcode})，{delay:.1f} 秒后重启")
+        if now < self._restart_at[worker_id]:
+            return
+
+        with self._lock:
+            if self._closed:
+                return
+            self._restart_at[worker_id] = None
+            self._restart_failures[worker_id] += 1
+            self.restarts += 1
+            old_queue = self._request_queues[worker_id]
+            self._spawn_worker(worker_id)
+        old_queue.cancel_join_thread()
+        old_queue.close()
+
+    def generate(self, prompt: str, route: str = "default") -> str:
+        """同步生成响应"""
+        return self.submit("generate", prompt, route).result()
+
+    async def agenerate(self, prompt: str, route: str = "default") -> str:
+        """异步生成响应"""
+        return await asyncio.wrap_future(self.submit("generate", prompt, route))
+
+    def generate_with_stats(self, prompt: str, route: str = "default"):
+        """同步生成响应，同时返回生成统计"""
+        return self.submit("generate_with_stats", prompt, route).result()
+
+    async def agenerate_with_stats(self, prompt: str, route: str = "default"):
+        """异步生成响应，同时返回生成统计"""
+        return await asyncio.wrap_future(self.submit("generate_with_stats", prompt, route))
+
+    def _split_batch(self, prompts: List[str]) -> List[List[str]]:
+        """把一批提示按副本数切成连续的子批次"""
+        if not prompts:
+            return []
+        size = -(-len(prompts) // self.num_workers)
+        return [prompts[i:i + size] for i in range(0, len(prompts), size)]
+
+    def generate_batch(self, prompts: List[str], route: str = "default") -> List[str]:
+        """同步批量生成，子批次分发到多个副本"""
+        futures = [self.submit("generate_batch", chunk, route) for chunk in self._split_batch(prompts)]
+        return [response for future in futures for response in future.result()]
+
+    async def agenerate_batch(self, prompts: List[str], route: str = "default") -> List[str]:
+        """异步批量生成，子批次分发到多个副本"""
+        futures = [self.submit("generate_batch", chunk, route) for chunk in self._split_batch(prompts)]
+        chunks = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+        return [response for chunk in chunks for response in chunk]
+
+    def stats(self) -> Dict[str, Any]:
+        """返回进程池当前状态"""
+        with self._lock:
+            outstanding = list(self._outstanding)
+        return {
+            "num_workers": self.num_workers,
+            "threads_per_worker": self.threads_per_worker,
+            "core_groups": self.core_groups,
+            "outstanding": outstanding,
+            "alive": [process.is_alive() for process in self._processes],
+            "ready": list(self._ready),
+            "live_workers": len(self.live_workers()),
+            "restarts": self.restarts,
+            "pids": [process.pid for process in self._processes]
+        }
+
+    def shutdown(self, timeout: float = 10.0):
+        """停止所有工作进程"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        for request_queue in self._request_queues:
+            if request_queue is None:
+                continue
+            try:
+                request_queue.put(None)
+            except (OSError, ValueError):
+                pass
+
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+            self._request_worker.clear()
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("推理进程池已关闭"))
+
+    # 与LoRALanguageModel保持一致的关闭接口
+    close = shutdown
@@ -1,9 +1,18 @@
+import asyncio
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List
 import os
-from app.lora_rag_handler import create_lora_rag_handler
+from app.lora_rag_handler import create_lora_rag_handler, VECTOR_STORE_PATH
+from app.readiness import ReadinessState
+from app.admission import AdmissionController, AdmissionRejected, client_key_from_request, rejection_response
+from app.metrics import runtime_collector, metrics_response
+from app.tracing import tracer, InMemoryExporter, trace_http_request
+from app.profiler import MAX_PROFILE_SECONDS, verify_admin_token, run_profile
+from app.ollama_client import CircuitOpenError, get_ollama_client
+from app.prefork import take_preloaded_handler
 
 # 创建FastAPI应用
 app = FastAPI(
@@ -15,9 +24,23 @@ app = FastAPI(
 # 全局变量存储RAG处理器
 rag_handler = None
 
+# 预热完成前 /ready 返回503
+readiness = ReadinessState()
+
+# 并发上限、有界等待队列和按客户端限流，避免请求堆积在推理线程后面直到客户端超时
+admission = AdmissionController()
+
+# 单次批量请求允许的最大问题数
+MAX_BATCH_QUERIES = int(os.getenv("MAX_BATCH_QUERIES", "64"))
+
 # 定义请求体模型
 class QueryRequest(BaseModel):
     query: str
+    include_timings: Optional[bool] = False
+    use_lora: Optional[bool] = True
+
+class BatchQueryRequest(BaseModel):
+    queries: List[str]
     use_lora: Optional[bool] = True
 
 class ModelSwitchRequest(BaseModel):
@@ -28,10 +51,26 @@ class ConfigRequest(BaseModel):
     lora_model_path: Optional[str] = None
     cache_dir: Optional[str] = None
 
-@app.on_event("startup")
-async def startup_event():
-    """应用启动时初始化RAG处理器"""
-    global rag_handler
+def timings_requested(request: QueryRequest, http_request: Request) -> bool:
+    """通过请求体的include_timings或X-Include-Timings请求头开启耗时明细"""
+    header = http_request.headers.get("x-include-timings", "").lower()
+    return bool(request.include_timings) or header in ("1", "true", "yes")
+
+# 为每个请求创建根span，处理器中的检索、嵌入、FAISS搜索和生成span挂在其下
+app.middleware("http")(trace_http_request)
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """准入拒绝时快速返回429/503和Retry-After"""
+    return rejection_response(exc)
+
+@app.exception_handler(CircuitOpenError)
+async def ollama_circuit_open_handler(request: Request, exc: CircuitOpenError):
+    """Ollama熔断期间快速返回503，避免请求在故障的模型服务上堆积"""
+    return rejection_response(AdmissionRejected(503, str(exc), exc.retry_after))
+
+def build_rag_handler():
+    """按环境变量创建RAG处理器；LoRA初始化失败时回退到原始模型，仍失败则抛出异常"""
     try:
         # 从环境变量读取是否默认使用LoRA
         use_lora_default = os.getenv("USE_LORA_DEFAULT", "true").lower() == "true"
@@ -46,19 +85,40 @@ async def startup_event():
         print(f"LoRA适配器路径: {lora_path}")
         print(f"默认使用LoRA: {use_lora_default}")
         
-        rag_handler = create_lora_rag_handler(use_lora=use_lora_default)
+        handler = create_lora_rag_handler(use_lora=use_lora_default)
         print("✅ RAG系统初始化完成")
+        return handler
         
     except Exception as e:
         print(f"❌ RAG系统初始化失败: {e}")
         # 如果LoRA初始化失败，尝试使用原始模型
+        print("尝试使用原始Ollama模型...")
+        handler = create_lora_rag_handler(use_lora=False)
+        print("✅ 使用原始模型初始化成功")
+        return handler
+
+@app.on_event("startup")
+async def startup_event():
+    """应用启动时初始化RAG处理器"""
+    global rag_handler
+    runtime_collector.bind(admission, lambda: rag_handler)
+    # pre-fork模式下主进程已在fork前加载好向量库和模型，worker直接复用
+    rag_handler = take_preloaded_handler()
+    if rag_handler is None:
         try:
-            print("尝试使用原始Ollama模型...")
-            rag_handler = create_lora_rag_handler(use_lora=False)
-            print("✅ 使用原始模型初始化成功")
+            rag_handler = build_rag_handler()
         except Exception as e2:
             print(f"❌ 原始模型初始化也失败: {e2}")
-            rag_handler = None
+            readiness.mark_not_ready("init_failed", str(e2))
+            return
+    
+    # 在后台预热，期间服务已可响应 /health 和 /ready
+    readiness.start_warmup(rag_handler)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """关闭共享的Ollama连接池"""
+    await get_ollama_client().aclose()
 
 @app.get("/", summary="API根路径")
 async def root():
@@ -83,10 +143,25 @@ async def root():
         }
     }
 
+def switch_model_and_rewarm(use_lora: bool):
+    """切换模型模式并在后台重新预热，预热完成前 /ready 返回503；模式未变化时返回None"""
+    if use_lora == rag_handler.use_lora:
+        return None
+    readiness.mark_not_ready("switching_model")
+    rag_handler.switch_model(use_lora)
+    return readiness.start_warmup(rag_handler)
+
+async def ensure_model_mode(use_lora: bool):
+    """请求指定的模型模式与当前不同时切换，并等待预热完成后再处理该请求"""
+    warmup = switch_model_and_rewarm(use_lora)
+    if warmup is not None:
+        # 请求被取消时不取消预热
+        await asyncio.shield(warmup)
+
 @app.post("/ask",
           summary="向RAG系统提问",
           response_description="包含答案和来源文档的响应")
-async def ask_question(request: QueryRequest):
+async def ask_question(request: QueryRequest, http_request: Request):
     """
     接收用户的问题，并返回由RAG系统生成的答案。
     可以选择是否使用LoRA微调模型。
@@ -96,18 +171,54 @@ async def ask_question(request: QueryRequest):
     if rag_handler is None:
         raise HTTPException(status_code=500, detail="RAG系统未正确初始化")
     
-    try:
-        # 如果请求的模型模式与当前不同，切换模型
-        if request.use_lora != rag_handler.use_lora:
-            print(f"切换模型模式: {'LoRA' if request.use_lora else 'Ollama'}")
-            rag_handler.switch_model(request.use_lora)
+    async with admission.admit(client_key_from_request(http_request)):
+        try:
+            # 如果请求的模型模式与当前不同，切换模型并预热
+            await ensure_model_mode(request.use_lora)
+            
+            # 生成回答
+            response = await rag_handler.get_answer(
+                request.query, include_timings=timings_requested(request, http_request)
+            )
+            return response
+            
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"处理问题时出错: {str(e)}")
+
+@app.post("/ask_batch",
+          summary="批量向RAG系统提问",
+          response_description="与输入顺序一致的答案列表")
+async def ask_batch(request: BatchQueryRequest, http_request: Request):
+    """
+    一次提交多个问题，共享一次嵌入调用和一次向量检索，并批量生成答案。
+    单个问题失败时只在对应结果中返回error，不影响其他问题。
+    """
+    global rag_handler
+    
+    if rag_handler is None:
+        raise HTTPException(status_code=500, detail="RAG系统未正确初始化")
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="queries不能为空")
+    if len(request.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"单次最多提交 {MAX_BATCH_QUERIES} 个问题")
+    
+    # 批量请求按问题数消耗限流令牌，但只占用一个处理名额
+    async with admission.admit(client_key_from_request(http_request), cost=len(request.queries)):
+        try:
+            await ensure_model_mode(request.use_lora)
         
-        # 生成回答
-        response = await rag_handler.get_answer(request.query)
-        return response
+            results = await rag_handler.get_answers(request.queries)
+            return {
+                "results": results,
+                "model_info": {
+                    "base_model": rag_handler.base_model_name,
+                    "lora_model": rag_handler.lora_model_path if rag_handler.use_lora else None,
+                    "using_lora": rag_handler.use_lora
+                }
+            }
         
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"处理问题时出错: {str(e)}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"批量处理问题时出错: {str(e)}")
 
 @app.post("/switch_model",
           summary="切换模型模式",
@@ -123,7 +234,8 @@ async def switch_model(request: ModelSwitchRequest):
     
     try:
         old_mode = rag_handler.use_lora
-        rag_handler.switch_model(request.use_lora)
+        # 新加载的模型需要重新预热
+        switch_model_and_rewarm(request.use_lora)
         
         return {
             "message": "模型切换成功",
@@ -159,7 +271,7 @@ async def get_model_info():
         "lora_exists": lora_exists,
         "using_lora": rag_handler.use_lora,
         "cache_dir": rag_handler.cache_dir,
-        "vector_store_path": os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'vector_store')),
+        "vector_store_path": VECTOR_STORE_PATH,
         "embedding_model": os.getenv("OLLAMA_EMBEDDING_MODEL")
     }
 
@@ -184,8 +296,7 @@ async def health_check():
     }
     
     # 检查向量存储
-    vector_store_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'vector_store'))
-    health_status["components"]["vector_store"] = os.path.exists(vector_store_path) and os.listdir(vector_store_path)
+    health_status["components"]["vector_store"] = os.path.exists(VECTOR_STORE_PATH) and os.listdir(VECTOR_STORE_PATH)
     
     # 检查LoRA模型
     if rag_handler:
@@ -194,14 +305,12 @@ async def health_check():
             "base_model": rag_handler.base_model_name,
             "using_lora": rag_handler.use_lora
         }
+    health_status["details"]["admission"] = admission.stats()
     
-    # 检查Ollama服务（简单检查）
-    try:
-        import requests
-        response = requests.get("http://localhost:11434/api/tags", timeout=5)
-        health_status["components"]["ollama_service"] = response.status_code == 200
-    except:
-        health_status["components"]["ollama_service"] = False
+    # 检查Ollama服务：复用共享连接池异步请求，熔断期间直接判定不可用
+    ollama_client = get_ollama_client()
+    health_status["components"]["ollama_service"] = await ollama_client.ping(timeout=5)
+    health_status["details"]["ollama"] = ollama_client.stats()
     
     # 判断整体状态
     if not all(health_status["components"].values()):
@@ -209,6 +318,92 @@ async def health_check():
     
     return health_status
 
+@app.get("/metrics",
+         summary="Prometheus监控指标",
+         response_description="Prometheus文本格式的指标")
+async def metrics():
+    """
+    导出各流水线阶段耗时直方图、token吞吐、准入队列、模型内存和向量索引规模。
+    """
+    return metrics_response()
+
+@app.get("/traces",
+         summary="最近的请求链路",
+         response_description="按请求分组的span列表")
+async def get_traces(limit: int = 20,
+                     min_duration_ms: float = 0,
+                     trace_id: Optional[str] = None,
+                     x_admin_token: Optional[str] = Header(None)):
+    """
+    返回进程内收集的最近请求链路（TRACE_EXPORTER=memory时可用），
+    可按最小耗时筛选慢请求，或按X-Trace-Id响应头查询单条链路。
+    需要在X-Admin-Token请求头中提供ADMIN_TOKEN。
+    """
+    if not verify_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="需要有效的管理令牌（X-Admin-Token）")
+    if not isinstance(tracer.exporter, InMemoryExporter):
+        raise HTTPException(status_code=404, detail="未启用进程内追踪收集（TRACE_EXPORTER=memory）")
+    if trace_id:
+        return {"spans": tracer.exporter.spans(trace_id)}
+    return {"traces": tracer.exporter.traces(limit, min_duration_ms)}
+
+@app.post("/admin/profile",
+          summary="在线采样分析",
+          response_description="折叠栈格式的采样结果")
+async def admin_profile(seconds: float = 10,
+                        interval_ms: float = 5,
+                        thread: Optional[str] = None,
+                        format: str = "collapsed",
+                        x_admin_token: Optional[str] = Header(None)):
+    """
+    对当前进程的所有Python线程做栈采样，返回可交给flamegraph.pl或speedscope的折叠栈。
+    format=json时同时返回GIL唤醒延迟、事件循环延迟、各线程CPU时间和torch线程配置。
+    thread参数按线程名过滤，例如 MainThread（事件循环）或 lora-inference（推理线程）。
+    需要在X-Admin-Token请求头中提供ADMIN_TOKEN。
+    """
+    if not verify_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="需要有效的管理令牌（X-Admin-Token）")
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds需在0到{MAX_PROFILE_SECONDS}之间")
+    if interval_ms < 1:
+        raise HTTPException(status_code=400, detail="interval_ms不能小于1")
+    
+    try:
+        collapsed, stats = await run_profile(seconds, interval_ms / 1000, thread)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    # 推理进程池副本是独立进程，需要用py-spy等外部工具按PID分析
+    backend = getattr(rag_handler, "lora_backend", None)
+    if hasattr(backend, "stats"):
+        stats["inference_pool"] = backend.stats()
+    
+    if format == "json":
+        return {"stats": stats, "collapsed": collapsed}
+    return PlainTextResponse(collapsed, headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'})
+
+@app.get("/ready",
+         summary="就绪检查",
+         response_description="预热完成前返回503")
+async def ready_check():
+    """
+    供负载均衡器使用的就绪探针，预热完成后才返回200。
+    /health 只反映组件是否存活，不代表首个请求不会落入冷启动路径。
+    """
+    content = readiness.to_dict()
+    content["admission"] = admission.stats()
+    content["ollama"] = get_ollama_client().stats()
+    is_ready = readiness.is_ready
+    # 推理进程池有副本退出、正在重启时容量不足，恢复到全部副本前报告降级
+    backend = getattr(rag_handler, "lora_backend", None)
+    if hasattr(backend, "live_workers"):
+        live_workers = len(backend.live_workers())
+        content["inference_workers"] = {"live": live_workers, "total": backend.num_workers}
+        if live_workers < backend.num_workers:
+            is_ready = False
+            content["status"] = "degraded" if live_workers else "no_live_inference_workers"
+    return JSONResponse(status_code=200 if is_ready else 503, content=content)
+
 # 启动服务器
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8001)  # 使用不同端口避免冲突
\ No newline at end of file
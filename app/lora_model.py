@@ -0,0 +1,439 @@
+"""
+LoRA微调模型推理
+
+依赖torch、transformers和peft，仅在启用LoRA模式时由lora_rag_handler按需导入，
+使只使用Ollama模式的服务不必承担这些库的导入开销。
+"""
+
+import os
+import torch
+import asyncio
+import time
+from typing import Optional, Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteriaList
+from peft import PeftModel
+from app.generation_limits import AnswerLengthStats, StopSequenceCriteria, DeadlineCriteria, FirstTokenTimer, load_answer_lengths
+from app.metrics import STAGE_LATENCY, observe_generation
+
+# 生成参数（环境变量由lora_rag_handler在导入时从.env.lora/.env加载）
+NUM_ASSISTANT_TOKENS = int(os.getenv("NUM_ASSISTANT_TOKENS", "5"))
+MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", "512"))
+GENERATION_DEADLINE_SECONDS = float(os.getenv("GENERATION_DEADLINE_SECONDS", "30"))
+STOP_SEQUENCES = ["<|im_end|>"]
+GENERATION_BATCH_SIZE = int(os.getenv("BATCH_SIZE", "8"))
+
+class LoRALanguageModel:
+    """
+    基于LoRA微调模型的简单包装器
+    """
+    
+    def __init__(self, 
+                 base_model_name: str,
+                 lora_model_path: str,
+                 cache_dir: Optional[str] = None,
+                 max_length: int = 2048,
+                 temperature: float = 0.7,
+                 device: str = "auto",
+                 num_threads: Optional[int] = None,
+                 draft_model_name: Optional[str] = None,
+                 num_assistant_tokens: int = NUM_ASSISTANT_TOKENS,
+                 max_new_tokens: int = MAX_NEW_TOKENS,
+                 deadline_seconds: float = GENERATION_DEADLINE_SECONDS,
+                 stop_sequences: Optional[List[str]] = None,
+                 batch_size: int = GENERATION_BATCH_SIZE):
+        
+        # 设置基本属性
+        self.base_model_name = base_model_name
+        self.lora_model_path = lora_model_path
+        self.cache_dir = cache_dir
+        self.max_length = max_length
+        self.temperature = temperature
+        self.device = device if device != "auto" else ("cuda" if torch.cuda.is_available() else "cpu")
+        self.num_threads = num_threads
+        self.draft_model_name = draft_model_name
+        self.num_assistant_tokens = num_assistant_tokens
+        self.max_new_tokens = max_new_tokens
+        self.deadline_seconds = deadline_seconds
+        self.stop_sequences = stop_sequences if stop_sequences is not None else STOP_SEQUENCES
+        self.length_stats = AnswerLengthStats(max_tokens=max_new_tokens)
+        self.batch_size = max(1, batch_size)
+        
+        # 限制torch计算线程数（推理进程池中每个副本只使用分配给它的核心）
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        
+        # 初始化模型相关属性
+        self.tokenizer = None
+        self.model = None
+        self.base_model = None
+        self.draft_model = None
+        self.last_generation_stats = None
+        
+        # 加载模型
+        self._load_model()
+        
+        # 创建线程池用于异步推理（模型只能串行推理，一个线程即可）
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lora-inference")
+    
+    def _load_model(self):
+        """加载基础模型和LoRA适配器"""
+        print(f"正在加载基础模型: {self.base_model_name}")
+        
+        # 加载tokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            self.base_model_name,
+            cache_dir=self.cache_dir,
+            trust_remote_code=True
+        )
+        
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        
+        # 设备配置逻辑
+        if self.device == "cpu":
+            # 强制使用CPU
+            device_map = None
+            torch_dtype = torch.float32
+            print("配置为CPU模式，使用CPU进行推理")
+        elif self.device == "cuda":
+            # 强制使用CUDA
+            if torch.cuda.is_available():
+                device_map = "auto"
+                torch_dtype = torch.bfloat16
+                print("配置为CUDA模式，使用GPU进行推理")
+            else:
+                print("Warning: 配置为CUDA模式但CUDA不可用，回退到CPU")
+                device_map = None
+                torch_dtype = torch.float32
+        else:
+            # auto模式：自动检测
+            if torch.cuda.is_available():
+                device_map = "auto"
+                torch_dtype = torch.bfloat16
+                print("自动检测到CUDA，使用GPU进行推理")
+            else:
+                device_map = None
+                torch_dtype = torch.float32
+                print("CUDA不可用，使用CPU进行推理")
+        
+        # 加载基础模型
+        self.base_model = AutoModelForCausalLM.from_pretrained(
+            self.base_model_name,
+            cache_dir=self.cache_dir,
+            trust_remote_code=True,
+            torch_dtype=torch_dtype,
+            device_map=device_map,
+            low_cpu_mem_usage=True
+        )
+        
+        # 检查LoRA适配器是否存在
+        if os.path.exists(self.lora_model_path):
+            print(f"正在加载LoRA适配器: {self.lora_model_path}")
+            try:
+                self.model = PeftModel.from_pretrained(
+                    self.base_model,
+                    self.lora_model_path,
+                    torch_dtype=torch_dtype
+                )
+                print("✅ LoRA适配器加载成功")
+            except Exception as e:
+                print(f"⚠️ LoRA适配器加载失败: {e}")
+                print("使用基础模型进行推理")
+                self.model = self.base_model
+        else:
+            print(f"⚠️ LoRA适配器路径不存在: {self.lora_model_path}")
+            print("使用基础模型进行推理")
+            self.model = self.base_model
+        
+        # 设置为评估模式
+        self.model.eval()
+        
+        # 加载草稿模型（用于辅助生成/推测解码）
+        if self.draft_model_name:
+            self._load_draft_model(torch_dtype, device_map)
+        
+        # 停止序列的token id，以及用微调数据集的回答长度初始化生成上限
+        self.stop_token_sequences = [
+            self.tokenizer.encode(seq, add_special_tokens=False) for seq in self.stop_sequences
+        ]
+        self._seed_length_stats()
+    
+    def _seed_length_stats(self):
+        """用微调数据集中的回答长度作为各路由生成上限的先验"""
+        lengths = load_answer_lengths(lambda text: len(self.tokenizer.encode(text, add_special_tokens=False)))
+        if lengths:
+            self.length_stats.record_many("default", lengths)
+            print(f"已从微调数据集加载 {len(lengths)} 条回答长度，默认生成上限 {self.length_stats.token_cap('default')} tokens")
+    
+    def _token_cap(self, route: str) -> int:
+        """路由样本不足min_samples时回退到默认路由的上限"""
+        return self.length_stats.token_cap(route, fallback_route="default")
+    
+    def _load_draft_model(self, torch_dtype, device_map):
+        """加载小型草稿模型，需与基础模型共用同一分词器"""
+        print(f"正在加载草稿模型: {self.draft_model_name}")
+        try:
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                self.draft_model_name,
+                cache_dir=self.cache_dir,
+                trust_remote_code=True,
+                torch_dtype=torch_dtype,
+                device_map=device_map,
+                low_cpu_mem_usage=True
+            )
+            self.draft_model.eval()
+            self.draft_model.generation_config.num_assistant_tokens = self.num_assistant_tokens
+            print(f"✅ 草稿模型加载成功，每轮推测 {self.num_assistant_tokens} 个token")
+        except Exception as e:
+            print(f"⚠️ 草稿模型加载失败: {e}")
+            print("关闭辅助生成，使用常规解码")
+            self.draft_model = None
+    
+    def _count_forward_passes(self, module, counter: Dict[str, int], key: str):
+        """为模块注册前向计数钩子，返回钩子句柄"""
+        def hook(*args):
+            counter[key] += 1
+        return module.register_forward_hook(hook)
+    
+    def _log_speculative_stats(self, stats: Dict[str, Any]):
+        """记录单次辅助生成的接受率和加速比"""
+        new_tokens = stats["new_tokens"]
+        target_passes = max(stats["target_passes"], 1)
+        draft_passes = stats["draft_passes"]
+        
+        # 每次目标模型前向都会产出1个自身token，其余新token都来自被接受的草稿token
+        accepted = max(new_tokens - target_passes, 0)
+        stats["accepted_draft_tokens"] = accepted
+        stats["acceptance_rate"] = accepted / draft_passes if draft_passes else 0.0
+        stats["tokens_per_target_pass"] = new_tokens / target_passes
+        
+        print(
+            f"辅助生成统计: 新token {new_tokens}, 目标模型前向 {stats['target_passes']} 次, "
+            f"草稿token {draft_passes} 个, 接受率 {stats['acceptance_rate']:.1%}, "
+            f"理论加速比 {stats['tokens_per_target_pass']:.2f}x, "
+            f"耗时 {stats['duration']:.2f}秒 ({new_tokens / max(stats['duration'], 1e-6):.1f} token/s)"
+        )
+    
+    def _generation_kwargs(self, token_cap: int, stopping_criteria) -> Dict[str, Any]:
+        """单条和批量生成共用的generate参数"""
+        return {
+            "max_new_tokens": token_cap,
+            "stopping_criteria": stopping_criteria,
+            "temperature": self.temperature,
+            "do_sample": True if self.temperature > 0 else False,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "eos_token_id": self.tokenizer.eos_token_id,
+            "repetition_penalty": 1.1
+        }
+    
+    def _generate_response(self, prompt: str, route: str = "default") -> str:
+        """生成响应"""
+        return self._generate_with_stats(prompt, route)[0]
+    
+    def _generate_with_stats(self, prompt: str, route: str = "default"):
+        """生成响应，并返回本次生成的token数和预填充/解码耗时"""
+        try:
+            # 编码输入
+            inputs = self.tokenizer(
+                prompt,
+                return_tensors="pt",
+                truncation=True,
+                max_length=self.max_length - self.max_new_tokens,  # 为输出预留空间
+                padding=True
+            )
+            
+            # 移动到正确的设备
+            if self.device != "cpu" and torch.cuda.is_available():
+                inputs = {k: v.cuda() for k, v in inputs.items()}
+            
+            # 提前结束条件：停止序列、按路由学习的token上限、墙钟截止时间
+            prompt_length = inputs['input_ids'].shape[1]
+            token_cap = self._token_cap(route)
+            deadline = DeadlineCriteria(self.deadline_seconds)
+            first_token = FirstTokenTimer()
+            stopping_criteria = StoppingCriteriaList([
+                StopSequenceCriteria(self.stop_token_sequences, prompt_length),
+                deadline,
+                first_token
+            ])
+            
+            generate_kwargs = self._generation_kwargs(token_cap, stopping_criteria)
+            
+            # 辅助生成：草稿模型推测多个token，由LoRA模型一次前向验证
+            hooks = []
+            counter = {"target": 0, "draft": 0}
+            if self.draft_model is not None:
+                generate_kwargs["assistant_model"] = self.draft_model
+                hooks.append(self._count_forward_passes(self.base_model, counter, "target"))
+                hooks.append(self._count_forward_passes(self.draft_model, counter, "draft"))
+            
+            # 生成响应
+            start_time = time.time()
+            try:
+                with torch.no_grad():
+                    outputs = self.model.generate(**inputs, **generate_kwargs)
+            finally:
+                for handle in hooks:
+                    handle.remove()
+            
+            finished_at = time.perf_counter()
+            new_token_ids = outputs[0][prompt_length:]
+            prefill_seconds, decode_seconds = first_token.split(finished_at)
+            observe_generation("lora", prefill_seconds, decode_seconds, len(new_token_ids), prompt_length)
+            generation_stats = {
+                "prompt_tokens": prompt_length,
+                "completion_tokens": len(new_token_ids),
+                "prefill_seconds": prefill_seconds,
+                "decode_seconds": decode_seconds
+            }
+            
+            # 超时截断的回答不计入长度统计；达到上限的按上限计入，使上限能随实际需要上调
+            if deadline.triggered:
+                print(f"⚠️ 生成超过 {self.deadline_seconds} 秒截止时间，返回部分回答（{len(new_token_ids)} tokens）")
+            else:
+                self.length_stats.record(route, len(new_token_ids))
+            
+            if self.draft_model is not None:
+                self.last_generation_stats = {
+                    "new_tokens": len(new_token_ids),
+                    "target_passes": counter["target"],
+                    "draft_passes": counter["draft"],
+                    "duration": time.time() - start_time
+                }
+                self._log_speculative_stats(self.last_generation_stats)
+            
+            # 解码响应
+            response = self.tokenizer.decode(
+                new_token_ids,
+                skip_special_tokens=True
+            )
+            
+            return response.strip(), generation_stats
+            
+        except Exception as e:
+            print(f"生成响应时出错: {e}")
+            return "抱歉，生成响应时出现错误。", {}
+    
+    def _generate_batch(self, prompts: List[str], route: str = "default") -> List[str]:
+        """批量生成响应：左侧填充后在一次generate调用中解码整批序列"""
+        if len(prompts) == 1:
+            return [self._generate_response(prompts[0], route)]
+        
+        try:
+            # 批量生成需要左侧填充，使所有序列的生成部分对齐
+            padding_side = self.tokenizer.padding_side
+            self.tokenizer.padding_side = "left"
+            try:
+                inputs = self.tokenizer(
+                    prompts,
+                    return_tensors="pt",
+                    truncation=True,
+                    max_length=self.max_length - self.max_new_tokens,
+                    padding=True
+                )
+            finally:
+                self.tokenizer.padding_side = padding_side
+            
+            if self.device != "cpu" and torch.cuda.is_available():
+                inputs = {k: v.cuda() for k, v in inputs.items()}
+            
+            prompt_length = inputs['input_ids'].shape[1]
+            deadline = DeadlineCriteria(self.deadline_seconds)
+            first_token = FirstTokenTimer()
+            stopping_criteria = StoppingCriteriaList([
+                StopSequenceCriteria(self.stop_token_sequences, prompt_length),
+                deadline,
+                first_token
+            ])
+            
+            # 辅助生成只支持单条序列，批量时使用常规解码
+            with torch.no_grad():
+                outputs = self.model.generate(
+                    **inputs,
+                    **self._generation_kwargs(self._token_cap(route), stopping_criteria)
+                )
+            prefill_seconds, decode_seconds = first_token.split(time.perf_counter())
+            
+            responses = []
+            total_new_tokens = 0
+            for row in outputs:
+                new_token_ids = row[prompt_length:]
+                num_tokens = int((new_token_ids != self.tokenizer.pad_token_id).sum())
+                total_new_tokens += num_tokens
+                if not deadline.triggered:
+                    self.length_stats.record(route, num_tokens)
+                responses.append(self.tokenizer.decode(new_token_ids, skip_special_tokens=True).strip())
+            observe_generation("lora", prefill_seconds, decode_seconds, total_new_tokens,
+                               int(inputs['attention_mask'].sum()))
+            
+            if deadline.triggered:
+                print(f"⚠️ 批量生成超过 {self.deadline_seconds} 秒截止时间，返回部分回答")
+            return responses
+            
+        except Exception as e:
+            print(f"批量生成时出错，改为逐条生成: {e}")
+            return [self._generate_response(prompt, route) for prompt in prompts]
+    
+    def generate_batch(self, prompts: List[str], route: str = "default") -> List[str]:
+        """按batch_size分批生成，返回与输入顺序一致的响应"""
+        responses = []
+        for start in range(0, len(prompts), self.batch_size):
+            responses.extend(self._generate_batch(prompts[start:start + self.batch_size], route))
+        return responses
+    
+    def _run_queued(self, submitted_at: float, func, *args):
+        """在推理线程中执行，并记录请求在推理线程前的排队时间"""
+        STAGE_LATENCY.labels("lora", "inference_wait").observe(time.perf_counter() - submitted_at)
+        return func(*args)
+    
+    async def agenerate_batch(self, prompts: List[str], route: str = "default") -> List[str]:
+        """异步批量生成响应"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, self._run_queued, time.perf_counter(), self.generate_batch, prompts, route
+        )
+    
+    def generate(self, prompt: str, route: str = "default") -> str:
+        """生成响应"""
+        return self._generate_response(prompt, route)
+    
+    def generate_with_stats(self, prompt: str, route: str = "default"):
+        """生成响应，同时返回生成统计（token数、预填充和解码秒数）"""
+        return self._generate_with_stats(prompt, route)
+    
+    async def agenerate_with_stats(self, prompt: str, route: str = "default"):
+        """异步生成响应，同时返回生成统计"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, self._run_queued, time.perf_counter(), self._generate_with_stats, prompt, route
+        )
+    
+    async def agenerate(self, prompt: str, route: str = "default") -> str:
+        """异步生成响应"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, self._run_queued, time.perf_counter(), self._generate_response, prompt, route
+        )
+    
+    def invoke(self, input_text: str) -> str:
+        """调用接口，兼容LangChain"""
+        return self.generate(input_text)
+    
+    def predict(self, text: str) -> str:
+        """预测接口"""
+        return self.generate(text)
+    
+    def after_fork(self, num_threads: Optional[int] = None):
+        """
+        pre-fork模式下在worker进程中调用：fork不会复制线程，重建推理线程池，
+        并按每个worker分到的核心数设置torch计算线程。
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lora-inference")
+        if num_threads:
+            self.num_threads = num_threads
+            torch.set_num_threads(num_threads)
+
+    def close(self):
+        """释放推理线程池"""
+        self.executor.shutdown(wait=False)
@@ -1,35 +1,48 @@
 import os
-import torch
 from typing import Optional, Dict, Any, List
 from dotenv import load_dotenv
 from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains import create_retrieval_chain
 from langchain_core.runnables import Runnable
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import PeftModel
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import time
+from app.retrieval import batch_similarity_search, format_context, serialize_documents
+from app.metrics import track_stage, observe_ollama_response, build_timings, astream_with_ttft, message_token_counts
+from app.tracing import start_span, document_sources
+from app.ollama_client import get_ollama_client
 
 # 加载环境变量
-# 首先加载.env文件
-load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
-# 然后加载.env.lora文件（如果存在），它会覆盖.env中的同名变量
+# 优先级：进程环境变量 > .env.lora > .env（先加载的文件不会被后加载的文件覆盖）
 lora_env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env.lora'))
 if os.path.exists(lora_env_path):
-    load_dotenv(dotenv_path=lora_env_path, override=True)
+    load_dotenv(dotenv_path=lora_env_path)
     print(f"✅ 已加载LoRA环境配置: {lora_env_path}")
 else:
     print(f"⚠️ LoRA环境配置文件不存在: {lora_env_path}")
+load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
 
 # 定义常量
-VECTOR_STORE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'vector_store'))
+# 相对路径按项目根目录解析
+VECTOR_STORE_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', os.getenv("VECTOR_STORE_PATH", "vector_store")
+))
 OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL")
 LORA_MODEL_PATH = os.getenv("LORA_MODEL_PATH", "./lora_adapters")
 BASE_MODEL_NAME = os.getenv("BASE_MODEL_NAME", "Qwen/Qwen2.5-1.5B-Instruct")
 CACHE_DIR = os.getenv("CACHE_DIR", None)
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_THREADS_PER_WORKER = int(os.getenv("INFERENCE_THREADS_PER_WORKER", "0")) or None
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME") or None
+RETRIEVAL_K = 5
+BATCH_GENERATION_CONCURRENCY = int(os.getenv("BATCH_GENERATION_CONCURRENCY", "4"))
+
+def __getattr__(name):
+    """按需导入LoRA推理类，避免只用Ollama模式时加载torch/transformers/peft"""
+    if name == "LoRALanguageModel":
+        from app.lora_model import LoRALanguageModel
+        return LoRALanguageModel
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class LoRALangChainWrapper(Runnable):
     """
@@ -42,13 +55,7 @@ class LoRALangChainWrapper(Runnable):
     
     def invoke(self, input_text, config=None, **kwargs):
         """LangChain调用接口"""
-        if hasattr(input_text, 'content'):
-            # 处理消息对象
-            return self.lora_model.generate(input_text.content)
-        elif isinstance(input_text, str):
-            return self.lora_model.generate(input_text)
-        else:
-            return self.lora_model.generate(str(input_text))
+        return self.lora_model.generate(self._to_text(input_text), self._route(config))
     
     def predict(self, text):
         """预测接口"""
@@ -56,208 +63,35 @@ class LoRALangChainWrapper(Runnable):
     
     async def ainvoke(self, input_text, config=None, **kwargs):
         """异步调用接口"""
-        if hasattr(input_text, 'content'):
-            return await self.lora_model.agenerate(input_text.content)
-        elif isinstance(input_text, str):
-            return await self.lora_model.agenerate(input_text)
-        else:
-            return await self.lora_model.agenerate(str(input_text))
-
-class LoRALanguageModel:
-    """
-    基于LoRA微调模型的简单包装器
-    """
-    
-    def __init__(self, 
-                 base_model_name: str,
-                 lora_model_path: str,
-                 cache_dir: Optional[str] = None,
-                 max_length: int = 2048,
-                 temperature: float = 0.7,
-                 device: str = "auto"):
-        
-        # 设置基本属性
-        self.base_model_name = base_model_name
-        self.lora_model_path = lora_model_path
-        self.cache_dir = cache_dir
-        self.max_length = max_length
-        self.temperature = temperature
-        self.device = device if device != "auto" else ("cuda" if torch.cuda.is_available() else "cpu")
-        
-        # 初始化线程池
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        
-        # 初始化模型相关属性
-        self.tokenizer = None
-        self.model = None
-        self.base_model = None
-        
-        # 加载模型
-        self._load_model()
-        
-        # 创建线程池用于异步推理
-        self.executor = ThreadPoolExecutor(max_workers=1)
-    
-    def _load_model(self):
-        """加载基础模型和LoRA适配器"""
-        print(f"正在加载基础模型: {self.base_model_name}")
-        
-        # 加载tokenizer
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.base_model_name,
-            cache_dir=self.cache_dir,
-            trust_remote_code=True
-        )
-        
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
-        
-        # 设备配置逻辑
-        if self.device == "cpu":
-            # 强制使用CPU
-            device_map = None
-            torch_dtype = torch.float32
-            print("配置为CPU模式，使用CPU进行推理")
-        elif self.device == "cuda":
-            # 强制使用CUDA
-            if torch.cuda.is_available():
-                device_map = "auto"
-                torch_dtype = torch.bfloat16
-                print("配置为CUDA模式，使用GPU进行推理")
-            else:
-                print("Warning: 配置为CUDA模式但CUDA不可用，回退到CPU")
-                device_map = None
-                torch_dtype = torch.float32
-        else:
-            # auto模式：自动检测
-            if torch.cuda.is_available():
-                device_map = "auto"
-                torch_dtype = torch.bfloat16
-                print("自动检测到CUDA，使用GPU进行推理")
-            else:
-                device_map = None
-                torch_dtype = torch.float32
-                print("CUDA不可用，使用CPU进行推理")
-        
-        # 加载基础模型
-        self.base_model = AutoModelForCausalLM.from_pretrained(
-            self.base_model_name,
-            cache_dir=self.cache_dir,
-            trust_remote_code=True,
-            torch_dtype=torch_dtype,
-            device_map=device_map,
-            low_cpu_mem_usage=True
-        )
-        
-        # 检查LoRA适配器是否存在
-        if os.path.exists(self.lora_model_path):
-            print(f"正在加载LoRA适配器: {self.lora_model_path}")
-            try:
-                self.model = PeftModel.from_pretrained(
-                    self.base_model,
-                    self.lora_model_path,
-                    torch_dtype=torch_dtype
-                )
-                print("✅ LoRA适配器加载成功")
-            except Exception as e:
-                print(f"⚠️ LoRA适配器加载失败: {e}")
-                print("使用基础模型进行推理")
-                self.model = self.base_model
-        else:
-            print(f"⚠️ LoRA适配器路径不存在: {self.lora_model_path}")
-            print("使用基础模型进行推理")
-            self.model = self.base_model
-        
-        # 设置为评估模式
-        self.model.eval()
+        return await self.lora_model.agenerate(self._to_text(input_text), self._route(config))
     
-    def _generate_response(self, prompt: str) -> str:
-        """生成响应"""
+    async def abatch(self, inputs, config=None, *, return_exceptions=False, **kwargs):
+        """批量调用接口：整批交给模型做批量生成，而不是逐条并发调用"""
+        if isinstance(config, list):
+            config = config[0] if config else None
+        texts = [self._to_text(input_text) for input_text in inputs]
         try:
-            # 编码输入
-            inputs = self.tokenizer(
-                prompt,
-                return_tensors="pt",
-                truncation=True,
-                max_length=self.max_length - 512,  # 为输出预留空间
-                padding=True
-            )
-            
-            # 移动到正确的设备
-            if self.device != "cpu" and torch.cuda.is_available():
-                inputs = {k: v.cuda() for k, v in inputs.items()}
-            
-            # 生成响应
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=512,
-                    temperature=self.temperature,
-                    do_sample=True if self.temperature > 0 else False,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    repetition_penalty=1.1
-                )
-            
-            # 解码响应
-            response = self.tokenizer.decode(
-                outputs[0][inputs['input_ids'].shape[1]:],
-                skip_special_tokens=True
-            )
-            
-            return response.strip()
-            
+            return await self.lora_model.agenerate_batch(texts, self._route(config))
         except Exception as e:
-            print(f"生成响应时出错: {e}")
-            return "抱歉，生成响应时出现错误。"
-    
-    def generate(self, prompt: str) -> str:
-        """生成响应"""
-        return self._generate_response(prompt)
+            if return_exceptions:
+                return [e] * len(texts)
+            raise
     
-    async def agenerate(self, prompt: str) -> str:
-        """异步生成响应"""
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(self.executor, self._generate_response, prompt)
-    
-    def invoke(self, input_text: str) -> str:
-        """调用接口，兼容LangChain"""
-        return self.generate(input_text)
-    
-    def predict(self, text: str) -> str:
-        """预测接口"""
-        return self.generate(text)
-    
-    def generate_prompt(self, prompts, **kwargs):
-        """生成提示接口"""
-        if isinstance(prompts, list):
-            return [self._call(prompt, **kwargs) for prompt in prompts]
-        else:
-            return self._call(prompts, **kwargs)
-    
-    async def apredict(self, text: str, **kwargs) -> str:
-        """异步预测接口"""
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(self.executor, self._call, text)
-    
-    async def apredict_messages(self, messages, **kwargs) -> str:
-        """异步消息预测接口"""
-        if isinstance(messages, list):
-            text = "\n".join([str(msg) for msg in messages])
+    @staticmethod
+    def _to_text(input_text) -> str:
+        """把LangChain输入（消息对象、字符串或提示值）转换为模型输入文本"""
+        if hasattr(input_text, 'content'):
+            # 处理消息对象
+            return input_text.content
+        elif isinstance(input_text, str):
+            return input_text
         else:
-            text = str(messages)
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(self.executor, self._call, text)
+            return str(input_text)
     
-    async def agenerate_prompt(self, prompts, **kwargs):
-        """异步生成提示接口"""
-        if isinstance(prompts, list):
-            loop = asyncio.get_event_loop()
-            tasks = [loop.run_in_executor(self.executor, self._call, prompt) for prompt in prompts]
-            return await asyncio.gather(*tasks)
-        else:
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(self.executor, self._call, prompts)
+    @staticmethod
+    def _route(config) -> str:
+        """从LangChain运行配置的metadata中读取路由名，用于按路由限制生成长度"""
+        return ((config or {}).get("metadata") or {}).get("route", "default")
 
 class LoRARAGHandler:
     """
@@ -269,7 +103,10 @@ class LoRARAGHandler:
                  lora_model_path: str = LORA_MODEL_PATH,
                  cache_dir: Optional[str] = CACHE_DIR,
                  use_lora: bool = True,
-                 device: str = "cpu"):
+                 device: str = "cpu",
+                 inference_workers: int = INFERENCE_WORKERS,
+                 threads_per_worker: Optional[int] = INFERENCE_THREADS_PER_WORKER,
+                 draft_model_name: Optional[str] = DRAFT_MODEL_NAME):
         
         if not os.path.exists(VECTOR_STORE_PATH) or not os.listdir(VECTOR_STORE_PATH):
             raise ValueError(f"向量存储路径 {VECTOR_STORE_PATH} 不存在或为空。请先运行 ingest.py 脚本。")
@@ -279,6 +116,11 @@ class LoRARAGHandler:
         self.lora_model_path = lora_model_path
         self.cache_dir = cache_dir
         self.device = device
+        self.inference_workers = inference_workers
+        self.threads_per_worker = threads_per_worker
+        self.draft_model_name = draft_model_name
+        self.vector_store_path = VECTOR_STORE_PATH
+        self.lora_backend = None
         
         # 初始化组件
         self._initialize_components()
@@ -287,23 +129,22 @@ class LoRARAGHandler:
         """初始化RAG组件"""
         print("正在初始化LoRA RAG处理器...")
         
-        # 初始化嵌入模型
-        self.embeddings = OllamaEmbeddings(
+        # 释放上一次初始化时创建的推理资源
+        self._close_lora_backend()
+        
+        # 初始化嵌入模型（与Ollama生成模型共用进程内的连接池）
+        ollama_client = get_ollama_client()
+        self.embeddings = ollama_client.bind(OllamaEmbeddings(
             model=OLLAMA_EMBEDDING_MODEL, 
-            base_url="http://localhost:11434"
-        )
+            base_url=ollama_client.base_url
+        ))
         
         # 初始化语言模型
         if self.use_lora:
             print("使用LoRA微调模型")
             try:
-                lora_model = LoRALanguageModel(
-                    base_model_name=self.base_model_name,
-                    lora_model_path=self.lora_model_path,
-                    cache_dir=self.cache_dir,
-                    temperature=0.1,  # 较低的温度以获得更一致的回答
-                    device=self.device
-                )
+                lora_model = self._create_lora_backend()
+                self.lora_backend = lora_model
                 # 创建LangChain兼容的包装器
                 self.llm = LoRALangChainWrapper(lora_model)
                 print(f"✅ LoRA模型初始化成功，base_model_name: {lora_model.base_model_name}")
@@ -314,11 +155,11 @@ class LoRARAGHandler:
         else:
             print("使用Ollama模型")
             from langchain_ollama import ChatOllama
-            self.llm = ChatOllama(
+            self.llm = ollama_client.bind(ChatOllama(
                 model=os.getenv("OLLAMA_CHAT_MODEL", "qwen3:4b"),
                 temperature=0,
-                base_url="http://localhost:11434"
-            )
+                base_url=ollama_client.base_url
+            ))
         
         # 加载向量存储
         print("正在加载向量存储...")
@@ -328,17 +169,48 @@ class LoRARAGHandler:
             allow_dangerous_deserialization=True
         )
         
-        # 创建检索器
-        self.retriever = self.vector_store.as_retriever(search_kwargs={"k": 5})
-        
         # 创建提示模板
         self.prompt = self._create_prompt_template()
         
-        # 创建检索链
-        self.retrieval_chain = self._create_chain()
-        
         print("✅ LoRA RAG处理器初始化完成")
     
+    def _create_lora_backend(self):
+        """创建LoRA推理后端：单个模型实例，或多副本推理进程池"""
+        model_kwargs = {
+            "base_model_name": self.base_model_name,
+            "lora_model_path": self.lora_model_path,
+            "cache_dir": self.cache_dir,
+            "temperature": 0.1,  # 较低的温度以获得更一致的回答
+            "device": self.device,
+            "draft_model_name": self.draft_model_name
+        }
+        
+        if self.inference_workers > 1:
+            if self.device == "cpu":
+                from app.inference_pool import InferencePool
+                return InferencePool(
+                    model_kwargs,
+                    num_workers=self.inference_workers,
+                    threads_per_worker=self.threads_per_worker
+                ).start()
+            print(f"⚠️ 推理进程池仅支持CPU模式，当前设备为 {self.device}，使用单个模型实例")
+        
+        from app.lora_model import LoRALanguageModel
+        return LoRALanguageModel(num_threads=self.threads_per_worker, **model_kwargs)
+    
+    def after_fork(self, num_threads: Optional[int] = None):
+        """pre-fork模式下在worker进程中调用，重建推理线程等不能跨fork继承的资源"""
+        if num_threads:
+            self.threads_per_worker = num_threads
+        if self.lora_backend is not None and hasattr(self.lora_backend, "after_fork"):
+            self.lora_backend.after_fork(num_threads)
+    
+    def _close_lora_backend(self):
+        """关闭当前的LoRA推理后端"""
+        if self.lora_backend is not None:
+            self.lora_backend.close()
+            self.lora_backend = None
+    
     def _create_prompt_template(self):
         """创建针对微调模型优化的提示模板"""
         system_prompt = (
@@ -357,30 +229,111 @@ class LoRARAGHandler:
             ("human", "问题：{input}\n\n请根据上述上下文信息回答这个问题。")
         ])
     
-    def _create_chain(self):
-        """创建检索链"""
-        question_answer_chain = create_stuff_documents_chain(self.llm, self.prompt)
-        return create_retrieval_chain(self.retriever, question_answer_chain)
+    @property
+    def backend_name(self) -> str:
+        """监控指标中的后端标签"""
+        return "lora" if self.use_lora else "ollama"
+    
+    async def warmup(self, query: str = "系统预热") -> Dict[str, float]:
+        """执行一次合成的嵌入、检索和生成，提前支付线程池、分词器缓存和模型加载等首次调用开销"""
+        timings = {}
+        
+        start = time.time()
+        query_vector = await self.embeddings.aembed_query(query)
+        timings["embed"] = time.time() - start
+        
+        start = time.time()
+        await self.vector_store.asimilarity_search_by_vector(query_vector, k=5)
+        timings["retrieve"] = time.time() - start
+        
+        start = time.time()
+        if self.use_lora:
+            # 推理进程池需要让每个副本都完成一次生成
+            replicas = getattr(self.lora_backend, "num_workers", 1)
+            await asyncio.gather(*[
+                self.lora_backend.agenerate("你好", "warmup") for _ in range(replicas)
+            ])
+        else:
+            await self.llm.ainvoke("你好")
+        timings["generate"] = time.time() - start
+        
+        return timings
+    
+    async def _retrieve(self, query: str, timings: Optional[Dict[str, float]] = None) -> list:
+        """嵌入问题并检索相关文档"""
+        backend = self.backend_name
+        with start_span("rag.retrieval", k=RETRIEVAL_K) as span:
+            with track_stage(backend, "embed", timings), start_span("ollama.embed", model=OLLAMA_EMBEDDING_MODEL):
+                query_vector = await self.embeddings.aembed_query(query)
+            with track_stage(backend, "search", timings), start_span("faiss.search", k=RETRIEVAL_K):
+                docs = await self.vector_store.asimilarity_search_by_vector(query_vector, k=RETRIEVAL_K)
+            span.set_attributes({"chunk_count": len(docs), "sources": document_sources(docs)})
+        return docs
+    
+    async def _generate(self, prompt_value, route: str, include_timings: bool):
+        """
+        生成答案，返回 (答案文本, 首个token耗时秒数, 提示token数, 生成token数)。
+        Ollama只在需要计时时改用流式调用测量首个token耗时，其余情况首个token耗时为None。
+        """
+        config = {"metadata": {"route": route}}
+        
+        if self.use_lora:
+            start = time.perf_counter()
+            answer, stats = await self.lora_backend.agenerate_with_stats(
+                LoRALangChainWrapper._to_text(prompt_value), route
+            )
+            if not stats:
+                return answer, None, None, None
+            # 首个token之前的时间 = 推理线程排队 + 预填充，即生成总耗时减去解码耗时
+            ttft_seconds = time.perf_counter() - start - stats["decode_seconds"]
+            return answer, ttft_seconds, stats["prompt_tokens"], stats["completion_tokens"]
+        
+        # Ollama从响应元数据中记录预填充/解码耗时，LoRA模型在推理线程中自行记录
+        if include_timings:
+            message, ttft_seconds = await astream_with_ttft(self.llm, prompt_value, config=config)
+        else:
+            message, ttft_seconds = await self.llm.ainvoke(prompt_value, config=config), None
+        observe_ollama_response(message)
+        return (message.content, ttft_seconds, *message_token_counts(message))
     
-    async def get_answer(self, query: str) -> Dict[str, Any]:
-        """根据用户提问，检索并生成答案"""
+    async def get_answer(self, query: str, route: str = "ask", include_timings: bool = False) -> Dict[str, Any]:
+        """
+        根据用户提问，按嵌入、检索、提示构建、生成四个阶段生成答案。
+        include_timings为True时在响应中返回各阶段耗时、首个token耗时和token数。
+        """
+        backend = self.backend_name
+        timings = {} if include_timings else None
         try:
-            response = await self.retrieval_chain.ainvoke({"input": query})
+            with start_span("rag.get_answer", backend=backend, route=route, query_chars=len(query)), \
+                    track_stage(backend, "total", timings):
+                docs = await self._retrieve(query, timings)
+                with track_stage(backend, "prompt", timings), start_span("rag.prompt") as span:
+                    context = format_context(docs)
+                    prompt_value = self.prompt.invoke({"context": context, "input": query})
+                    span.set_attribute("context_chars", len(context))
+                with track_stage(backend, "generate", timings), start_span(
+                    "llm.generate",
+                    backend=backend,
+                    model=self.base_model_name if self.use_lora else os.getenv("OLLAMA_CHAT_MODEL", "qwen3:4b"),
+                    adapter=os.path.basename(os.path.normpath(self.lora_model_path)) if self.use_lora else None
+                ) as span:
+                    answer, ttft_seconds, prompt_tokens, completion_tokens = await self._generate(
+                        prompt_value, route, include_timings
+                    )
+                    span.set_attributes({"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
             
-            return {
-                "answer": response["answer"],
-                "source_documents": [
-                    {
-                        "content": doc.page_content,
-                        "metadata": doc.metadata
-                    } for doc in response["context"]
-                ],
+            response = {
+                "answer": answer,
+                "source_documents": serialize_documents(docs),
                 "model_info": {
                     "base_model": self.base_model_name,
                     "lora_model": self.lora_model_path if self.use_lora else None,
                     "using_lora": self.use_lora
                 }
             }
+            if include_timings:
+                response["timings"] = build_timings(timings, ttft_seconds, prompt_tokens, completion_tokens)
+            return response
         except Exception as e:
             print(f"生成答案时出错: {e}")
             return {
@@ -394,6 +347,55 @@ class LoRARAGHandler:
                 }
             }
     
+    async def get_answers(self, queries: List[str], route: str = "ask_batch") -> List[Dict[str, Any]]:
+        """
+        批量问答：一次嵌入调用、一次FAISS矩阵检索、批量生成。
+        结果与输入顺序一致，单个问题失败时只在该项返回error。
+        """
+        results = [{"query": query} for query in queries]
+        valid = [i for i, query in enumerate(queries) if query and query.strip()]
+        for i in set(range(len(queries))) - set(valid):
+            results[i]["error"] = "问题不能为空"
+        if not valid:
+            return results
+        
+        backend = self.backend_name
+        try:
+            with track_stage(backend, "batch_embed"), start_span("ollama.embed", model=OLLAMA_EMBEDDING_MODEL, query_count=len(valid)):
+                vectors = await self.embeddings.aembed_documents([queries[i] for i in valid])
+            with track_stage(backend, "batch_search"), start_span("faiss.search", k=RETRIEVAL_K, query_count=len(valid)) as span:
+                # FAISS矩阵检索在线程中执行，与单条检索的异步路径一样不阻塞事件循环
+                docs_per_query = await asyncio.to_thread(batch_similarity_search, self.vector_store, vectors, RETRIEVAL_K)
+                span.set_attribute("chunk_count", sum(len(docs) for docs in docs_per_query))
+        except Exception as e:
+            print(f"批量检索时出错: {e}")
+            for i in valid:
+                results[i]["error"] = f"检索失败: {e}"
+            return results
+        
+        with track_stage(backend, "batch_prompt"):
+            prompts = [
+                self.prompt.invoke({"context": format_context(docs), "input": queries[i]})
+                for i, docs in zip(valid, docs_per_query)
+            ]
+        with track_stage(backend, "batch_generate"), start_span("llm.generate_batch", backend=backend, batch_size=len(prompts)):
+            outputs = await self.llm.abatch(
+                prompts,
+                config={"metadata": {"route": route}, "max_concurrency": BATCH_GENERATION_CONCURRENCY},
+                return_exceptions=True
+            )
+        
+        for i, docs, output in zip(valid, docs_per_query, outputs):
+            if isinstance(output, Exception):
+                results[i]["error"] = f"生成失败: {output}"
+                continue
+            if not self.use_lora:
+                observe_ollama_response(output)
+            results[i]["answer"] = output.content if hasattr(output, "content") else output
+            results[i]["source_documents"] = serialize_documents(docs)
+        
+        return results
+    
     def switch_model(self, use_lora: bool):
         """切换模型模式（LoRA或原始模型）"""
         if use_lora != self.use_lora:
@@ -1,7 +1,17 @@
+import os
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from app.rag_handler import rag_handler_instance
+from typing import List, Optional
+from app.rag_handler import RAGHandler
+from app.readiness import ReadinessState
+from app.admission import AdmissionController, AdmissionRejected, client_key_from_request, rejection_response
+from app.metrics import runtime_collector, metrics_response
+from app.tracing import tracer, InMemoryExporter, trace_http_request
+from app.profiler import MAX_PROFILE_SECONDS, verify_admin_token, run_profile
+from app.ollama_client import CircuitOpenError, get_ollama_client
+from app.prefork import take_preloaded_handler
 
 # 创建FastAPI应用
 app = FastAPI(
@@ -10,21 +20,176 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# RAG处理器在启动事件中创建，预热完成前 /ready 返回503
+rag_handler_instance = None
+readiness = ReadinessState()
+
+# 并发上限、有界等待队列和按客户端限流
+admission = AdmissionController()
+
+# 单次批量请求允许的最大问题数
+MAX_BATCH_QUERIES = int(os.getenv("MAX_BATCH_QUERIES", "64"))
+
 # 定义请求体模型
 class QueryRequest(BaseModel):
     query: str
+    include_timings: Optional[bool] = False
+
+class BatchQueryRequest(BaseModel):
+    queries: List[str]
+
+def timings_requested(request: QueryRequest, http_request: Request) -> bool:
+    """通过请求体的include_timings或X-Include-Timings请求头开启耗时明细"""
+    header = http_request.headers.get("x-include-timings", "").lower()
+    return bool(request.include_timings) or header in ("1", "true", "yes")
+
+# 为每个请求创建根span，处理器中的检索、嵌入、FAISS搜索和生成span挂在其下
+app.middleware("http")(trace_http_request)
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """准入拒绝时快速返回429/503和Retry-After"""
+    return rejection_response(exc)
+
+@app.exception_handler(CircuitOpenError)
+async def ollama_circuit_open_handler(request: Request, exc: CircuitOpenError):
+    """Ollama熔断期间快速返回503，避免请求在故障的模型服务上堆积"""
+    return rejection_response(AdmissionRejected(503, str(exc), exc.retry_after))
+
+def build_rag_handler():
+    """创建RAG处理器（pre-fork模式下由主进程在fork前调用）"""
+    return RAGHandler()
+
+@app.on_event("startup")
+async def startup_event():
+    """应用启动时初始化RAG处理器，并在后台预热"""
+    global rag_handler_instance
+    runtime_collector.bind(admission, lambda: rag_handler_instance)
+    # pre-fork模式下主进程已在fork前加载好向量库，worker直接复用
+    rag_handler_instance = take_preloaded_handler()
+    if rag_handler_instance is None:
+        try:
+            rag_handler_instance = build_rag_handler()
+        except Exception as e:
+            print(f"❌ RAG系统初始化失败: {e}")
+            readiness.mark_not_ready("init_failed", str(e))
+            return
+    
+    readiness.start_warmup(rag_handler_instance)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """关闭共享的Ollama连接池"""
+    await get_ollama_client().aclose()
 
 # 定义API端点
 @app.post("/ask",
           summary="向RAG系统提问",
           response_description="包含答案和来源文档的响应")
-async def ask_question(request: QueryRequest):
+async def ask_question(request: QueryRequest, http_request: Request):
     """
     接收用户的问题，并返回由RAG系统生成的答案。
     """
-    response = await rag_handler_instance.get_answer(request.query)
+    if rag_handler_instance is None:
+        raise HTTPException(status_code=500, detail="RAG系统未正确初始化")
+    
+    async with admission.admit(client_key_from_request(http_request)):
+        response = await rag_handler_instance.get_answer(
+            request.query, include_timings=timings_requested(request, http_request)
+        )
     return response
 
+@app.post("/ask_batch",
+          summary="批量向RAG系统提问",
+          response_description="与输入顺序一致的答案列表")
+async def ask_batch(request: BatchQueryRequest, http_request: Request):
+    """
+    一次提交多个问题，共享一次嵌入调用和一次向量检索。
+    单个问题失败时只在对应结果中返回error，不影响其他问题。
+    """
+    if rag_handler_instance is None:
+        raise HTTPException(status_code=500, detail="RAG系统未正确初始化")
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="queries不能为空")
+    if len(request.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"单次最多提交 {MAX_BATCH_QUERIES} 个问题")
+    
+    # 批量请求按问题数消耗限流令牌，但只占用一个处理名额
+    async with admission.admit(client_key_from_request(http_request), cost=len(request.queries)):
+        results = await rag_handler_instance.get_answers(request.queries)
+    return {"results": results}
+
+@app.get("/metrics",
+         summary="Prometheus监控指标",
+         response_description="Prometheus文本格式的指标")
+async def metrics():
+    """
+    导出各流水线阶段耗时直方图、token吞吐、准入队列、模型内存和向量索引规模。
+    """
+    return metrics_response()
+
+@app.get("/traces",
+         summary="最近的请求链路",
+         response_description="按请求分组的span列表")
+async def get_traces(limit: int = 20,
+                     min_duration_ms: float = 0,
+                     trace_id: Optional[str] = None,
+                     x_admin_token: Optional[str] = Header(None)):
+    """
+    返回进程内收集的最近请求链路（TRACE_EXPORTER=memory时可用），
+    可按最小耗时筛选慢请求，或按X-Trace-Id响应头查询单条链路。
+    需要在X-Admin-Token请求头中提供ADMIN_TOKEN。
+    """
+    if not verify_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="需要有效的管理令牌（X-Admin-Token）")
+    if not isinstance(tracer.exporter, InMemoryExporter):
+        raise HTTPException(status_code=404, detail="未启用进程内追踪收集（TRACE_EXPORTER=memory）")
+    if trace_id:
+        return {"spans": tracer.exporter.spans(trace_id)}
+    return {"traces": tracer.exporter.traces(limit, min_duration_ms)}
+
+@app.post("/admin/profile",
+          summary="在线采样分析",
+          response_description="折叠栈格式的采样结果")
+async def admin_profile(seconds: float = 10,
+                        interval_ms: float = 5,
+                        thread: Optional[str] = None,
+                        format: str = "collapsed",
+                        x_admin_token: Optional[str] = Header(None)):
+    """
+    对当前进程的所有Python线程做栈采样，返回可交给flamegraph.pl或speedscope的折叠栈。
+    format=json时同时返回GIL唤醒延迟、事件循环延迟、各线程CPU时间和torch线程配置。
+    thread参数按线程名过滤，例如 MainThread（事件循环）或 lora-inference（推理线程）。
+    需要在X-Admin-Token请求头中提供ADMIN_TOKEN。
+    """
+    if not verify_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="需要有效的管理令牌（X-Admin-Token）")
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds需在0到{MAX_PROFILE_SECONDS}之间")
+    if interval_ms < 1:
+        raise HTTPException(status_code=400, detail="interval_ms不能小于1")
+    
+    try:
+        collapsed, stats = await run_profile(seconds, interval_ms / 1000, thread)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    if format == "json":
+        return {"stats": stats, "collapsed": collapsed}
+    return PlainTextResponse(collapsed, headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'})
+
+@app.get("/ready",
+         summary="就绪检查",
+         response_description="预热完成前返回503")
+async def ready_check():
+    """
+    供负载均衡器使用的就绪探针，预热完成后才返回200。
+    """
+    content = readiness.to_dict()
+    content["admission"] = admission.stats()
+    content["ollama"] = get_ollama_client().stats()
+    return JSONResponse(status_code=200 if readiness.is_ready else 503, content=content)
+
 # 启动服务器
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,214 @@
+"""
+Prometheus监控指标
+
+按流水线阶段（嵌入、检索、提示构建、生成、预填充、解码）记录耗时直方图，
+并在抓取时采集准入队列、模型内存和向量索引规模，通过 /metrics 端点导出。
+"""
+
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# 覆盖毫秒级的嵌入/检索到数十秒的CPU生成
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+STAGE_LATENCY = Histogram(
+    "rag_stage_duration_seconds",
+    "RAG流水线各阶段耗时",
+    ["backend", "stage"],
+    buckets=STAGE_BUCKETS
+)
+
+GENERATED_TOKENS = Counter(
+    "rag_generated_tokens_total",
+    "生成的token总数",
+    ["backend"]
+)
+
+PROMPT_TOKENS = Counter(
+    "rag_prompt_tokens_total",
+    "输入模型的提示token总数",
+    ["backend"]
+)
+
+DECODE_TOKENS_PER_SECOND = Histogram(
+    "rag_decode_tokens_per_second",
+    "解码阶段每秒生成的token数",
+    ["backend"],
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+)
+
+ADMISSION_WAIT = Histogram(
+    "rag_admission_wait_seconds",
+    "请求在准入队列中的等待时间",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+@contextmanager
+def track_stage(backend: str, stage: str, timings: Optional[Dict[str, float]] = None):
+    """记录一个阶段的耗时；传入timings时同时写入该字典（秒）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(backend, stage).observe(elapsed)
+        if timings is not None:
+            timings[stage] = elapsed
+
+def observe_generation(backend: str, prefill_seconds: float, decode_seconds: float,
+                       new_tokens: int, prompt_tokens: Optional[int] = None):
+    """记录一次生成的预填充/解码耗时和token吞吐"""
+    STAGE_LATENCY.labels(backend, "prefill").observe(prefill_seconds)
+    STAGE_LATENCY.labels(backend, "decode").observe(decode_seconds)
+    GENERATED_TOKENS.labels(backend).inc(new_tokens)
+    if prompt_tokens:
+        PROMPT_TOKENS.labels(backend).inc(prompt_tokens)
+    # 首个token计入预填充，其余token计入解码
+    if decode_seconds > 0 and new_tokens > 1:
+        DECODE_TOKENS_PER_SECOND.labels(backend).observe((new_tokens - 1) / decode_seconds)
+
+def observe_ollama_response(message):
+    """从Ollama响应元数据（纳秒）中提取预填充/解码耗时和token数"""
+    metadata = getattr(message, "response_metadata", None) or {}
+    if "eval_count" not in metadata:
+        return
+    observe_generation(
+        "ollama",
+        prefill_seconds=metadata.get("prompt_eval_duration", 0) / 1e9,
+        decode_seconds=metadata.get("eval_duration", 0) / 1e9,
+        new_tokens=metadata.get("eval_count", 0),
+        prompt_tokens=metadata.get("prompt_eval_count")
+    )
+
+# /ask 响应中timings字段的阶段名
+TIMING_FIELDS = {
+    "embed": "embedding_ms",
+    "search": "retrieval_ms",
+    "prompt": "prompt_ms",
+    "generate": "generation_ms",
+    "total": "total_ms"
+}
+
+def build_timings(timings: Dict[str, float], ttft_seconds: Optional[float] = None,
+                  prompt_tokens: Optional[int] = None, completion_tokens: Optional[int] = None) -> Dict[str, Optional[float]]:
+    """把track_stage收集的各阶段耗时（秒）整理为响应中的timings对象（毫秒）"""
+    result = {
+        field: round(timings[stage] * 1000, 2)
+        for stage, field in TIMING_FIELDS.items() if stage in timings
+    }
+    # 当前流水线没有重排序阶段
+    result["rerank_ms"] = None
+    result["ttft_ms"] = round(ttft_seconds * 1000, 2) if ttft_seconds is not None else None
+    result["prompt_tokens"] = prompt_tokens
+    result["completion_tokens"] = completion_tokens
+    return result
+
+async def astream_with_ttft(llm, model_input, config=None):
+    """以流式方式调用聊天模型，返回 (合并后的消息, 首个token耗时秒数)"""
+    start = time.perf_counter()
+    ttft_seconds = None
+    message = None
+    async for chunk in llm.astream(model_input, config=config):
+        if ttft_seconds is None and chunk.content:
+            ttft_seconds = time.perf_counter() - start
+        message = chunk if message is None else message + chunk
+    return message, ttft_seconds
+
+def message_token_counts(message):
+    """读取聊天模型响应的 (提示token数, 生成token数)"""
+    usage = getattr(message, "usage_metadata", None) or {}
+    if usage:
+        return usage.get("input_tokens"), usage.get("output_tokens")
+    metadata = getattr(message, "response_metadata", None) or {}
+    return metadata.get("prompt_eval_count"), metadata.get("eval_count")
+
+def _process_memory_bytes() -> Dict[str, float]:
+    """当前进程及其子进程（推理进程池副本）的常驻内存，以及GPU已分配显存"""
+    memory = {}
+    try:
+        import psutil
+        process = psutil.Process()
+        memory["process_rss"] = process.memory_info().rss
+        memory["children_rss"] = sum(child.memory_info().rss for child in process.children(recursive=True))
+    except Exception:
+        pass
+
+    # 只在torch已被加载时读取显存，避免为采集指标而导入torch
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        memory["cuda_allocated"] = torch.cuda.memory_allocated()
+    return memory
+
+class RuntimeCollector:
+    """抓取时读取准入队列、模型内存和向量索引状态"""
+
+    def __init__(self):
+        self.admission = None
+        self.handler_getter: Callable = lambda: None
+
+    def bind(self, admission=None, handler_getter: Optional[Callable] = None):
+        """绑定当前应用的准入控制器和RAG处理器"""
+        self.admission = admission
+        self.handler_getter = handler_getter or (lambda: None)
+
+    def collect(self):
+        if self.admission is not None:
+            stats = self.admission.stats()
+            queue = GaugeMetricFamily("rag_admission_queue_depth", "准入队列中等待的请求数")
+            queue.add_metric([], stats["queue_depth"])
+            yield queue
+            in_flight = GaugeMetricFamily("rag_admission_in_flight", "正在处理的请求数")
+            in_flight.add_metric([], stats["in_flight"])
+            yield in_flight
+            rejected = CounterMetricFamily("rag_admission_rejected", "被拒绝的请求累计数", labels=["reason"])
+            rejected.add_metric(["queue_full"], stats["rejected_queue_full"])
+            rejected.add_metric(["timeout"], stats["rejected_timeout"])
+            rejected.add_metric(["rate_limited"], stats["rejected_rate_limited"])
+            yield rejected
+
+        memory = GaugeMetricFamily("rag_model_memory_bytes", "服务进程和推理副本的内存占用", labels=["kind"])
+        for kind, value in _process_memory_bytes().items():
+            memory.add_metric([kind], value)
+        yield memory
+
+        handler = self.handler_getter()
+        vector_store = getattr(handler, "vector_store", None)
+        index = getattr(vector_store, "index", None)
+        if isinstance(getattr(index, "ntotal", None), int):
+            vectors = GaugeMetricFamily("rag_index_vectors", "向量索引中的向量数")
+            vectors.add_metric([], index.ntotal)
+            yield vectors
+            dimension = GaugeMetricFamily("rag_index_dimension", "向量维度")
+            dimension.add_metric([], index.d)
+            yield dimension
+
+        index_path = getattr(handler, "vector_store_path", None)
+        if isinstance(index_path, str) and os.path.isdir(index_path):
+            size = GaugeMetricFamily("rag_index_size_bytes", "向量存储目录的磁盘占用")
+            size.add_metric([], sum(
+                os.path.getsize(os.path.join(index_path, name)) for name in os.listdir(index_path)
+            ))
+            yield size
+
+runtime_collector = RuntimeCollector()
+REGISTRY.register(runtime_collector)
+
+def metrics_response():
+    """生成 /metrics 端点的响应"""
+    from fastapi import Response
+
+    registry = REGISTRY
+    # 设置PROMETHEUS_MULTIPROC_DIR后，推理进程池副本中记录的生成指标写入共享目录，在这里汇总
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import CollectorRegistry, multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(runtime_collector)
+
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,414 @@
+"""
+共享的Ollama客户端
+
+RAGHandler、LoRARAGHandler、增量更新和评估脚本原先各自创建 OllamaEmbeddings/ChatOllama，
+每个模型实例持有独立的HTTP连接。这里提供进程内共享的 ollama.Client/AsyncClient：
+- 底层连接池保持长连接（keep-alive），请求不再重复建立TCP连接；
+- 限制同时发往Ollama的请求数，超出时在客户端排队（流式响应读完才释放名额）；
+- 连接失败和502/503/504响应按指数退避自动重试；
+- 连续失败达到阈值后熔断，冷却期内直接失败，冷却结束后放行一个探测请求。
+
+LangChain模型通过 bind() 使用共享客户端；测试或压测时可通过 transport_factory
+注入替身传输层（如 httpx.ASGITransport(app=fake_ollama_app)）。
+
+通过环境变量配置（首次调用 get_ollama_client() 时读取）：
+    OLLAMA_BASE_URL=http://localhost:11434
+    OLLAMA_MAX_CONNECTIONS=16        连接池大小
+    OLLAMA_MAX_CONCURRENCY=8         同时发往Ollama的请求数
+    OLLAMA_TIMEOUT=120               读取超时（秒），OLLAMA_CONNECT_TIMEOUT=5 连接超时
+    OLLAMA_MAX_RETRIES=2
+    OLLAMA_BREAKER_THRESHOLD=5       连续失败多少次后熔断（0表示关闭熔断）
+    OLLAMA_BREAKER_RESET_SECONDS=30  熔断冷却时间
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+
+# 可以安全重试的错误：请求尚未被Ollama处理
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+RETRYABLE_STATUS = {502, 503, 504}
+
+class CircuitOpenError(httpx.TransportError):
+    """熔断期间拒绝发往Ollama的请求"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Ollama服务连续失败，已熔断，{retry_after:.0f}秒后重试")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """连续失败计数熔断器，同步和异步请求共用"""
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.open_count = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def before_request(self) -> bool:
+        """熔断中抛出CircuitOpenError；冷却结束后只放行一个探测请求，放行的是探测请求时返回True"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.reset_seconds - (time.monotonic() - self.opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(remaining)
+            if self._probe_in_flight:
+                raise CircuitOpenError(1)
+            self._probe_in_flight = True
+            return True
+
+    def abandon_probe(self):
+        """探测请求被取消或因非传输错误中止时释放探测名额，下一个请求重新探测"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.failures += 1
+            half_open_probe = self._probe_in_flight
+            self._probe_in_flight = False
+            if half_open_probe or (self.opened_at is None and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self.open_count += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "open_count": self.open_count
+        }
+
+def _backoff_delay(attempt: int, base: float) -> float:
+    """第attempt次重试前的等待时间：指数退避加随机抖动"""
+    return base * (2 ** (attempt - 1)) * (0.5 + random.random())
+
+class _ReleasingAsyncStream(httpx.AsyncByteStream):
+    """响应体读完或关闭时释放并发名额"""
+
+    def __init__(self, stream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """同步版本的 _ReleasingAsyncStream"""
+
+    def __init__(self, stream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+
+class ResilientAsyncTransport(httpx.AsyncBaseTransport):
+    """在底层传输层之上增加并发限制、重试和熔断"""
+
+    def __init__(self, breaker: CircuitBreaker, max_concurrency: int = 8, max_retries: int = 2,
+                 transport_factory: Optional[Callable[[], httpx.AsyncBaseTransport]] = None,
+                 backoff_seconds: float = 0.2):
+        self.breaker = breaker
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._factory = transport_factory or httpx.AsyncHTTPTransport
+        self._loop = None
+        self._inner: Optional[httpx.AsyncBaseTransport] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.retries = 0
+
+    def _bind_loop(self):
+        # 连接池和信号量都绑定在事件循环上；脚本多次asyncio.run时为新循环重新创建
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._inner = self._factory()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._inner, self._semaphore
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        inner, semaphore = self._bind_loop()
+        await semaphore.acquire()
+        self.in_flight += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.in_flight -= 1
+                semaphore.release()
+
+        try:
+            response = await self._send(inner, request)
+        except BaseException:
+            release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingAsyncStream(response.stream, release),
+            extensions=response.extensions
+        )
+
+    async def _send(self, inner: httpx.AsyncBaseTransport, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            probe = self.breaker.before_request()
+            try:
+                response = await inner.handle_async_request(request)
+            except RETRYABLE_ERRORS:
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+            except httpx.TransportError:
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # 取消（如ping超时）或其他异常不计为失败，但必须释放探测名额，否则熔断器一直停在半开
+                if probe:
+                    self.breaker.abandon_probe()
+                raise
+            else:
+                if response.status_code not in RETRYABLE_STATUS:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    return response
+                await response.aclose()
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(_backoff_delay(attempt, self.backoff_seconds))
+
+    async def aclose(self):
+        if self._inner is not None and self._loop is asyncio.get_running_loop():
+            await self._inner.aclose()
+        self._inner = None
+        self._loop = None
+
+class ResilientTransport(httpx.BaseTransport):
+    """同步版本的 ResilientAsyncTransport，供ingest和增量更新等同步脚本使用"""
+
+    def __init__(self, breaker: CircuitBreaker, max_concurrency: int = 8, max_retries: int = 2,
+                 transport_factory: Optional[Callable[[], httpx.BaseTransport]] = None,
+                 backoff_seconds: float = 0.2):
+        self.breaker = breaker
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._factory = transport_factory or httpx.HTTPTransport
+        self._inner: Optional[httpx.BaseTransport] = None
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.retries = 0
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self._semaphore.acquire()
+        with self._lock:
+            self.in_flight += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                with self._lock:
+                    self.in_flight -= 1
+                self._semaphore.release()
+
+        try:
+            response = self._send(request)
+        except BaseException:
+            release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, release),
+            extensions=response.extensions
+        )
+
+    def _get_inner(self) -> httpx.BaseTransport:
+        with self._lock:
+            if self._inner is None:
+                self._inner = self._factory()
+            return self._inner
+
+    def _send(self, request: httpx.Request) -> httpx.Response:
+        inner = self._get_inner()
+        attempt = 0
+        while True:
+            probe = self.breaker.before_request()
+            try:
+                response = inner.handle_request(request)
+            except RETRYABLE_ERRORS:
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+            except httpx.TransportError:
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # 取消（如ping超时）或其他异常不计为失败，但必须释放探测名额，否则熔断器一直停在半开
+                if probe:
+                    self.breaker.abandon_probe()
+                raise
+            else:
+                if response.status_code not in RETRYABLE_STATUS:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    return response
+                response.close()
+            attempt += 1
+            with self._lock:
+                self.retries += 1
+            time.sleep(_backoff_delay(attempt, self.backoff_seconds))
+
+    def close(self):
+        with self._lock:
+            inner, self._inner = self._inner, None
+        if inner is not None:
+            inner.close()
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+class OllamaClient:
+    """进程内共享的Ollama同步/异步客户端"""
+
+    def __init__(self, base_url: Optional[str] = None, max_connections: Optional[int] = None,
+                 max_concurrency: Optional[int] = None, timeout: Optional[float] = None,
+                 connect_timeout: Optional[float] = None, max_retries: Optional[int] = None,
+                 breaker_threshold: Optional[int] = None, breaker_reset_seconds: Optional[float] = None,
+                 transport_factory: Optional[Callable[[], httpx.AsyncBaseTransport]] = None,
+                 sync_transport_factory: Optional[Callable[[], httpx.BaseTransport]] = None):
+        import ollama
+
+        self.base_url = base_url or os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+        max_connections = max_connections or _env_int("OLLAMA_MAX_CONNECTIONS", 16)
+        self.max_concurrency = max_concurrency or _env_int("OLLAMA_MAX_CONCURRENCY", 8)
+        max_retries = max_retries if max_retries is not None else _env_int("OLLAMA_MAX_RETRIES", 2)
+        timeout = httpx.Timeout(
+            timeout or _env_float("OLLAMA_TIMEOUT", 120.0),
+            connect=connect_timeout or _env_float("OLLAMA_CONNECT_TIMEOUT", 5.0)
+        )
+
+        self.breaker = CircuitBreaker(
+            breaker_threshold if breaker_threshold is not None else _env_int("OLLAMA_BREAKER_THRESHOLD", 5),
+            breaker_reset_seconds or _env_float("OLLAMA_BREAKER_RESET_SECONDS", 30.0)
+        )
+
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=60
+        )
+        self.async_transport = ResilientAsyncTransport(
+            self.breaker, self.max_concurrency, max_retries,
+            transport_factory or (lambda: httpx.AsyncHTTPTransport(limits=limits))
+        )
+        self.sync_transport = ResilientTransport(
+            self.breaker, self.max_concurrency, max_retries,
+            sync_transport_factory or (lambda: httpx.HTTPTransport(limits=limits))
+        )
+        self.async_client = ollama.AsyncClient(host=self.base_url, timeout=timeout, transport=self.async_transport)
+        self.client = ollama.Client(host=self.base_url, timeout=timeout, transport=self.sync_transport)
+
+    def bind(self, model):
+        """让LangChain的OllamaEmbeddings/ChatOllama使用共享客户端，返回model本身"""
+        if hasattr(model, "_async_client"):
+            model._client = self.client
+            model._async_client = self.async_client
+        return model
+
+    async def ping(self, timeout: float = 5.0) -> bool:
+        """检查Ollama服务是否可用（熔断中直接返回False）"""
+        try:
+            await asyncio.wait_for(self.async_client.list(), timeout)
+            return True
+        except Exception:
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.async_transport.in_flight + self.sync_transport.in_flight,
+            "retries": self.async_transport.retries + self.sync_transport.retries,
+            "circuit": self.breaker.stats()
+        }
+
+    async def aclose(self):
+        await self.async_transport.aclose()
+        self.sync_transport.close()
+
+_shared_client: Optional[OllamaClient] = None
+_shared_lock = threading.Lock()
+
+def get_ollama_client() -> OllamaClient:
+    """返回进程内共享的Ollama客户端，首次调用时按环境变量创建"""
+    global _shared_client
+    if _shared_client is None:
+        with _shared_lock:
+            if _shared_client is None:
+                _shared_client = OllamaClient()
+    return _shared_client
+
+def set_ollama_client(client: Optional[OllamaClient]) -> Optional[OllamaClient]:
+    """替换共享客户端（例如注入替身服务），返回原客户端"""
+    global _shared_client
+    with _shared_lock:
+        previous, _shared_client = _shared_client, client
+    return previous
@@ -0,0 +1,184 @@
+"""
+预派生（pre-fork）多进程服务
+
+uvicorn --workers 以spawn方式启动worker，每个worker各自加载FAISS索引、文档库和
+LoRA模型权重，内存随worker数线性增长。pre-fork模式下主进程先调用应用的
+build_rag_handler() 完成加载，再 gc.freeze() 并 fork 出多个worker：
+- 索引向量和模型权重位于faiss/torch分配的内存中，只读使用，各worker按写时复制共享；
+- gc.freeze() 把加载阶段创建的Python对象移出GC跟踪，避免垃圾回收遍历时写入对象头而复制页面；
+- 所有worker在fork前创建的同一个监听套接字上accept，由内核分发连接；
+- worker意外退出时主进程重新fork，新worker同样共享主进程中已加载的数据。
+
+注意：
+- 每个worker有独立的准入控制、追踪缓冲区和Prometheus指标，多进程指标需设置 PROMETHEUS_MULTIPROC_DIR；
+- LoRA推理进程池（INFERENCE_WORKERS>1）与pre-fork互斥，此模式下固定为1；
+- 在某个worker中调用 /switch_model 会在该worker内重新加载模型，不再与其他worker共享；
+- os.fork 仅在Linux/macOS可用。
+
+使用方法:
+    python -m app.prefork --app main --workers 4 --port 8000
+    python -m app.prefork --app lora_main --workers 2 --port 8001 --threads-per-worker 4
+"""
+
+import os
+import gc
+import sys
+import time
+import random
+import signal
+import socket
+import argparse
+import importlib
+import traceback
+from typing import Dict, Optional
+
+APPS = {
+    "main": "app.main",
+    "lora_main": "app.lora_main"
+}
+
+# 主进程在fork前加载的RAG处理器，worker的启动事件通过 take_preloaded_handler() 取用
+_preloaded_handler = None
+
+def take_preloaded_handler():
+    """返回主进程在fork前加载的RAG处理器；非pre-fork模式下返回None"""
+    return _preloaded_handler
+
+def create_listen_socket(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    """创建供所有worker共享的监听套接字"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+def _rss_mb() -> float:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except Exception:
+        return 0.0
+
+class PreforkServer:
+    """加载一次、fork多个worker并在worker退出时补齐"""
+
+    def __init__(self, app_name: str, host: str = "127.0.0.1", port: int = 8000, workers: int = 2,
+                 threads_per_worker: Optional[int] = None, log_level: str = "info"):
+        self.app_name = app_name
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.log_level = log_level
+        self.module = None
+        self.handler = None
+        self.sock: Optional[socket.socket] = None
+        self.workers: Dict[int, int] = {}
+        self.stopping = False
+
+    def preload(self):
+        """在主进程中导入应用并加载向量库和模型"""
+        # 必须在导入torch之前设置，限制每个worker的OpenMP线程数
+        os.environ.setdefault("OMP_NUM_THREADS", str(self.threads_per_worker))
+        if int(os.getenv("INFERENCE_WORKERS", "1")) > 1:
+            print("⚠️ pre-fork模式不支持推理进程池，INFERENCE_WORKERS固定为1")
+        os.environ["INFERENCE_WORKERS"] = "1"
+
+        self.module = importlib.import_module(APPS[self.app_name])
+        started = time.time()
+        self.handler = self.module.build_rag_handler()
+
+        # 加载阶段的对象移入永久代，之后的GC不再遍历（也就不再写入）这些对象
+        gc.collect()
+        gc.freeze()
+        print(f"✅ 主进程已加载RAG处理器 ({time.time() - started:.1f}s, RSS {_rss_mb():.0f}MB)")
+
+    def _run_worker(self, index: int):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        random.seed()
+        # 以 python -m app.prefork 运行时本文件是__main__，应用导入的是app.prefork，需设置在后者上
+        importlib.import_module("app.prefork")._preloaded_handler = self.handler
+        if self.handler is not None and hasattr(self.handler, "after_fork"):
+            self.handler.after_fork(self.threads_per_worker)
+
+        import uvicorn
+        print(f"🚀 worker {index} (pid {os.getpid()}) 启动")
+        server = uvicorn.Server(uvicorn.Config(self.module.app, log_level=self.log_level))
+        server.run(sockets=[self.sock])
+
+    def spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker(index)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = index
+
+    def stop(self, signum=None, frame=None):
+        """通知所有worker优雅退出"""
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> int:
+        if not hasattr(os, "fork"):
+            print("❌ 当前平台不支持os.fork，请改用 uvicorn --workers")
+            return 1
+
+        try:
+            self.preload()
+        except Exception as e:
+            print(f"❌ 主进程加载RAG处理器失败: {e}")
+            return 1
+
+        self.sock = create_listen_socket(self.host, self.port)
+        print(f"🚀 pre-fork服务: http://{self.host}:{self.port}, {self.num_workers} 个worker, "
+              f"每个worker {self.threads_per_worker} 个计算线程")
+        # 先安装信号处理再fork，避免启动期间收到SIGTERM时worker成为孤儿进程
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.num_workers):
+            self.spawn(index)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.workers.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            print(f"⚠️ worker {index} (pid {pid}) 意外退出（状态 {status}），重新创建")
+            time.sleep(1)
+            self.spawn(index)
+
+        self.sock.close()
+        return 0
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='pre-fork多进程服务')
+    parser.add_argument('--app', choices=list(APPS), default='main', help='要启动的应用')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=8000, help='监听端口')
+    parser.add_argument('--workers', type=int, default=2, help='worker进程数')
+    parser.add_argument('--threads-per-worker', type=int, help='每个worker的torch/OpenMP线程数（默认按核心数平分）')
+    parser.add_argument('--log-level', default='info', help='uvicorn日志级别')
+
+    args = parser.parse_args()
+
+    server = PreforkServer(args.app, args.host, args.port, args.workers, args.threads_per_worker, args.log_level)
+    return server.run()
+
+if __name__ == "__main__":
+    sys.exit(main())
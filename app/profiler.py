@@ -0,0 +1,179 @@
+"""
+在线采样分析
+
+在后台线程中按固定间隔读取 sys._current_frames()，把各线程的调用栈累计为
+火焰图工具（flamegraph.pl、speedscope）可直接读取的折叠栈格式，无需重启服务
+即可查看事件循环线程和LoRA推理线程在高延迟时刻的热点。
+
+同时统计分析窗口内的：
+- 采样线程的唤醒延迟：睡眠超时后重新获得GIL的等待时间，反映GIL争用；
+- 各原生线程的CPU时间（含torch/OpenMP计算线程），以及torch线程配置。
+"""
+
+import os
+import sys
+import time
+import secrets
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from app.stats import percentile
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+MAX_PROFILE_SECONDS = 60
+
+_profile_lock = threading.Lock()
+
+def verify_admin_token(token: Optional[str]) -> bool:
+    """校验管理接口令牌；未配置ADMIN_TOKEN时管理接口保持关闭"""
+    if not ADMIN_TOKEN or not token:
+        return False
+    return secrets.compare_digest(token, ADMIN_TOKEN)
+
+def _frame_label(frame) -> str:
+    # 用函数定义所在行而不是当前执行行标识帧，同一函数的样本在火焰图中合并为一个条
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _collapse(frame) -> List[str]:
+    """从栈顶帧回溯，返回自底向上的帧标签列表"""
+    stack = []
+    while frame is not None:
+        stack.append(_frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def _thread_cpu_times() -> Dict[int, float]:
+    """各原生线程的累计CPU时间（秒），键为系统线程ID"""
+    try:
+        import psutil
+        return {thread.id: thread.user_time + thread.system_time for thread in psutil.Process().threads()}
+    except Exception:
+        return {}
+
+def _torch_thread_info() -> Optional[Dict[str, Any]]:
+    """torch线程配置；torch未加载时返回None，不为此导入torch"""
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return None
+    return {
+        "num_threads": torch.get_num_threads(),
+        "num_interop_threads": torch.get_num_interop_threads(),
+        "omp_num_threads": os.getenv("OMP_NUM_THREADS")
+    }
+
+class SamplingProfiler:
+    """对当前进程所有Python线程做定时栈采样"""
+
+    def __init__(self, interval: float = 0.005, thread_filter: Optional[str] = None):
+        self.interval = interval
+        self.thread_filter = thread_filter
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.wakeup_delays: List[float] = []
+
+    def _thread_names(self) -> Dict[int, str]:
+        return {thread.ident: thread.name for thread in threading.enumerate()}
+
+    def run(self, duration: float) -> Dict[str, Any]:
+        """采样duration秒，返回折叠栈和统计信息"""
+        own_ident = threading.get_ident()
+        native_names = {thread.native_id: thread.name for thread in threading.enumerate()}
+        cpu_before = _thread_cpu_times()
+        started = time.perf_counter()
+        deadline = started + duration
+
+        while time.perf_counter() < deadline:
+            names = self._thread_names()
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                name = names.get(ident, f"thread-{ident}")
+                if self.thread_filter and self.thread_filter not in name:
+                    continue
+                self.stacks[";".join([name] + _collapse(frame))] += 1
+            self.samples += 1
+
+            # 睡眠超出预期的部分主要是等待重新获得GIL的时间
+            before_sleep = time.perf_counter()
+            time.sleep(self.interval)
+            self.wakeup_delays.append(max(0.0, time.perf_counter() - before_sleep - self.interval))
+
+        elapsed = time.perf_counter() - started
+        cpu_after = _thread_cpu_times()
+        native_names.update({thread.native_id: thread.name for thread in threading.enumerate()})
+
+        thread_cpu = []
+        for native_id, total in cpu_after.items():
+            used = total - cpu_before.get(native_id, 0.0)
+            if used <= 0:
+                continue
+            thread_cpu.append({
+                "native_id": native_id,
+                # 没有Python线程对应的原生线程通常是torch/OpenMP计算线程
+                "name": native_names.get(native_id, "native"),
+                "cpu_seconds": round(used, 4),
+                "utilization": round(used / elapsed, 3)
+            })
+        thread_cpu.sort(key=lambda item: item["cpu_seconds"], reverse=True)
+
+        return {
+            "duration_seconds": round(elapsed, 3),
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000,
+            "gil": {
+                "wakeup_delay_mean_ms": round(1000 * sum(self.wakeup_delays) / max(len(self.wakeup_delays), 1), 3),
+                "wakeup_delay_p99_ms": round(1000 * percentile(self.wakeup_delays, 0.99), 3),
+                "wakeup_delay_max_ms": round(1000 * max(self.wakeup_delays, default=0.0), 3)
+            },
+            "threads": thread_cpu,
+            "torch": _torch_thread_info()
+        }
+
+    def collapsed(self) -> str:
+        """折叠栈文本：每行 "帧;帧;帧 次数" """
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+def profile(duration: float, interval: float = 0.005, thread_filter: Optional[str] = None):
+    """
+    执行一次采样分析，返回 (折叠栈文本, 统计信息)。
+    同一时间只允许一次分析，正在分析时抛出RuntimeError。
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("已有分析任务正在运行")
+    try:
+        profiler = SamplingProfiler(interval, thread_filter)
+        stats = profiler.run(min(duration, MAX_PROFILE_SECONDS))
+        return profiler.collapsed(), stats
+    finally:
+        _profile_lock.release()
+
+async def measure_event_loop_lag(duration: float, interval: float = 0.01) -> Dict[str, float]:
+    """在分析期间测量事件循环调度延迟：回调实际执行时间与预期时间之差"""
+    import asyncio
+    lags = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - expected))
+    return {
+        "mean_ms": round(1000 * sum(lags) / max(len(lags), 1), 3),
+        "p99_ms": round(1000 * percentile(lags, 0.99), 3),
+        "max_ms": round(1000 * max(lags, default=0.0), 3)
+    }
+
+async def run_profile(duration: float, interval: float = 0.005, thread_filter: Optional[str] = None):
+    """在后台线程中采样，同时在事件循环上测量调度延迟"""
+    import asyncio
+    lag_task = asyncio.ensure_future(measure_event_loop_lag(min(duration, MAX_PROFILE_SECONDS)))
+    try:
+        collapsed, stats = await asyncio.to_thread(profile, duration, interval, thread_filter)
+    except BaseException:
+        # 已有分析任务在运行（409）或请求被取消时，停止测量事件循环延迟
+        lag_task.cancel()
+        raise
+    stats["event_loop_lag"] = await lag_task
+    return collapsed, stats
@@ -1,31 +1,41 @@
 import os
+import time
+import asyncio
 from dotenv import load_dotenv
 from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
 from langchain_ollama import ChatOllama
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains import create_retrieval_chain
 from langchain_core.prompts import ChatPromptTemplate
+from app.retrieval import batch_similarity_search, format_context, serialize_documents
+from app.metrics import track_stage, observe_ollama_response, build_timings, astream_with_ttft, message_token_counts
+from app.tracing import start_span, document_sources
+from app.ollama_client import get_ollama_client
 
 # 加载环境变量
 load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
 
 # 定义常量
-VECTOR_STORE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'vector_store'))
+# 相对路径按项目根目录解析
+VECTOR_STORE_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', os.getenv("VECTOR_STORE_PATH", "vector_store")
+))
 OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL")
 OLLAMA_CHAT_MODEL = os.getenv("OLLAMA_CHAT_MODEL")
+RETRIEVAL_K = 5
+BATCH_GENERATION_CONCURRENCY = int(os.getenv("BATCH_GENERATION_CONCURRENCY", "4"))
 
 class RAGHandler:
     def __init__(self):
         if not os.path.exists(VECTOR_STORE_PATH) or not os.listdir(VECTOR_STORE_PATH):
             raise ValueError(f"向量存储路径 {VECTOR_STORE_PATH} 不存在或为空。请先运行 ingest.py 脚本。")
 
-        self.embeddings = OllamaEmbeddings(model=OLLAMA_EMBEDDING_MODEL, base_url="http://localhost:11434")
-        self.llm = ChatOllama(model=OLLAMA_CHAT_MODEL, temperature=0, base_url="http://localhost:11434")
+        # 嵌入和生成共用进程内的Ollama连接池
+        ollama_client = get_ollama_client()
+        self.embeddings = ollama_client.bind(OllamaEmbeddings(model=OLLAMA_EMBEDDING_MODEL, base_url=ollama_client.base_url))
+        self.llm = ollama_client.bind(ChatOllama(model=OLLAMA_CHAT_MODEL, temperature=0, base_url=ollama_client.base_url))
+        self.vector_store_path = VECTOR_STORE_PATH
         self.vector_store = FAISS.load_local(VECTOR_STORE_PATH, self.embeddings, allow_dangerous_deserialization=True)
-        self.retriever = self.vector_store.as_retriever(search_kwargs={"k": 5})
         self.prompt = self._create_prompt_template()
-        self.retrieval_chain = self._create_chain()
 
     def _create_prompt_template(self):
         """创建并返回一个聊天提示模板。"""
@@ -41,23 +51,106 @@ class RAGHandler:
             [("system", system_prompt), ("human", "{input}")]
         )
 
-    def _create_chain(self):
-        """创建并返回一个检索链。"""
-        question_answer_chain = create_stuff_documents_chain(self.llm, self.prompt)
-        return create_retrieval_chain(self.retriever, question_answer_chain)
-
-    async def get_answer(self, query: str):
-        """根据用户提问，检索并生成答案。"""
-        response = await self.retrieval_chain.ainvoke({"input": query})
-        return {
-            "answer": response["answer"],
-            "source_documents": [
-                {
-                    "content": doc.page_content,
-                    "metadata": doc.metadata
-                } for doc in response["context"]
-            ]
+    async def warmup(self, query: str = "系统预热") -> dict:
+        """执行一次合成的嵌入、检索和生成，提前支付连接、模型加载等首次调用开销"""
+        timings = {}
+        
+        start = time.time()
+        query_vector = await self.embeddings.aembed_query(query)
+        timings["embed"] = time.time() - start
+        
+        start = time.time()
+        await self.vector_store.asimilarity_search_by_vector(query_vector, k=5)
+        timings["retrieve"] = time.time() - start
+        
+        start = time.time()
+        await self.llm.ainvoke("你好")
+        timings["generate"] = time.time() - start
+        
+        return timings
+    
+    async def _retrieve(self, query: str, timings: dict = None) -> list:
+        """嵌入问题并检索相关文档"""
+        with start_span("rag.retrieval", k=RETRIEVAL_K) as span:
+            with track_stage("ollama", "embed", timings), start_span("ollama.embed", model=OLLAMA_EMBEDDING_MODEL):
+                query_vector = await self.embeddings.aembed_query(query)
+            with track_stage("ollama", "search", timings), start_span("faiss.search", k=RETRIEVAL_K):
+                docs = await self.vector_store.asimilarity_search_by_vector(query_vector, k=RETRIEVAL_K)
+            span.set_attributes({"chunk_count": len(docs), "sources": document_sources(docs)})
+        return docs
+    
+    async def get_answer(self, query: str, include_timings: bool = False):
+        """
+        根据用户提问，按嵌入、检索、提示构建、生成四个阶段生成答案。
+        include_timings为True时以流式调用模型测量首个token耗时，并在响应中返回各阶段耗时。
+        """
+        timings = {} if include_timings else None
+        ttft_seconds = None
+        with start_span("rag.get_answer", backend="ollama", query_chars=len(query)), track_stage("ollama", "total", timings):
+            docs = await self._retrieve(query, timings)
+            with track_stage("ollama", "prompt", timings), start_span("rag.prompt") as span:
+                context = format_context(docs)
+                prompt_value = self.prompt.invoke({"context": context, "input": query})
+                span.set_attribute("context_chars", len(context))
+            with track_stage("ollama", "generate", timings), start_span("llm.generate", backend="ollama", model=OLLAMA_CHAT_MODEL) as span:
+                if include_timings:
+                    message, ttft_seconds = await astream_with_ttft(self.llm, prompt_value)
+                else:
+                    message = await self.llm.ainvoke(prompt_value)
+                prompt_tokens, completion_tokens = message_token_counts(message)
+                span.set_attributes({"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+        observe_ollama_response(message)
+        
+        response = {
+            "answer": message.content,
+            "source_documents": serialize_documents(docs)
         }
-
-# 在模块加载时创建单例
-rag_handler_instance = RAGHandler()
\ No newline at end of file
+        if include_timings:
+            response["timings"] = build_timings(timings, ttft_seconds, prompt_tokens, completion_tokens)
+        return response
+    
+    async def get_answers(self, queries: list) -> list:
+        """
+        批量问答：一次嵌入调用、一次FAISS矩阵检索、并发生成。
+        结果与输入顺序一致，单个问题失败时只在该项返回error。
+        """
+        results = [{"query": query} for query in queries]
+        valid = [i for i, query in enumerate(queries) if query and query.strip()]
+        for i in set(range(len(queries))) - set(valid):
+            results[i]["error"] = "问题不能为空"
+        if not valid:
+            return results
+        
+        try:
+            with track_stage("ollama", "batch_embed"), start_span("ollama.embed", model=OLLAMA_EMBEDDING_MODEL, query_count=len(valid)):
+                vectors = await self.embeddings.aembed_documents([queries[i] for i in valid])
+            with track_stage("ollama", "batch_search"), start_span("faiss.search", k=RETRIEVAL_K, query_count=len(valid)) as span:
+                # FAISS矩阵检索在线程中执行，与单条检索的异步路径一样不阻塞事件循环
+                docs_per_query = await asyncio.to_thread(batch_similarity_search, self.vector_store, vectors, RETRIEVAL_K)
+                span.set_attribute("chunk_count", sum(len(docs) for docs in docs_per_query))
+        except Exception as e:
+            for i in valid:
+                results[i]["error"] = f"检索失败: {e}"
+            return results
+        
+        with track_stage("ollama", "batch_prompt"):
+            prompts = [
+                self.prompt.invoke({"context": format_context(docs), "input": queries[i]})
+                for i, docs in zip(valid, docs_per_query)
+            ]
+        with track_stage("ollama", "batch_generate"), start_span("llm.generate_batch", backend="ollama", batch_size=len(prompts)):
+            outputs = await self.llm.abatch(
+                prompts,
+                config={"max_concurrency": BATCH_GENERATION_CONCURRENCY},
+                return_exceptions=True
+            )
+        
+        for i, docs, output in zip(valid, docs_per_query, outputs):
+            if isinstance(output, Exception):
+                results[i]["error"] = f"生成失败: {output}"
+                continue
+            observe_ollama_response(output)
+            results[i]["answer"] = output.content
+            results[i]["source_documents"] = serialize_documents(docs)
+        
+        return results
\ No newline at end of file
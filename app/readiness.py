@@ -0,0 +1,95 @@
+"""
+服务就绪状态
+
+记录RAG处理器的预热进度，供 /ready 端点在预热完成前返回503，
+避免负载均衡器把首批请求送入冷启动路径。预热失败（例如Ollama尚未启动）时按指数退避重试。
+"""
+
+import os
+import time
+import asyncio
+import traceback
+from typing import Any, Dict, Optional
+
+WARMUP_QUERY = "系统预热：请简单介绍一下公司的产品。"
+
+# 预热最多尝试次数，以及首次重试前的等待秒数（之后每次翻倍，不超过WARMUP_MAX_RETRY_DELAY）
+WARMUP_MAX_ATTEMPTS = int(os.getenv("WARMUP_MAX_ATTEMPTS", "5"))
+WARMUP_RETRY_DELAY = float(os.getenv("WARMUP_RETRY_DELAY", "5"))
+WARMUP_MAX_RETRY_DELAY = float(os.getenv("WARMUP_MAX_RETRY_DELAY", "60"))
+
+class ReadinessState:
+    """服务就绪状态"""
+
+    def __init__(self,
+                 max_attempts: int = WARMUP_MAX_ATTEMPTS,
+                 retry_delay: float = WARMUP_RETRY_DELAY,
+                 max_retry_delay: float = WARMUP_MAX_RETRY_DELAY):
+        self.state = "starting"
+        self.error: Optional[str] = None
+        self.warmup_timings: Dict[str, float] = {}
+        self.warmup_attempts = 0
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # 保存后台预热任务的引用，避免任务在运行中被垃圾回收
+        self.warmup_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+
+    def start_warmup(self, handler) -> asyncio.Task:
+        """在后台执行预热，取消尚未结束的上一次预热（例如切换模型时）"""
+        if self.warmup_task is not None and not self.warmup_task.done():
+            self.warmup_task.cancel()
+        self.warmup_task = asyncio.create_task(self.run_warmup(handler))
+        return self.warmup_task
+
+    async def run_warmup(self, handler) -> bool:
+        """执行处理器的预热流程，失败时按指数退避重试，并根据结果更新就绪状态"""
+        self.warmup_attempts = 0
+        delay = self.retry_delay
+        while True:
+            self.warmup_attempts += 1
+            self.state = "warming_up"
+            self.error = None
+            print(f"🔥 开始预热（第 {self.warmup_attempts}/{self.max_attempts} 次）：嵌入、检索、生成...")
+
+            try:
+                self.warmup_timings = await handler.warmup(WARMUP_QUERY)
+                break
+            except Exception as e:
+                self.state = "warmup_failed"
+                self.error = f"{type(e).__name__}: {e}"
+                print(f"❌ 预热失败: {self.error}")
+                traceback.print_exc()
+
+            if self.warmup_attempts >= self.max_attempts:
+                return False
+            print(f"⏳ {delay:.0f} 秒后重试预热")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+        self.state = "ready"
+        self.ready_at = time.time()
+        timings = ", ".join(f"{stage} {seconds:.2f}秒" for stage, seconds in self.warmup_timings.items())
+        print(f"✅ 预热完成: {timings}")
+        return True
+
+    def mark_not_ready(self, state: str = "starting", error: Optional[str] = None):
+        """标记服务未就绪（例如处理器初始化失败或正在切换模型）"""
+        self.state = state
+        self.error = error
+        self.ready_at = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "status": self.state,
+            "error": self.error,
+            "warmup_timings": self.warmup_timings,
+            "warmup_attempts": self.warmup_attempts,
+            "startup_seconds": (self.ready_at - self.started_at) if self.ready_at else None
+        }
@@ -0,0 +1,57 @@
+"""
+批量检索工具
+
+直接对FAISS索引做矩阵检索，一次search调用完成多个问题的相似度搜索，
+供两个RAG处理器的批量问答接口共用。
+"""
+
+from typing import List
+
+import numpy as np
+from langchain_core.documents import Document
+
+# 与create_stuff_documents_chain默认的文档分隔符保持一致
+DOCUMENT_SEPARATOR = "\n\n"
+
+def batch_similarity_search(vector_store, query_vectors: List[List[float]], k: int = 5) -> List[List[Document]]:
+    """
+    对多个查询向量执行一次FAISS矩阵检索。
+
+    返回与输入顺序一致的文档列表，每个元素是对应查询的前k个文档。
+    """
+    if not query_vectors:
+        return []
+
+    matrix = np.asarray(query_vectors, dtype=np.float32)
+    if getattr(vector_store, "_normalize_L2", False):
+        import faiss
+        faiss.normalize_L2(matrix)
+
+    _, indices = vector_store.index.search(matrix, k)
+
+    results = []
+    for row in indices:
+        docs = []
+        for i in row:
+            # 索引中向量不足k个时FAISS以-1填充
+            if i == -1:
+                continue
+            doc_id = vector_store.index_to_docstore_id[i]
+            doc = vector_store.docstore.search(doc_id)
+            if isinstance(doc, Document):
+                docs.append(doc)
+        results.append(docs)
+    return results
+
+def format_context(docs: List[Document]) -> str:
+    """把检索到的文档拼接为提示中的上下文"""
+    return DOCUMENT_SEPARATOR.join(doc.page_content for doc in docs)
+
+def serialize_documents(docs: List[Document]) -> List[dict]:
+    """转换为API响应中的来源文档格式"""
+    return [
+        {
+            "content": doc.page_content,
+            "metadata": doc.metadata
+        } for doc in docs
+    ]
@@ -0,0 +1,21 @@
+"""
+统计工具
+
+服务端指标、压测和评估脚本共用的分位数计算，保证各处报告的p50/p95/p99口径一致。
+"""
+
+import math
+from typing import Iterable
+
+def percentile(values: Iterable[float], p: float) -> float:
+    """
+    最近秩分位数：排序后取第 ceil(p × n) 个值（p取0到1），没有数据时返回0。
+
+    例如1到100的p95为95，p50为50。
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    # 先舍入再取整，避免 0.07 × 100 = 7.000000000000001 这类浮点误差多取一位
+    index = min(len(values) - 1, max(0, math.ceil(round(p * len(values), 9)) - 1))
+    return values[index]
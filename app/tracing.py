@@ -0,0 +1,285 @@
+"""
+请求链路追踪
+
+参照OpenTelemetry的数据模型（trace_id/span_id/父span/属性/状态）记录HTTP请求、
+检索、嵌入调用、FAISS搜索和模型生成等span，通过contextvars在异步调用间传递当前span。
+span结束后交给本地导出器：由后台线程写入JSONL文件，或保存在进程内的环形缓冲区中供 /traces 查询。
+
+通过环境变量配置：
+    TRACE_EXPORTER=memory|file|none（默认memory）
+    TRACE_EXPORT_PATH=logs/traces.jsonl（file模式的输出文件）
+    TRACE_BUFFER_SIZE=5000（memory模式保留的span数）
+    TRACE_FILE_QUEUE_SIZE=10000（file模式等待写入的span数上限，写入跟不上时丢弃新span）
+"""
+
+import os
+import json
+import time
+import queue
+import secrets
+import threading
+import contextvars
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "memory").lower()
+TRACE_EXPORT_PATH = os.getenv(
+    "TRACE_EXPORT_PATH",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'logs', 'traces.jsonl'))
+)
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "5000"))
+TRACE_FILE_QUEUE_SIZE = int(os.getenv("TRACE_FILE_QUEUE_SIZE", "10000"))
+
+# 属性中文本值的最大长度，避免把整段上下文写进追踪数据
+MAX_ATTRIBUTE_LENGTH = 200
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+def _truncate(value: Any) -> Any:
+    if isinstance(value, str) and len(value) > MAX_ATTRIBUTE_LENGTH:
+        return value[:MAX_ATTRIBUTE_LENGTH] + "..."
+    if isinstance(value, (list, tuple)):
+        return [_truncate(item) for item in value]
+    return value
+
+class Span:
+    """一次操作的耗时和属性"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None,
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes: Dict[str, Any] = {}
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+        if attributes:
+            self.set_attributes(attributes)
+
+    def set_attribute(self, key: str, value: Any):
+        if value is not None:
+            self.attributes[key] = _truncate(value)
+
+    def set_attributes(self, attributes: Dict[str, Any]):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def record_exception(self, exc: BaseException):
+        self.status = "error"
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def end(self):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes
+        }
+
+class InMemoryExporter:
+    """把结束的span保存在进程内的环形缓冲区中"""
+
+    def __init__(self, max_spans: int = TRACE_BUFFER_SIZE):
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self._spans.append(span.to_dict())
+
+    def spans(self, trace_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            spans = list(self._spans)
+        if trace_id:
+            spans = [span for span in spans if span["trace_id"] == trace_id]
+        return spans
+
+    def traces(self, limit: int = 20, min_duration_ms: float = 0) -> List[Dict[str, Any]]:
+        """按根span返回最近的若干条链路，每条链路包含全部span"""
+        grouped: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        for span in self.spans():
+            grouped.setdefault(span["trace_id"], []).append(span)
+
+        traces = []
+        for trace_id, spans in reversed(grouped.items()):
+            # 请求带traceparent时根span的父span在上游服务中，父span不在本地的即为本地根span
+            local_ids = {span["span_id"] for span in spans}
+            root = next((span for span in spans if span["parent_id"] not in local_ids), None)
+            if root is None or (root["duration_ms"] or 0) < min_duration_ms:
+                continue
+            traces.append({
+                "trace_id": trace_id,
+                "name": root["name"],
+                "duration_ms": root["duration_ms"],
+                "spans": sorted(spans, key=lambda span: span["start_time"])
+            })
+            if len(traces) >= limit:
+                break
+        return traces
+
+class JsonlFileExporter:
+    """
+    把结束的span逐行追加到JSONL文件，供离线分析。
+
+    export只把span放入队列，序列化和写文件由后台线程批量完成，不阻塞事件循环。
+    """
+
+    def __init__(self, path: str = TRACE_EXPORT_PATH, max_pending: int = TRACE_FILE_QUEUE_SIZE):
+        self.path = path
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._thread = threading.Thread(target=self._write_loop, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span):
+        try:
+            self._queue.put_nowait(span.to_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """等待已导出的span全部写入文件"""
+        self._queue.join()
+
+    def _write_loop(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                spans = [self._queue.get()]
+                while True:
+                    try:
+                        spans.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    f.writelines(json.dumps(span, ensure_ascii=False, default=str) + "\n" for span in spans)
+                    f.flush()
+                except Exception as e:
+                    print(f"⚠️ 写入追踪文件失败: {e}")
+                finally:
+                    for _ in spans:
+                        self._queue.task_done()
+
+class Tracer:
+    """创建span并在结束时交给导出器；没有导出器时不记录任何数据"""
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    @contextmanager
+    def start_span(self, name: str, attributes: Optional[Dict[str, Any]] = None,
+                   trace_id: Optional[str] = None, parent_id: Optional[str] = None):
+        """开始一个span；未指定trace_id时继承当前span，没有当前span则开启新链路"""
+        if not self.enabled:
+            yield _NOOP_SPAN
+            return
+
+        parent = _current_span.get()
+        if trace_id is None:
+            if parent is not None:
+                trace_id, parent_id = parent.trace_id, parent.span_id
+            else:
+                trace_id = secrets.token_hex(16)
+
+        span = Span(name, trace_id, parent_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+            try:
+                self.exporter.export(span)
+            except Exception as e:
+                print(f"⚠️ 导出追踪数据失败: {e}")
+
+class _NoopSpan:
+    """关闭追踪时使用的空span"""
+    trace_id = None
+    span_id = None
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def set_attributes(self, attributes: Dict[str, Any]):
+        pass
+
+    def record_exception(self, exc: BaseException):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+def create_exporter(kind: str = TRACE_EXPORTER):
+    """按配置创建导出器"""
+    if kind == "file":
+        return JsonlFileExporter(TRACE_EXPORT_PATH)
+    if kind == "memory":
+        return InMemoryExporter(TRACE_BUFFER_SIZE)
+    return None
+
+tracer = Tracer(create_exporter())
+
+def start_span(name: str, **attributes):
+    """在全局tracer上开始一个span"""
+    return tracer.start_span(name, attributes)
+
+def current_span():
+    """返回当前span（关闭追踪或不在span内时返回空span）"""
+    return _current_span.get() or _NOOP_SPAN
+
+def parse_traceparent(header: Optional[str]):
+    """解析W3C traceparent请求头，返回 (trace_id, parent_span_id)，格式不对时返回 (None, None)"""
+    if not header:
+        return None, None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None, None
+    return parts[1], parts[2]
+
+def document_sources(docs) -> List[str]:
+    """提取检索结果的来源文件，作为span属性"""
+    return [str(doc.metadata.get("source", "")) for doc in docs]
+
+async def trace_http_request(request, call_next):
+    """FastAPI中间件：为每个HTTP请求创建根span，并在响应头中返回X-Trace-Id"""
+    if not tracer.enabled:
+        return await call_next(request)
+
+    trace_id, parent_id = parse_traceparent(request.headers.get("traceparent"))
+    with tracer.start_span(
+        "http.request",
+        {"http.method": request.method, "http.path": request.url.path},
+        trace_id=trace_id,
+        parent_id=parent_id
+    ) as span:
+        response = await call_next(request)
+        span.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            span.status = "error"
+        response.headers["X-Trace-Id"] = span.trace_id
+        return response
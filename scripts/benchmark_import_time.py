@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+API模块导入耗时基准
+
+在独立子进程中以 `python -X importtime` 导入各服务模块，汇总总耗时和最慢的
+顶层依赖包，并检查Ollama模式下是否误导入了torch/transformers/peft等重型库。
+结果保存为JSON，可与基线结果对比，作为冷启动时间的回归检查。
+
+使用方法:
+    python scripts/benchmark_import_time.py
+    python scripts/benchmark_import_time.py --baseline benchmark_results/import_time_baseline.json
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from datetime import datetime
+from typing import Dict, List
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+OUTPUT_DIR = os.path.join(PROJECT_ROOT, 'benchmark_results')
+
+# 需要测量的模块
+MODULES = ['app.main', 'app.lora_main', 'app.lora_rag_handler']
+
+# Ollama模式下不应在导入阶段加载的重型库
+HEAVY_PACKAGES = ['torch', 'transformers', 'peft']
+
+def parse_importtime(stderr: str) -> List[Dict]:
+    """解析 -X importtime 输出，返回每个模块的自身耗时和累计耗时（微秒）"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            self_part, cumulative_part, raw_name = line.split(':', 1)[1].split('|', 2)
+            self_us = int(self_part)
+            cumulative_us = int(cumulative_part)
+        except ValueError:
+            continue
+        # 模块名前的缩进表示嵌套深度：顶层模块前有1个空格，每深一层多2个空格
+        raw_name = raw_name[1:]
+        entries.append({
+            'module': raw_name.strip(),
+            'depth': (len(raw_name) - len(raw_name.lstrip())) // 2,
+            'self_us': self_us,
+            'cumulative_us': cumulative_us
+        })
+    return entries
+
+def slowest_packages(entries: List[Dict], limit: int = 10) -> List[Dict]:
+    """按顶层包名汇总自身耗时，返回最慢的若干个包"""
+    totals = {}
+    for entry in entries:
+        package = entry['module'].split('.')[0]
+        totals[package] = totals.get(package, 0) + entry['self_us']
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [{'package': package, 'self_ms': self_us / 1000} for package, self_us in ranked]
+
+def measure_module(module: str, repeat: int = 3) -> Dict:
+    """多次测量模块导入，取总耗时最短的一次"""
+    env = dict(os.environ, USE_LORA_DEFAULT='false', PYTHONDONTWRITEBYTECODE='1')
+    code = (
+        f"import sys, json; import {module}; "
+        f"print(json.dumps([m for m in {HEAVY_PACKAGES!r} if m in sys.modules]))"
+    )
+
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=PROJECT_ROOT, env=env, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            return {'module': module, 'error': result.stderr.strip().splitlines()[-1:]}
+
+        entries = parse_importtime(result.stderr)
+        top_level = [e for e in entries if e['depth'] == 0]
+        total_us = sum(e['cumulative_us'] for e in top_level)
+        if best is None or total_us < best['total_ms'] * 1000:
+            best = {
+                'module': module,
+                'total_ms': total_us / 1000,
+                'module_count': len(entries),
+                'heavy_packages_loaded': json.loads(result.stdout.strip().splitlines()[-1]),
+                'slowest_packages': slowest_packages(entries)
+            }
+    return best
+
+def compare_with_baseline(results: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    """与基线比较，返回超出允许回退比例的模块说明"""
+    regressions = []
+    for module, current in results['modules'].items():
+        previous = baseline.get('modules', {}).get(module)
+        if not previous or 'total_ms' not in previous or 'total_ms' not in current:
+            continue
+        limit = previous['total_ms'] * (1 + max_regression)
+        if current['total_ms'] > limit:
+            regressions.append(
+                f"{module}: {current['total_ms']:.0f}ms > 基线 {previous['total_ms']:.0f}ms × {1 + max_regression:.2f}"
+            )
+    return regressions
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='测量API模块导入耗时')
+    parser.add_argument('--modules', nargs='+', default=MODULES, help='要测量的模块')
+    parser.add_argument('--repeat', type=int, default=3, help='每个模块的测量次数（取最小值）')
+    parser.add_argument('--output', default=os.path.join(OUTPUT_DIR, 'import_time.json'), help='结果文件路径')
+    parser.add_argument('--baseline', help='基线结果文件，用于回归检查')
+    parser.add_argument('--max-regression', type=float, default=0.25, help='允许的最大耗时回退比例')
+
+    args = parser.parse_args()
+
+    # 先读取基线，允许基线与输出为同一文件
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = {
+        'timestamp': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'modules': {}
+    }
+
+    failed = False
+    for module in args.modules:
+        measurement = measure_module(module, args.repeat)
+        results['modules'][module] = measurement
+
+        if 'error' in measurement:
+            print(f"❌ {module}: 导入失败 {measurement['error']}")
+            failed = True
+            continue
+
+        print(f"{module}: {measurement['total_ms']:.0f}ms, {measurement['module_count']} 个模块")
+        for entry in measurement['slowest_packages'][:5]:
+            print(f"    {entry['package']}: {entry['self_ms']:.0f}ms")
+        if measurement['heavy_packages_loaded']:
+            print(f"  ⚠️ Ollama模式下导入了重型库: {measurement['heavy_packages_loaded']}")
+            failed = True
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"\n结果已保存: {args.output}")
+
+    if baseline is not None:
+        regressions = compare_with_baseline(results, baseline, args.max_regression)
+        for message in regressions:
+            print(f"❌ 导入耗时回退 {message}")
+        failed = failed or bool(regressions)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+多进程服务内存基准
+
+在同一个合成向量库和Ollama替身服务上，分别以两种方式启动N个worker：
+- uvicorn --workers N：每个worker独立加载向量库；
+- python -m app.prefork --workers N：主进程加载一次后fork，worker按写时复制共享。
+
+就绪后先发送一批 /ask 请求，让每个worker都实际访问过索引，再用psutil统计
+主进程和各worker的RSS、USS（进程独占）和PSS（共享页按进程数分摊）。
+RSS会把共享页重复计入每个进程，比较两种模式应看PSS合计和每个worker的USS。
+
+使用方法:
+    python scripts/benchmark_prefork_memory.py
+    python scripts/benchmark_prefork_memory.py --app lora_main --workers 2 4 --chunks 100000
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from datetime import datetime
+from typing import Dict, List
+
+import psutil
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+OUTPUT_DIR = os.path.join(PROJECT_ROOT, 'benchmark_results')
+
+sys.path.insert(0, PROJECT_ROOT)
+from scripts.build_synthetic_corpus import ensure_corpus
+from scripts.load_test import (
+    APPS, load_queries, free_port, git_commit, start_process, stop_process,
+    wait_until_ready, run_load, app_env, start_fake_ollama
+)
+
+MODES = ['uvicorn', 'prefork']
+
+def serve_command(mode: str, app_name: str, workers: int, port: int) -> List[str]:
+    if mode == 'prefork':
+        return [sys.executable, '-m', 'app.prefork', '--app', app_name, '--workers', str(workers),
+                '--port', str(port), '--log-level', 'warning']
+    return [sys.executable, '-m', 'uvicorn', APPS[app_name], '--host', '127.0.0.1', '--port', str(port),
+            '--workers', str(workers), '--log-level', 'warning']
+
+def memory_mb(process: psutil.Process) -> Dict[str, float]:
+    """单个进程的RSS/USS/PSS（MB）；平台不提供USS/PSS时为0"""
+    try:
+        info = process.memory_full_info()
+    except psutil.AccessDenied:
+        info = process.memory_info()
+    return {
+        key: round(getattr(info, key, 0) / 1024 / 1024, 1)
+        for key in ('rss', 'uss', 'pss')
+    }
+
+def measure_processes(pid: int) -> Dict:
+    """主进程及所有子进程的内存；uvicorn --workers 的multiprocessing辅助进程同样计入"""
+    master = psutil.Process(pid)
+    children = []
+    for child in master.children(recursive=True):
+        try:
+            children.append(memory_mb(child))
+        except psutil.Error:
+            pass
+    master_memory = memory_mb(master)
+    total = {
+        key: round(master_memory[key] + sum(child[key] for child in children), 1)
+        for key in master_memory
+    }
+    per_worker = {
+        key: round(sum(child[key] for child in children) / len(children), 1) if children else 0.0
+        for key in master_memory
+    }
+    return {'master': master_memory, 'children': children, 'total': total, 'per_worker': per_worker}
+
+def benchmark_mode(mode: str, app_name: str, workers: int, corpus: str, fake_url: str, args,
+                   queries: List[str]) -> Dict:
+    """以指定方式启动服务，预热后测量内存"""
+    port = free_port()
+    process = start_process(
+        f"{mode}_{app_name}_w{workers}",
+        serve_command(mode, app_name, workers, port),
+        app_env(fake_url, corpus, args.extra_env), args.log_dir
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        started = time.time()
+        if not wait_until_ready(f"{base_url}/ready", process, args.startup_timeout):
+            print(f"❌ {mode} 未能就绪，日志见 {args.log_dir}")
+            return {'mode': mode, 'workers': workers, 'error': 'not_ready'}
+        ready_seconds = time.time() - started
+        # /ready 只说明有一个worker就绪，等待其余worker完成加载
+        time.sleep(args.settle_seconds)
+
+        # 每个worker平均处理若干请求，确保索引页都被访问过
+        load = asyncio.run(run_load(base_url, queries, workers, workers * args.requests_per_worker))
+        memory = measure_processes(process.pid)
+    finally:
+        stop_process(process)
+
+    return {
+        'mode': mode,
+        'workers': workers,
+        'ready_seconds': round(ready_seconds, 2),
+        'requests': load['requests'],
+        'errors': load['errors'],
+        'memory_mb': memory
+    }
+
+def print_results(results: List[Dict]):
+    print(f"\n{'模式':<10}{'worker':>8}{'RSS合计':>12}{'PSS合计':>12}{'每worker USS':>16}{'每worker PSS':>16}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['mode']:<10}{result['workers']:>8}  {result['error']}")
+            continue
+        memory = result['memory_mb']
+        print(
+            f"{result['mode']:<10}{result['workers']:>8}"
+            f"{memory['total']['rss']:>12.0f}{memory['total']['pss']:>12.0f}"
+            f"{memory['per_worker']['uss']:>16.0f}{memory['per_worker']['pss']:>16.0f}"
+        )
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='uvicorn --workers 与 pre-fork 模式的内存对比')
+    parser.add_argument('--app', choices=list(APPS), default='main', help='被测应用')
+    parser.add_argument('--workers', nargs='+', type=int, default=[2, 4], help='worker数')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES, help='启动方式')
+    parser.add_argument('--chunks', type=int, default=100000, help='合成向量库规模（文本块数）')
+    parser.add_argument('--dim', type=int, default=768, help='向量维度')
+    parser.add_argument('--requests-per-worker', type=int, default=5, help='测量前每个worker的预热请求数')
+    parser.add_argument('--settle-seconds', type=float, default=5.0, help='首个worker就绪后等待其余worker的时间')
+    parser.add_argument('--env', action='append', dest='env_items', metavar='KEY=VALUE', help='传给被测应用的额外环境变量')
+    parser.add_argument('--startup-timeout', type=float, default=300.0, help='等待服务就绪的最长时间（秒）')
+    parser.add_argument('--output', default=os.path.join(OUTPUT_DIR, 'prefork_memory.json'), help='结果文件路径')
+
+    args = parser.parse_args()
+    args.extra_env = dict(item.partition('=')[::2] for item in args.env_items or [])
+    args.log_dir = os.path.join(OUTPUT_DIR, 'logs')
+    # 替身服务不计入本基准，使用最小延迟
+    args.embed_latency_ms = args.prefill_ms = args.token_latency_ms = 0
+    args.tokens = 8
+
+    queries = load_queries()
+    fake_server, fake_url = start_fake_ollama(args, args.log_dir)
+    results = []
+    try:
+        if fake_server.poll() is not None:
+            print("❌ Ollama替身服务启动失败")
+            return 1
+        corpus = ensure_corpus(args.chunks, args.dim)
+        for workers in args.workers:
+            for mode in args.modes:
+                print(f"🚀 {mode}: {args.app}, {workers} 个worker, 向量库 {args.chunks} 个文本块")
+                results.append(benchmark_mode(mode, args.app, workers, corpus, fake_url, args, queries))
+    finally:
+        stop_process(fake_server)
+
+    print_results(results)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'timestamp': datetime.now().isoformat(),
+            'commit': git_commit(),
+            'app': args.app,
+            'chunks': args.chunks,
+            'dim': args.dim,
+            'results': results
+        }, f, indent=2, ensure_ascii=False)
+    print(f"\n结果已保存: {args.output}")
+
+    return 1 if any('error' in result for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+检索索引基准
+
+读取已构建的向量库（index.faiss）或生成带聚类结构的合成向量，以精确的
+Flat搜索结果为基准，对 Flat、HNSW、IVF-Flat、IVF-PQ 等索引类型和参数
+（efSearch、nprobe）做扫描，报告 recall@k、单查询QPS与p50/p99延迟、
+构建时间和索引内存占用，用数据选择索引类型和参数。
+
+查询使用 evaluation_dataset.json 中的用户问题，经嵌入模型编码后再加入少量
+扰动扩充到指定数量，使结果接近线上查询的分布；嵌入模型不可用时改用
+向量库中随机向量加扰动作为查询。
+
+使用方法:
+    python scripts/benchmark_retrieval.py
+    python scripts/benchmark_retrieval.py --vector-store vector_store --k 5 --num-queries 500
+    python scripts/benchmark_retrieval.py --synthetic 100000 --dim 768 --hnsw-m 16 32 --nprobe 4 16 64
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+OUTPUT_DIR = os.path.join(PROJECT_ROOT, 'benchmark_results')
+
+sys.path.insert(0, PROJECT_ROOT)
+from scripts.load_test import load_queries
+from app.stats import percentile
+
+# IVF训练时每个聚类中心至少需要的训练向量数（低于此值faiss会告警且聚类质量差）
+MIN_POINTS_PER_CENTROID = 39
+
+def load_vectors(vector_store: str) -> np.ndarray:
+    """从向量库的index.faiss中取出全部原始向量"""
+    import faiss
+    index = faiss.read_index(os.path.join(vector_store, 'index.faiss'))
+    return index.reconstruct_n(0, index.ntotal).astype(np.float32)
+
+def synthetic_vectors(count: int, dim: int, clusters: int = 256, seed: int = 42) -> np.ndarray:
+    """生成带聚类结构的单位向量，比均匀随机向量更接近真实文本嵌入的分布"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    labels = rng.integers(0, clusters, count)
+    vectors = centers[labels] + 0.5 * rng.standard_normal((count, dim), dtype=np.float32)
+    return normalize(vectors)
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def perturb(vectors: np.ndarray, count: int, noise: float = 0.05, seed: int = 0) -> np.ndarray:
+    """对给定向量循环加入高斯扰动，扩充到count个查询"""
+    rng = np.random.default_rng(seed)
+    picked = vectors[np.arange(count) % len(vectors)]
+    scale = noise * np.linalg.norm(picked, axis=1, keepdims=True) / np.sqrt(vectors.shape[1])
+    return (picked + scale * rng.standard_normal(picked.shape, dtype=np.float32)).astype(np.float32)
+
+def embed_questions(questions: List[str]) -> Optional[np.ndarray]:
+    """用配置的Ollama嵌入模型编码问题，失败时返回None"""
+    try:
+        from dotenv import load_dotenv
+        from langchain_ollama import OllamaEmbeddings
+        from app.ollama_client import get_ollama_client
+        load_dotenv(os.path.join(PROJECT_ROOT, '.env'))
+        ollama_client = get_ollama_client()
+        embeddings = ollama_client.bind(OllamaEmbeddings(
+            model=os.getenv("OLLAMA_EMBEDDING_MODEL"),
+            base_url=ollama_client.base_url
+        ))
+        return np.array(embeddings.embed_documents(questions), dtype=np.float32)
+    except Exception as e:
+        print(f"⚠️ 嵌入问题失败，改用向量库中的向量作为查询: {e}")
+        return None
+
+def build_queries(vectors: np.ndarray, num_queries: int, use_questions: bool) -> (np.ndarray, str):
+    """构造查询向量，返回 (查询, 来源说明)"""
+    if use_questions:
+        question_vectors = embed_questions(load_queries())
+        if question_vectors is not None and question_vectors.shape[1] == vectors.shape[1]:
+            return perturb(question_vectors, num_queries), "evaluation_dataset"
+        if question_vectors is not None:
+            print(f"⚠️ 问题向量维度 {question_vectors.shape[1]} 与向量库 {vectors.shape[1]} 不一致")
+    rng = np.random.default_rng(1)
+    sample = vectors[rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)]
+    return perturb(sample, num_queries), "corpus_sample"
+
+def pq_subquantizers(dim: int, requested: int) -> int:
+    """PQ子空间数必须整除维度，取不超过requested的最大约数"""
+    for m in range(min(requested, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+def default_nlist(count: int) -> int:
+    """IVF聚类数：约4·√N，并保证每个中心有足够的训练向量"""
+    nlist = max(1, int(4 * np.sqrt(count)))
+    return max(1, min(nlist, count // MIN_POINTS_PER_CENTROID))
+
+def index_specs(count: int, dim: int, args) -> List[Dict]:
+    """按参数生成待测索引：名称、faiss工厂字符串和需要扫描的搜索参数"""
+    specs = [{'name': 'Flat', 'factory': 'Flat', 'param': None, 'values': [None]}]
+    for m in args.hnsw_m:
+        specs.append({
+            'name': f'HNSW{m}',
+            'factory': f'HNSW{m}',
+            'param': 'efSearch',
+            'values': args.ef_search,
+            'ef_construction': args.ef_construction
+        })
+
+    nlist = args.nlist or default_nlist(count)
+    nprobe = [n for n in args.nprobe if n <= nlist]
+    specs.append({'name': f'IVF{nlist},Flat', 'factory': f'IVF{nlist},Flat', 'param': 'nprobe', 'values': nprobe})
+
+    pq_m = pq_subquantizers(dim, args.pq_m)
+    # 8位PQ码本需要训练，向量太少时跳过
+    if count >= 256 * MIN_POINTS_PER_CENTROID // 4:
+        specs.append({
+            'name': f'IVF{nlist},PQ{pq_m}',
+            'factory': f'IVF{nlist},PQ{pq_m}x8',
+            'param': 'nprobe',
+            'values': nprobe
+        })
+    else:
+        print(f"⚠️ 向量数 {count} 过少，跳过IVF-PQ")
+    return specs
+
+def build_index(spec: Dict, vectors: np.ndarray):
+    """构建索引，返回 (索引, 构建秒数, 序列化后字节数)"""
+    import faiss
+    started = time.perf_counter()
+    index = faiss.index_factory(vectors.shape[1], spec['factory'])
+    if 'ef_construction' in spec:
+        index.hnsw.efConstruction = spec['ef_construction']
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    build_seconds = time.perf_counter() - started
+    return index, build_seconds, faiss.serialize_index(index).nbytes
+
+def recall_at_k(approx: np.ndarray, truth: np.ndarray) -> float:
+    """approx与truth的前k个结果的平均重合比例"""
+    k = truth.shape[1]
+    hits = sum(len(set(a[:k]) & set(t)) for a, t in zip(approx, truth))
+    return hits / (k * len(truth))
+
+def measure_search(index, queries: np.ndarray, k: int) -> Dict:
+    """逐条查询（与服务中单个请求一致），返回结果ID、QPS和延迟分布"""
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    latencies = []
+    started = time.perf_counter()
+    for i, query in enumerate(queries):
+        query_started = time.perf_counter()
+        _, ids[i] = index.search(query.reshape(1, -1), k)
+        latencies.append(time.perf_counter() - query_started)
+    elapsed = time.perf_counter() - started
+    return {
+        'ids': ids,
+        'qps': len(queries) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': 1000 * percentile(latencies, 0.50),
+        'p99_ms': 1000 * percentile(latencies, 0.99)
+    }
+
+def run_benchmark(vectors: np.ndarray, queries: np.ndarray, k: int, specs: List[Dict],
+                  search_threads: int = 1) -> List[Dict]:
+    """以Flat结果为基准扫描各索引和参数；训练和构建使用全部线程，搜索使用search_threads"""
+    import faiss
+    build_threads = faiss.omp_get_max_threads()
+    truth_index = faiss.IndexFlatL2(vectors.shape[1])
+    truth_index.add(vectors)
+    _, truth = truth_index.search(queries, k)
+
+    results = []
+    for spec in specs:
+        faiss.omp_set_num_threads(build_threads)
+        index, build_seconds, index_bytes = build_index(spec, vectors)
+        faiss.omp_set_num_threads(search_threads)
+        for value in spec['values']:
+            if spec['param']:
+                faiss.ParameterSpace().set_index_parameter(index, spec['param'], value)
+            search = measure_search(index, queries, k)
+            results.append({
+                'index': spec['name'],
+                'param': spec['param'],
+                'value': value,
+                f'recall@{k}': round(recall_at_k(search['ids'], truth), 4),
+                'qps': round(search['qps'], 1),
+                'p50_ms': round(search['p50_ms'], 3),
+                'p99_ms': round(search['p99_ms'], 3),
+                'build_seconds': round(build_seconds, 3),
+                'index_mb': round(index_bytes / 1024 / 1024, 2)
+            })
+        del index
+    faiss.omp_set_num_threads(build_threads)
+    return results
+
+def print_results(results: List[Dict], k: int):
+    print(f"\n{'索引':<20}{'参数':<16}{'recall@' + str(k):>10}{'QPS':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'构建(s)':>10}{'内存(MB)':>10}")
+    for r in results:
+        param = f"{r['param']}={r['value']}" if r['param'] else "-"
+        print(
+            f"{r['index']:<20}{param:<16}{r[f'recall@{k}']:>10.4f}{r['qps']:>10.0f}"
+            f"{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['build_seconds']:>10.2f}{r['index_mb']:>10.1f}"
+        )
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='FAISS索引类型与参数的召回率/延迟基准')
+    parser.add_argument('--vector-store', default=os.path.join(PROJECT_ROOT, 'vector_store'), help='已构建的向量库目录')
+    parser.add_argument('--synthetic', type=int, help='忽略向量库，生成指定数量的合成向量')
+    parser.add_argument('--dim', type=int, default=768, help='合成向量维度')
+    parser.add_argument('--k', type=int, default=5, help='recall@k中的k（与RETRIEVAL_K一致）')
+    parser.add_argument('--num-queries', type=int, default=200, help='查询数')
+    parser.add_argument('--hnsw-m', nargs='+', type=int, default=[16, 32], help='HNSW每个节点的连接数')
+    parser.add_argument('--ef-construction', type=int, default=200, help='HNSW构建时的efConstruction')
+    parser.add_argument('--ef-search', nargs='+', type=int, default=[16, 32, 64, 128], help='HNSW搜索时的efSearch')
+    parser.add_argument('--nlist', type=int, help='IVF聚类数（默认约4·√N）')
+    parser.add_argument('--nprobe', nargs='+', type=int, default=[1, 4, 16, 64], help='IVF搜索的聚类数')
+    parser.add_argument('--pq-m', type=int, default=48, help='PQ子空间数（自动调整为维度的约数）')
+    parser.add_argument('--threads', type=int, default=1, help='faiss搜索线程数（服务中为单查询，默认1）')
+    parser.add_argument('--output', default=os.path.join(OUTPUT_DIR, 'retrieval_benchmark.json'), help='结果文件路径')
+
+    args = parser.parse_args()
+
+    if args.synthetic:
+        vectors = synthetic_vectors(args.synthetic, args.dim)
+        source = f"synthetic:{args.synthetic}"
+    elif os.path.exists(os.path.join(args.vector_store, 'index.faiss')):
+        vectors = load_vectors(args.vector_store)
+        source = args.vector_store
+    else:
+        print(f"⚠️ 向量库不存在: {args.vector_store}，改用10000个合成向量")
+        vectors = synthetic_vectors(10000, args.dim)
+        source = "synthetic:10000"
+
+    queries, query_source = build_queries(vectors, args.num_queries, use_questions=not args.synthetic)
+    print(f"📊 向量 {len(vectors)} × {vectors.shape[1]} 维，查询 {len(queries)} 条（{query_source}）")
+
+    specs = index_specs(len(vectors), vectors.shape[1], args)
+    results = run_benchmark(vectors, queries, args.k, specs, args.threads)
+    print_results(results, args.k)
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'source': source,
+        'vectors': len(vectors),
+        'dim': int(vectors.shape[1]),
+        'queries': len(queries),
+        'query_source': query_source,
+        'k': args.k,
+        'threads': args.threads,
+        'results': results
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n结果已保存: {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
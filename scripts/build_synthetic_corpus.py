@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+合成向量库构建
+
+直接生成随机单位向量和占位文本，构建与 ingest.py 输出格式一致的FAISS向量库
+（index.faiss + index.pkl），不调用嵌入模型，几秒到几分钟即可得到1千、10万、
+100万个文本块规模的语料，供压测比较检索开销随库规模的变化。
+
+注意：100万块、768维的向量库约占3GB内存和磁盘。
+
+使用方法:
+    python scripts/build_synthetic_corpus.py --chunks 100000
+    python scripts/build_synthetic_corpus.py --chunks 1000000 --dim 768 --output benchmark_results/corpora/synthetic_1000000_768
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+CORPUS_DIR = os.path.join(PROJECT_ROOT, 'benchmark_results', 'corpora')
+
+# 每批生成的向量数，控制构建时的峰值内存
+BATCH_SIZE = 50000
+
+# 每个合成来源文件包含的文本块数
+CHUNKS_PER_SOURCE = 50
+
+TEMPLATES = [
+    "第{i}号合成文本块：产品型号HX-{model}的安装步骤、接线说明和常见故障处理。",
+    "第{i}号合成文本块：{model}系列设备的技术参数、工作温度范围和防护等级说明。",
+    "第{i}号合成文本块：售后服务政策第{model}条，保修期限、退换货流程与联系方式。",
+    "第{i}号合成文本块：项目{model}的验收标准、测试记录和交付文档清单。"
+]
+
+def corpus_path(chunks: int, dim: int) -> str:
+    """合成向量库的默认目录"""
+    return os.path.join(CORPUS_DIR, f"synthetic_{chunks}_{dim}")
+
+def synthetic_text(i: int) -> str:
+    return TEMPLATES[i % len(TEMPLATES)].format(i=i, model=i % 997)
+
+def build_corpus(output: str, chunks: int, dim: int = 768, seed: int = 42) -> str:
+    """构建合成向量库并保存到output目录，返回目录路径"""
+    import faiss
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import FakeEmbeddings
+
+    rng = np.random.default_rng(seed)
+    index = faiss.IndexFlatL2(dim)
+    documents = {}
+    index_to_docstore_id = {}
+
+    for start in range(0, chunks, BATCH_SIZE):
+        count = min(BATCH_SIZE, chunks - start)
+        vectors = rng.standard_normal((count, dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        index.add(vectors)
+
+        for i in range(start, start + count):
+            doc_id = str(i)
+            documents[doc_id] = Document(
+                page_content=synthetic_text(i),
+                metadata={"source": f"synthetic_{i // CHUNKS_PER_SOURCE}.docx", "chunk": i}
+            )
+            index_to_docstore_id[i] = doc_id
+
+    vector_store = FAISS(
+        # 嵌入函数不会被保存，加载时由应用传入真实的嵌入模型
+        embedding_function=FakeEmbeddings(size=dim),
+        index=index,
+        docstore=InMemoryDocstore(documents),
+        index_to_docstore_id=index_to_docstore_id
+    )
+    os.makedirs(output, exist_ok=True)
+    vector_store.save_local(output)
+    return output
+
+def ensure_corpus(chunks: int, dim: int = 768, seed: int = 42) -> str:
+    """返回合成向量库目录，不存在时先构建"""
+    path = corpus_path(chunks, dim)
+    if os.path.exists(os.path.join(path, 'index.faiss')):
+        return path
+    print(f"🔄 构建合成向量库: {chunks} 个文本块, {dim} 维")
+    started = time.time()
+    build_corpus(path, chunks, dim, seed)
+    print(f"✅ 合成向量库已保存: {path} ({time.time() - started:.1f}s)")
+    return path
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='构建合成FAISS向量库')
+    parser.add_argument('--chunks', type=int, default=1000, help='文本块数量')
+    parser.add_argument('--dim', type=int, default=768, help='向量维度，需与嵌入模型（或替身服务）一致')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    parser.add_argument('--output', help='输出目录（默认 benchmark_results/corpora/synthetic_<块数>_<维度>）')
+
+    args = parser.parse_args()
+
+    output = args.output or corpus_path(args.chunks, args.dim)
+    started = time.time()
+    build_corpus(output, args.chunks, args.dim, args.seed)
+    print(f"✅ 合成向量库已保存: {output} ({args.chunks} 个文本块, {time.time() - started:.1f}s)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
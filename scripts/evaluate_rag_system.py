@@ -24,12 +24,16 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 from app.rag_handler import RAGHandler
 from langchain_ollama import ChatOllama
+from app.ollama_client import get_ollama_client
+from app.stats import percentile
 
 # 配置参数
 EVALUATION_DATASET = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'evaluation_dataset.json'))
 OUTPUT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'evaluation_results'))
 JUDGE_MODEL = "qwen3:4b"  # 用作评判的模型
 MAX_CONCURRENT = 3  # 最大并发评估数量
+# get_answer返回的timings中参与耗时分布统计的字段
+STAGE_TIMING_FIELDS = ['embedding_ms', 'retrieval_ms', 'prompt_ms', 'ttft_ms', 'generation_ms', 'total_ms']
 
 class RAGEvaluator:
     """RAG系统评估器"""
@@ -51,11 +55,13 @@ class RAGEvaluator:
         
         print("初始化评判模型...")
         try:
-            self.judge_llm = ChatOllama(
+            # 评判模型与RAG系统共用进程内的Ollama连接池
+            ollama_client = get_ollama_client()
+            self.judge_llm = ollama_client.bind(ChatOllama(
                 model=JUDGE_MODEL,
                 temperature=0.1,  # 低温度确保评判一致性
-                base_url="http://localhost:11434"
-            )
+                base_url=ollama_client.base_url
+            ))
             print("评判模型初始化成功")
         except Exception as e:
             print(f"评判模型初始化失败: {e}")
@@ -76,13 +82,14 @@ class RAGEvaluator:
         """获取RAG系统的回答"""
         try:
             start_time = time.time()
-            result = await self.rag_handler.get_answer(question)
+            result = await self.rag_handler.get_answer(question, include_timings=True)
             response_time = time.time() - start_time
             
             return {
                 'answer': result.get('answer', ''),
                 'source_documents': result.get('source_documents', []),
                 'response_time': response_time,
+                'timings': result.get('timings', {}),
                 'success': True,
                 'error': None
             }
@@ -91,6 +98,7 @@ class RAGEvaluator:
                 'answer': '',
                 'source_documents': [],
                 'response_time': 0,
+                'timings': {},
                 'success': False,
                 'error': str(e)
             }
@@ -201,6 +209,7 @@ AI回答: {actual_answer}
             'rag_success': True,
             'rag_error': None,
             'response_time': rag_result['response_time'],
+            'timings': rag_result['timings'],
             'source_count': len(rag_result['source_documents']),
             'scores': scores,
             'category': question_data.get('category', 'unknown'),
@@ -241,7 +250,8 @@ AI回答: {actual_answer}
                     'successful_questions': 0,
                     'success_rate': 0,
                     'average_scores': {},
-                    'average_response_time': 0
+                    'average_response_time': 0,
+                    'stage_latency': {}
                 },
                 'category_analysis': {},
                 'difficulty_analysis': {},
@@ -259,6 +269,7 @@ AI回答: {actual_answer}
         # 计算平均响应时间
         response_times = [r['response_time'] for r in results if r['rag_success']]
         average_response_time = sum(response_times) / len(response_times) if response_times else 0
+        stage_latency = self.stage_latency_distribution(results)
         
         # 按类别分析
         category_analysis = {}
@@ -312,13 +323,32 @@ AI回答: {actual_answer}
                 'successful_questions': successful_questions,
                 'success_rate': successful_questions / total_questions,
                 'average_scores': average_scores,
-                'average_response_time': average_response_time
+                'average_response_time': average_response_time,
+                'stage_latency': stage_latency
             },
             'category_analysis': category_analysis,
             'difficulty_analysis': difficulty_analysis,
             'detailed_results': results
         }
     
+    def stage_latency_distribution(self, results: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+        """按阶段统计耗时分布（毫秒）：平均值、P50、P95、最大值"""
+        distribution = {}
+        for field in STAGE_TIMING_FIELDS:
+            values = sorted(
+                r['timings'][field] for r in results
+                if r['rag_success'] and r.get('timings', {}).get(field) is not None
+            )
+            if not values:
+                continue
+            distribution[field] = {
+                'mean': sum(values) / len(values),
+                'p50': percentile(values, 0.5),
+                'p95': percentile(values, 0.95),
+                'max': values[-1]
+            }
+        return distribution
+    
     def save_results(self, report: Dict[str, Any]):
         """保存评估结果"""
         os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -353,6 +383,11 @@ AI回答: {actual_answer}
 - **成功率**: {summary['success_rate']:.2%}
 - **平均响应时间**: {summary['average_response_time']:.2f}秒
 
+## 阶段耗时分布
+
+| 阶段 | 平均 (ms) | P50 (ms) | P95 (ms) | 最大 (ms) |
+|------|-----------|----------|----------|-----------|
+{self.format_stage_latency_table(summary.get('stage_latency', {}))}
 ## 评分详情
 
 | 维度 | 平均分 | 评级 |
@@ -397,6 +432,13 @@ AI回答: {actual_answer}
         with open(output_file, 'w', encoding='utf-8') as f:
             f.write(content)
     
+    def format_stage_latency_table(self, stage_latency: Dict[str, Dict[str, float]]) -> str:
+        """生成阶段耗时分布的Markdown表格行"""
+        rows = ""
+        for field, stats in stage_latency.items():
+            rows += f"| {field} | {stats['mean']:.1f} | {stats['p50']:.1f} | {stats['p95']:.1f} | {stats['max']:.1f} |\n"
+        return rows
+    
     def get_grade(self, score: float) -> str:
         """根据分数获取评级"""
         if score >= 4.5:
@@ -424,6 +466,11 @@ AI回答: {actual_answer}
         print(f"  成功率: {summary['success_rate']:.2%}")
         print(f"  平均响应时间: {summary['average_response_time']:.2f}秒")
         
+        if summary.get('stage_latency'):
+            print(f"\n阶段耗时分布 (ms):")
+            for field, stats in summary['stage_latency'].items():
+                print(f"  {field}: 平均 {stats['mean']:.1f}, P50 {stats['p50']:.1f}, P95 {stats['p95']:.1f}, 最大 {stats['max']:.1f}")
+        
         print(f"\n评分详情:")
         for key, score in summary['average_scores'].items():
             if key == 'overall_score':
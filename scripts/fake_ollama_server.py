@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+本地Ollama替身服务
+
+实现 /api/embed、/api/chat、/api/generate、/api/tags、/api/show 等接口，
+按配置的延迟返回确定性的嵌入向量和固定长度的流式回答，响应格式与Ollama一致
+（包括 prompt_eval_count、eval_count、eval_duration 等统计字段），
+供压测时替代真实模型，让结果只反映本服务自身的开销。
+
+使用方法:
+    python scripts/fake_ollama_server.py --port 11435
+    python scripts/fake_ollama_server.py --dim 768 --embed-latency-ms 20 --prefill-ms 200 --token-latency-ms 15 --tokens 64
+
+然后以 OLLAMA_BASE_URL=http://127.0.0.1:11435 启动应用。
+"""
+
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from typing import List
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+@dataclass
+class FakeOllamaConfig:
+    """替身服务的延迟和输出配置"""
+    dim: int = 768                    # 嵌入向量维度，需与向量库一致
+    embed_latency_ms: float = 20.0    # 每次嵌入请求的固定延迟
+    embed_per_item_ms: float = 1.0    # 每条输入额外增加的延迟
+    prefill_ms: float = 200.0         # 首个token前的延迟
+    token_latency_ms: float = 15.0    # 每个token的解码延迟
+    tokens: int = 64                  # 每次回答生成的token数
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    """按文本哈希生成确定性的单位向量，同一文本总是得到同一向量"""
+    seed = int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:4], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    vector /= np.linalg.norm(vector)
+    return vector.tolist()
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def _prompt_tokens(messages) -> int:
+    """粗略估计提示词token数（中文按字计）"""
+    return sum(len(str(message.get('content', ''))) for message in messages)
+
+def create_app(config: FakeOllamaConfig = None) -> FastAPI:
+    """创建替身服务应用"""
+    config = config or FakeOllamaConfig()
+    app = FastAPI(title="Fake Ollama")
+    app.state.config = config
+    app.state.requests = {"embed": 0, "chat": 0, "generate": 0}
+
+    def token_at(i: int) -> str:
+        return f"回答{i} "
+
+    async def generate_tokens(prompt_tokens: int, build_chunk):
+        """按配置的预填充和逐token延迟产生流式响应行"""
+        started = time.perf_counter()
+        await asyncio.sleep(config.prefill_ms / 1000)
+        prefill_ns = int((time.perf_counter() - started) * 1e9)
+
+        decode_started = time.perf_counter()
+        for i in range(config.tokens):
+            if i:
+                await asyncio.sleep(config.token_latency_ms / 1000)
+            yield json.dumps(build_chunk(token_at(i), False), ensure_ascii=False) + "\n"
+
+        final = build_chunk("", True)
+        final.update({
+            "done_reason": "stop",
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": prefill_ns,
+            "eval_count": config.tokens,
+            "eval_duration": int((time.perf_counter() - decode_started) * 1e9)
+        })
+        yield json.dumps(final, ensure_ascii=False) + "\n"
+
+    async def respond(body: dict, prompt_tokens: int, build_chunk):
+        lines = generate_tokens(prompt_tokens, build_chunk)
+        if body.get('stream', True):
+            return StreamingResponse(lines, media_type="application/x-ndjson")
+
+        # 非流式：合并所有片段，统计字段取最后一行
+        chunks = [json.loads(line) async for line in lines]
+        merged = chunks[-1]
+        text = "".join(token_at(i) for i in range(config.tokens))
+        if "message" in merged:
+            merged["message"]["content"] = text
+        else:
+            merged["response"] = text
+        return merged
+
+    @app.post("/api/embed")
+    async def embed(request: Request):
+        body = await request.json()
+        inputs = body.get('input', [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        app.state.requests["embed"] += 1
+        await asyncio.sleep((config.embed_latency_ms + config.embed_per_item_ms * len(inputs)) / 1000)
+        return {
+            "model": body.get('model', ''),
+            "embeddings": [fake_embedding(text, config.dim) for text in inputs]
+        }
+
+    @app.post("/api/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        app.state.requests["embed"] += 1
+        await asyncio.sleep((config.embed_latency_ms + config.embed_per_item_ms) / 1000)
+        return {"embedding": fake_embedding(body.get('prompt', ''), config.dim)}
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        body = await request.json()
+        app.state.requests["chat"] += 1
+        model = body.get('model', '')
+
+        def build_chunk(content: str, done: bool) -> dict:
+            return {
+                "model": model,
+                "created_at": _now(),
+                "message": {"role": "assistant", "content": content},
+                "done": done
+            }
+
+        return await respond(body, _prompt_tokens(body.get('messages', [])), build_chunk)
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        app.state.requests["generate"] += 1
+        model = body.get('model', '')
+
+        def build_chunk(content: str, done: bool) -> dict:
+            return {"model": model, "created_at": _now(), "response": content, "done": done}
+
+        return await respond(body, len(body.get('prompt', '')), build_chunk)
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": "fake:latest", "model": "fake:latest", "modified_at": _now(), "size": 0}]}
+
+    @app.post("/api/show")
+    async def show(request: Request):
+        body = await request.json()
+        return {
+            "modelfile": "",
+            "parameters": "",
+            "template": "",
+            "details": {"family": "fake", "parameter_size": "0B"},
+            "model_info": {"general.architecture": "fake", "fake.embedding_length": config.dim},
+            "model": body.get('model', '')
+        }
+
+    @app.get("/stats")
+    async def stats():
+        """替身服务自身的请求计数和当前配置"""
+        return {"config": asdict(config), "requests": app.state.requests}
+
+    return app
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='本地Ollama替身服务')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=11435, help='监听端口')
+    parser.add_argument('--dim', type=int, default=FakeOllamaConfig.dim, help='嵌入向量维度')
+    parser.add_argument('--embed-latency-ms', type=float, default=FakeOllamaConfig.embed_latency_ms, help='嵌入请求固定延迟')
+    parser.add_argument('--embed-per-item-ms', type=float, default=FakeOllamaConfig.embed_per_item_ms, help='每条输入的嵌入延迟')
+    parser.add_argument('--prefill-ms', type=float, default=FakeOllamaConfig.prefill_ms, help='首token延迟')
+    parser.add_argument('--token-latency-ms', type=float, default=FakeOllamaConfig.token_latency_ms, help='每token解码延迟')
+    parser.add_argument('--tokens', type=int, default=FakeOllamaConfig.tokens, help='每次回答的token数')
+
+    args = parser.parse_args()
+
+    config = FakeOllamaConfig(
+        dim=args.dim,
+        embed_latency_ms=args.embed_latency_ms,
+        embed_per_item_ms=args.embed_per_item_ms,
+        prefill_ms=args.prefill_ms,
+        token_latency_ms=args.token_latency_ms,
+        tokens=args.tokens
+    )
+
+    import uvicorn
+    print(f"🚀 Ollama替身服务: http://{args.host}:{args.port} {asdict(config)}")
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,13 +5,30 @@
 """
 
 import os
+import sys
+import re
 import json
+import fnmatch
 import hashlib
 import time
+import uuid
+import tempfile
+import queue
+import shutil
+import sqlite3
+import multiprocessing as mp
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Set, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 from pathlib import Path
 
+import faiss
+import httpx
+import numpy as np
+import psutil
+import xxhash
 from dotenv import load_dotenv
 from langchain_community.document_loaders import (
     DirectoryLoader, 
@@ -20,8 +37,18 @@ from langchain_community.document_loaders import (
     UnstructuredWordDocumentLoader
 )
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import OllamaEmbeddings
+from langchain_ollama import OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.ollama_client import get_ollama_client
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 # 加载环境变量
 load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
@@ -29,17 +56,559 @@ load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__),
 # 定义常量
 KNOWLEDGE_BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'notes'))
 VECTOR_STORE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'vector_store'))
-METADATA_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'update_metadata.json'))
+METADATA_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'update_metadata.db'))
+SCHEDULER_CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'scheduler_config.json'))
 OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL")
 
+# 文件哈希：xxh3_128比MD5快一个数量级，大块读取时hashlib/xxhash都会释放GIL，可多线程并行
+HASH_ALGORITHM = "xxh3_128"
+HASH_BUFFER_SIZE = 1024 * 1024
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(8, os.cpu_count() or 1))))
+# 变更文件的并行加载和分割（Unstructured/PyPDF解析是CPU密集型）
+LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", str(min(4, os.cpu_count() or 1))))
+LOAD_TIMEOUT_SECONDS = float(os.getenv("LOAD_TIMEOUT_SECONDS", "300"))
+# 累计到这么多个新文档块时嵌入并写入向量存储，不等全部文件加载完
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+# mtime距扫描时刻太近的文件，同一时间戳内可能还会被再次写入，不记录mtime_ns，下次扫描重新哈希
+RACY_MTIME_SECONDS = 2.0
+# 索引压缩：索引中没有文档块记录的孤儿向量超过此比例时重建；需要训练的索引（IVF）
+# 自上次重建以来新增和删除的向量数超过此比例时，重建的同时重新训练聚类中心
+COMPACT_ORPHAN_RATIO = float(os.getenv("COMPACT_ORPHAN_RATIO", "0.05"))
+COMPACT_CHURN_RATIO = float(os.getenv("COMPACT_CHURN_RATIO", "0.3"))
+# SQLite的 IN (...) 每批最多绑定的参数个数（旧版本上限为999）
+SQL_BATCH_SIZE = 500
+
+def new_hasher(algorithm: str = HASH_ALGORITHM):
+    """创建哈希对象；md5用于兼容旧版元数据"""
+    if algorithm == "xxh3_128":
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm)
+
+class FileFilter:
+    """知识库文件过滤规则（scheduler_config.json 中的 filters）
+    
+    模式语法同fnmatch，不区分大小写：
+    - 不含 / 的模式匹配文件名或目录名（任意层级），如 "*.tmp"、".*"；
+    - "目录/**" 排除整个目录，目录部分不含 / 时匹配任意层级的同名目录；
+    - 其他含 / 的模式匹配相对知识库根目录的路径。
+    所有模式在初始化时合并编译为正则表达式；目录在遍历时即被剪枝，不再进入。
+    """
+    
+    def __init__(self, include_patterns: Optional[List[str]] = None, exclude_patterns: Optional[List[str]] = None,
+                 min_file_size_bytes: int = 0, max_file_size_mb: Optional[float] = None):
+        name_patterns, path_patterns, dir_name_patterns, dir_path_patterns = [], [], [], []
+        for pattern in exclude_patterns or []:
+            if pattern.endswith('/**'):
+                base = pattern[:-3]
+                (dir_path_patterns if '/' in base else dir_name_patterns).append(base)
+            elif '/' in pattern:
+                path_patterns.append(pattern)
+            else:
+                name_patterns.append(pattern)
+        
+        self.include = self._compile(include_patterns)
+        self.exclude_name = self._compile(name_patterns)
+        self.exclude_path = self._compile(path_patterns)
+        self.exclude_dir_name = self._compile(dir_name_patterns)
+        self.exclude_dir_path = self._compile(dir_path_patterns)
+        self.min_size = min_file_size_bytes or 0
+        self.max_size = max_file_size_mb * 1024 * 1024 if max_file_size_mb else None
+    
+    @classmethod
+    def from_config(cls, filters: Optional[Dict]) -> 'FileFilter':
+        filters = filters or {}
+        return cls(
+            filters.get('include_patterns'),
+            filters.get('exclude_patterns'),
+            filters.get('min_file_size_bytes', 0),
+            filters.get('max_file_size_mb')
+        )
+    
+    @staticmethod
+    def _compile(patterns: Optional[List[str]]):
+        if not patterns:
+            return None
+        return re.compile('|'.join(f'(?:{fnmatch.translate(pattern)})' for pattern in patterns), re.IGNORECASE)
+    
+    @staticmethod
+    def _posix(rel_path: str) -> str:
+        return rel_path.replace(os.sep, '/')
+    
+    def excludes_dir(self, rel_dir: str) -> bool:
+        """目录本身是否被排除（不检查上级目录）"""
+        rel_dir = self._posix(rel_dir)
+        name = rel_dir.rsplit('/', 1)[-1]
+        return bool(
+            (self.exclude_dir_name and self.exclude_dir_name.match(name))
+            or (self.exclude_name and self.exclude_name.match(name))
+            or (self.exclude_dir_path and self.exclude_dir_path.match(rel_dir))
+        )
+    
+    def excludes_tree(self, rel_dir: str) -> bool:
+        """目录本身或任一上级目录是否被排除"""
+        parts = self._posix(rel_dir).split('/')
+        return any(self.excludes_dir('/'.join(parts[:i + 1])) for i in range(len(parts)))
+    
+    def includes_path(self, rel_path: str, check_parents: bool = True) -> bool:
+        """按路径判断文件是否需要入库；遍历时上级目录已剪枝，可跳过上级目录检查"""
+        rel_path = self._posix(rel_path)
+        parts = rel_path.split('/')
+        name = parts[-1]
+        if self.exclude_name and self.exclude_name.match(name):
+            return False
+        if self.exclude_path and self.exclude_path.match(rel_path):
+            return False
+        if check_parents and len(parts) > 1 and self.excludes_tree('/'.join(parts[:-1])):
+            return False
+        if self.include and not (self.include.match(name) or self.include.match(rel_path)):
+            return False
+        return True
+    
+    def includes_size(self, size: int) -> bool:
+        return size >= self.min_size and (self.max_size is None or size <= self.max_size)
+
+def load_file_filter(config_path: str = SCHEDULER_CONFIG_PATH) -> FileFilter:
+    """从调度器配置文件读取过滤规则，读取失败时不过滤"""
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            return FileFilter.from_config(json.load(f).get('filters'))
+    except (OSError, ValueError) as e:
+        print(f"读取文件过滤配置失败: {e}，不过滤文件")
+        return FileFilter()
+
+def lower_process_priority(nice: int = 0, ionice: Optional[str] = None):
+    """降低当前进程的CPU和I/O优先级（加载进程池的初始化函数），ionice 为 idle 或 best_effort"""
+    if nice and hasattr(os, 'nice'):
+        try:
+            os.nice(nice)
+        except OSError as e:
+            print(f"⚠️ 设置nice失败: {e}")
+    if ionice:
+        try:
+            process = psutil.Process()
+            if hasattr(psutil, 'IOPRIO_CLASS_IDLE'):  # Linux
+                if ionice == 'idle':
+                    process.ionice(psutil.IOPRIO_CLASS_IDLE)
+                else:
+                    process.ionice(psutil.IOPRIO_CLASS_BE, value=7)
+            else:  # Windows
+                process.ionice(psutil.IOPRIO_VERYLOW if ionice == 'idle' else psutil.IOPRIO_LOW)
+        except (AttributeError, OSError, psutil.Error) as e:
+            print(f"⚠️ 设置ionice失败: {e}")
+
+class ResourceGovernor:
+    """更新资源调节器，避免与API服务共用机器时嵌入批次挤占服务的CPU、内存和Ollama容量
+    
+    每个嵌入批次写入前调用 wait()：系统CPU或内存占用率、API探测延迟超过阈值时暂停并按指数退避
+    重新检查，累计暂停 max_pause_seconds 后无论如何继续，更新不会被无限期推迟。quiet_hours
+    时段内每个批次后再额外停顿 quiet_pause_seconds。更新进程（含加载子进程）的内存超过
+    max_memory_mb 时，已累积的文档块提前写入，不再等凑满一个批次。
+    """
+    
+    def __init__(self, max_cpu_percent: Optional[float] = None, max_memory_percent: Optional[float] = None,
+                 max_memory_mb: Optional[float] = None, api_url: Optional[str] = None,
+                 max_api_latency_ms: Optional[float] = None, quiet_hours: Optional[Tuple[str, str]] = None,
+                 quiet_pause_seconds: float = 0, max_pause_seconds: float = 300,
+                 worker_nice: int = 0, worker_ionice: Optional[str] = None):
+        self.max_cpu_percent = max_cpu_percent
+        self.max_memory_percent = max_memory_percent
+        self.max_memory_mb = max_memory_mb
+        self.api_url = api_url
+        self.max_api_latency_ms = max_api_latency_ms
+        self.quiet_hours = quiet_hours
+        self.quiet_pause_seconds = quiet_pause_seconds
+        self.max_pause_seconds = max_pause_seconds
+        self.worker_nice = worker_nice
+        self.worker_ionice = worker_ionice
+        self.stats = {'pauses': 0, 'paused_seconds': 0.0, 'last_reason': None}
+        if max_cpu_percent:
+            # 建立CPU占用率的采样起点，之后每次检查取上次检查以来的平均值
+            psutil.cpu_percent(interval=None)
+    
+    @classmethod
+    def from_config(cls, config: Optional[Dict]) -> 'ResourceGovernor':
+        """从调度器配置读取：performance.max_memory_usage_mb、monitoring.alert_thresholds.memory_usage_percent 和 throttling"""
+        config = config or {}
+        throttling = config.get('throttling', {})
+        if not throttling.get('enabled', True):
+            return cls()
+        quiet_hours = throttling.get('quiet_hours') or {}
+        return cls(
+            max_cpu_percent=throttling.get('max_cpu_percent'),
+            max_memory_percent=config.get('monitoring', {}).get('alert_thresholds', {}).get('memory_usage_percent'),
+            max_memory_mb=config.get('performance', {}).get('max_memory_usage_mb'),
+            api_url=throttling.get('api_url'),
+            max_api_latency_ms=throttling.get('max_api_latency_ms'),
+            quiet_hours=(quiet_hours['start'], quiet_hours['end']) if quiet_hours.get('start') else None,
+            quiet_pause_seconds=quiet_hours.get('batch_pause_seconds', 0),
+            max_pause_seconds=throttling.get('max_pause_seconds', 300),
+            worker_nice=throttling.get('worker_nice', 0),
+            worker_ionice=throttling.get('worker_ionice')
+        )
+    
+    def in_quiet_hours(self, now: Optional[datetime] = None) -> bool:
+        """当前是否在 quiet_hours 时段内（支持跨午夜，如 22:00-06:00）"""
+        if not self.quiet_hours:
+            return False
+        current = (now or datetime.now()).strftime('%H:%M')
+        start, end = self.quiet_hours
+        if start <= end:
+            return start <= current < end
+        return current >= start or current < end
+    
+    def process_memory_mb(self) -> float:
+        """更新进程及其子进程的常驻内存（MB）"""
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss / (1024 * 1024)
+    
+    def over_memory_limit(self) -> bool:
+        return bool(self.max_memory_mb) and self.process_memory_mb() > self.max_memory_mb
+    
+    def api_latency_ms(self) -> Optional[float]:
+        """探测API服务的响应延迟；服务未运行时返回None，超时按超时时间计"""
+        timeout = max(1.0, 4 * self.max_api_latency_ms / 1000)
+        started = time.perf_counter()
+        try:
+            httpx.get(self.api_url, timeout=timeout)
+        except httpx.TimeoutException:
+            return timeout * 1000
+        except httpx.HTTPError:
+            return None
+        return (time.perf_counter() - started) * 1000
+    
+    def pressure(self) -> Optional[str]:
+        """超过阈值的资源，没有时返回None"""
+        if self.max_cpu_percent:
+            cpu = psutil.cpu_percent(interval=None)
+            if cpu > self.max_cpu_percent:
+                return f"CPU {cpu:.0f}%"
+        if self.max_memory_percent:
+            memory = psutil.virtual_memory().percent
+            if memory > self.max_memory_percent:
+                return f"内存 {memory:.0f}%"
+        if self.api_url and self.max_api_latency_ms:
+            latency = self.api_latency_ms()
+            if latency is not None and latency > self.max_api_latency_ms:
+                return f"API延迟 {latency:.0f}ms"
+        return None
+    
+    def wait(self):
+        """在写入下一个嵌入批次前调用，资源紧张时暂停"""
+        paused, delay = 0.0, 1.0
+        reason = self.pressure()
+        if reason:
+            self.stats['pauses'] += 1
+            self.stats['last_reason'] = reason
+            print(f"⏸️ 资源紧张（{reason}），暂停嵌入...")
+        while reason and paused < self.max_pause_seconds:
+            pause = min(delay, self.max_pause_seconds - paused)
+            time.sleep(pause)
+            paused += pause
+            delay = min(delay * 2, 30)
+            reason = self.pressure()
+        if paused:
+            if reason:
+                print(f"⚠️ 已暂停 {paused:.0f} 秒，资源仍紧张（{reason}），继续嵌入")
+            else:
+                print(f"▶️ 资源恢复，暂停 {paused:.0f} 秒后继续嵌入")
+        if self.quiet_pause_seconds and self.in_quiet_hours():
+            time.sleep(self.quiet_pause_seconds)
+            paused += self.quiet_pause_seconds
+        self.stats['paused_seconds'] += paused
+
+def load_resource_governor(config_path: str = SCHEDULER_CONFIG_PATH) -> ResourceGovernor:
+    """从调度器配置文件读取资源限制，读取失败时不限制"""
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            return ResourceGovernor.from_config(json.load(f))
+    except (OSError, ValueError) as e:
+        print(f"读取资源限制配置失败: {e}，不限制更新占用的资源")
+        return ResourceGovernor()
+
+@contextmanager
+def file_lock(path: str):
+    """跨进程互斥锁，防止调度器和手动执行的更新脚本同时修改向量存储和元数据"""
+    with open(path, 'a+') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("⏳ 其他进程正在更新知识库，等待其完成...")
+                fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            # 锁定首字节；被占用时每秒重试，10次后抛出OSError
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def load_and_split(loader, text_splitter, rel_path: str, file_info: Dict) -> List:
+    """加载单个文件并分割为文档块（在加载进程中执行）"""
+    documents = loader(file_info['full_path']).load()
+    
+    # 为文档添加元数据
+    for doc in documents:
+        doc.metadata.update({
+            'file_path': rel_path,
+            'file_hash': file_info['hash'],
+            'file_size': file_info['size'],
+            'last_modified': file_info['mtime']
+        })
+    
+    return text_splitter.split_documents(documents)
+
+def retrainable_ivf(index):
+    """可用已存储的向量重新训练的IVF索引，不可训练时返回None
+
+    只有IVFFlat按原值保存向量；PQ/SQ编码或带PCA/OPQ预变换的索引取回的是旧量化器解码后的近似值，
+    用它们重新训练只会保留原有的量化误差。
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None or not isinstance(faiss.downcast_index(index), faiss.IndexIVF):
+        return None
+    if ivf.code_size != ivf.d * np.dtype(np.float32).itemsize:
+        return None
+    return ivf
+
+def chunk_hash(chunk) -> str:
+    """文档块内容哈希；PDF按页加载，页码一并计入"""
+    hasher = xxhash.xxh3_128()
+    hasher.update(f"{chunk.metadata.get('page', '')}\0{chunk.page_content}".encode('utf-8'))
+    return hasher.hexdigest()
+
+class MetadataStore:
+    """更新元数据存储（SQLite，WAL模式）
+    
+    files 表记录已入库文件的哈希和stat信息（hash为NULL表示上次加载失败、等待重试），
+    chunks 表记录每个文件写入向量存储的文档块ID和内容哈希，index_versions 表在每次更新
+    向量存储后追加一行。每次更新只在一个事务中改写变更文件对应的行，不再整体重写元数据。
+    首次打开时自动导入旧版的 update_metadata.json。
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            hash TEXT,
+            algorithm TEXT NOT NULL,
+            size INTEGER,
+            mtime REAL,
+            mtime_ns INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS files_pending ON files (path) WHERE hash IS NULL;
+        CREATE TABLE IF NOT EXISTS chunks (
+            id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            hash TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path, position);
+        CREATE TABLE IF NOT EXISTS index_versions (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            force_rebuild INTEGER NOT NULL DEFAULT 0,
+            total_documents INTEGER NOT NULL,
+            total_chunks INTEGER NOT NULL,
+            embedded INTEGER NOT NULL DEFAULT 0,
+            removed INTEGER NOT NULL DEFAULT 0,
+            kind TEXT NOT NULL DEFAULT 'update'
+        );
+    """
+    FILE_COLUMNS = ('hash', 'algorithm', 'size', 'mtime', 'mtime_ns')
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.legacy_path = os.path.splitext(path)[0] + '.json'
+        is_new = not os.path.exists(path)
+        with self.connect() as conn:
+            conn.executescript(self.SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(index_versions)")}
+            if 'kind' not in columns:
+                conn.execute("ALTER TABLE index_versions ADD COLUMN kind TEXT NOT NULL DEFAULT 'update'")
+        if is_new and os.path.exists(self.legacy_path):
+            self.migrate_json()
+    
+    @contextmanager
+    def connect(self):
+        """打开连接并开启一个事务，正常退出时提交、异常时回滚"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def _batches(paths):
+        paths = list(paths)
+        for start in range(0, len(paths), SQL_BATCH_SIZE):
+            batch = paths[start:start + SQL_BATCH_SIZE]
+            yield batch, ','.join('?' * len(batch))
+    
+    def file_records(self, paths=None) -> Dict[str, Dict]:
+        """读取文件记录；paths 为None时读取全部"""
+        query = f"SELECT path, {', '.join(self.FILE_COLUMNS)} FROM files"
+        records = {}
+        with self.connect() as conn:
+            if paths is None:
+                rows = conn.execute(query).fetchall()
+            else:
+                rows = []
+                for batch, marks in self._batches(paths):
+                    rows.extend(conn.execute(f"{query} WHERE path IN ({marks})", batch).fetchall())
+        for row in rows:
+            records[row[0]] = dict(zip(self.FILE_COLUMNS, row[1:]))
+        return records
+    
+    def paths_under(self, rel_dir: str) -> Set[str]:
+        """记录中位于目录下的文件（按主键范围查询）"""
+        prefix = rel_dir + os.sep
+        upper = rel_dir + chr(ord(os.sep) + 1)
+        with self.connect() as conn:
+            rows = conn.execute("SELECT path FROM files WHERE path >= ? AND path < ?", (prefix, upper)).fetchall()
+        return {row[0] for row in rows}
+    
+    def pending_paths(self) -> Set[str]:
+        """上次加载失败、等待重试的文件"""
+        with self.connect() as conn:
+            rows = conn.execute("SELECT path FROM files WHERE hash IS NULL").fetchall()
+        return {row[0] for row in rows}
+    
+    def chunk_records(self, paths) -> Dict[str, List[Dict]]:
+        """读取文件的文档块记录（按文件内顺序）"""
+        records = {}
+        with self.connect() as conn:
+            for batch, marks in self._batches(paths):
+                rows = conn.execute(
+                    f"SELECT path, id, hash FROM chunks WHERE path IN ({marks}) ORDER BY path, position", batch
+                ).fetchall()
+                for path, chunk_id, digest in rows:
+                    records.setdefault(path, []).append({'id': chunk_id, 'hash': digest})
+        return records
+    
+    def chunk_ids(self) -> Set[str]:
+        """全部已记录的文档块ID"""
+        with self.connect() as conn:
+            return {row[0] for row in conn.execute("SELECT id FROM chunks")}
+    
+    def churn_since_rebuild(self) -> int:
+        """上次重建或压缩索引以来，增量更新新嵌入和删除的文档块总数"""
+        with self.connect() as conn:
+            return conn.execute(
+                "SELECT COALESCE(SUM(embedded + removed), 0) FROM index_versions WHERE version > "
+                "(SELECT COALESCE(MAX(version), 0) FROM index_versions WHERE kind IN ('rebuild', 'compact'))"
+            ).fetchone()[0]
+    
+    def latest_version(self) -> Optional[Dict]:
+        """最近一次更新向量存储的记录；没有时返回None（向量存储的文档块未被记录过）"""
+        with self.connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM index_versions ORDER BY version DESC LIMIT 1").fetchone()
+        return dict(row) if row else None
+    
+    def apply(self, file_records: Dict[str, Dict], removed_files=(), chunk_records: Optional[Dict[str, List[Dict]]] = None,
+              version: Optional[Dict] = None, replace: bool = False) -> Dict:
+        """在一个事务中写入变更
+        
+        file_records 为需要新增或改写的文件记录，removed_files 的文件记录和文档块一并删除，
+        chunk_records 中的文件整体替换其文档块记录。version 不为None时追加一条索引版本记录
+        （kind 为 update、rebuild 或 compact，默认按 force_rebuild 取前两者）。
+        replace=True 时先清空全部记录（强制重建）。返回写入后的文件数和文档块数。
+        """
+        with self.connect() as conn:
+            if replace:
+                conn.execute("DELETE FROM files")
+                conn.execute("DELETE FROM chunks")
+            for batch, marks in self._batches(removed_files):
+                conn.execute(f"DELETE FROM files WHERE path IN ({marks})", batch)
+                conn.execute(f"DELETE FROM chunks WHERE path IN ({marks})", batch)
+            conn.executemany(
+                f"INSERT OR REPLACE INTO files (path, {', '.join(self.FILE_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, *(record.get(key) for key in self.FILE_COLUMNS)) for path, record in file_records.items()]
+            )
+            for path, records in (chunk_records or {}).items():
+                conn.execute("DELETE FROM chunks WHERE path = ?", (path,))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO chunks (id, path, position, hash) VALUES (?, ?, ?, ?)",
+                    [(record['id'], path, position, record['hash']) for position, record in enumerate(records)]
+                )
+            totals = {
+                'total_documents': conn.execute("SELECT COUNT(*) FROM files").fetchone()[0],
+                'total_chunks': conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            }
+            if version is not None:
+                conn.execute(
+                    "INSERT INTO index_versions (created_at, force_rebuild, total_documents, total_chunks, embedded, removed, kind) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (version.get('created_at') or datetime.now().isoformat(), int(version.get('force_rebuild', False)),
+                     totals['total_documents'], totals['total_chunks'],
+                     version.get('embedded', 0), version.get('removed', 0),
+                     version.get('kind') or ('rebuild' if version.get('force_rebuild') else 'update'))
+                )
+        return totals
+    
+    def import_metadata(self, metadata: Dict):
+        """用旧版JSON格式的元数据整体替换当前记录"""
+        file_records = {
+            path: {key: entry.get(key) for key in self.FILE_COLUMNS}
+            for path, entry in IncrementalUpdater.normalize_file_entries(metadata.get('file_hashes')).items()
+        }
+        file_chunks = metadata.get('file_chunks')
+        # 旧版中有文档块记录、但没有文件记录的文件是加载失败待重试的文件
+        for path in set(file_chunks or {}) - set(file_records):
+            file_records[path] = {'hash': None, 'algorithm': HASH_ALGORITHM}
+        version = None
+        if file_chunks is not None:
+            version = {'created_at': metadata.get('last_update')}
+        self.apply(file_records, chunk_records=file_chunks, version=version, replace=True)
+    
+    def migrate_json(self):
+        """导入旧版 update_metadata.json，导入后重命名为 .bak，避免再次导入过期的记录"""
+        with open(self.legacy_path, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        self.import_metadata(metadata)
+        os.replace(self.legacy_path, f"{self.legacy_path}.bak")
+        print(f"已将 {self.legacy_path} 迁移到 {self.path}")
+    
+    def load(self) -> Dict:
+        """以旧版JSON的结构返回全部元数据（用于查看和测试）"""
+        records = self.file_records()
+        latest = self.latest_version()
+        metadata = {
+            'last_update': latest['created_at'] if latest else None,
+            'file_hashes': {path: record for path, record in records.items() if record['hash'] is not None},
+            'total_documents': len(records),
+            'total_chunks': 0
+        }
+        if latest is not None:
+            metadata['file_chunks'] = self.chunk_records(records)
+            metadata['total_chunks'] = sum(len(chunks) for chunks in metadata['file_chunks'].values())
+        return metadata
+
 class IncrementalUpdater:
     """增量更新器"""
     
-    def __init__(self):
+    def __init__(self, filters: Optional[Dict] = None, compaction: Optional[Dict] = None,
+                 governor: Optional[ResourceGovernor] = None):
+        """filters、compaction 为 scheduler_config.json 中的对应配置；filters 和 governor 为None时从默认配置文件读取"""
         self.knowledge_base_path = KNOWLEDGE_BASE_PATH
         self.vector_store_path = VECTOR_STORE_PATH
         self.metadata_path = METADATA_PATH
-        self.embeddings = OllamaEmbeddings(model=OLLAMA_EMBEDDING_MODEL)
+        ollama_client = get_ollama_client()
+        self.embeddings = ollama_client.bind(OllamaEmbeddings(model=OLLAMA_EMBEDDING_MODEL, base_url=ollama_client.base_url))
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=1000,
             chunk_overlap=200,
@@ -53,63 +622,146 @@ class IncrementalUpdater:
             '.docx': UnstructuredWordDocumentLoader,
             '.doc': UnstructuredWordDocumentLoader
         }
+        self.file_filter = load_file_filter() if filters is None else FileFilter.from_config(filters)
+        self._metadata_store = None
+        self.governor = load_resource_governor() if governor is None else governor
+        compaction = compaction or {}
+        self.compact_orphan_ratio = compaction.get('orphan_ratio', COMPACT_ORPHAN_RATIO)
+        self.compact_churn_ratio = compaction.get('churn_ratio', COMPACT_CHURN_RATIO)
+    
+    def is_indexed_file(self, rel_path: str, check_parents: bool = True) -> bool:
+        """文件类型受支持且未被过滤规则排除"""
+        return (os.path.splitext(rel_path)[1].lower() in self.file_loaders
+                and self.file_filter.includes_path(rel_path, check_parents))
+    
+    def walk_files(self, top: str) -> List[str]:
+        """遍历目录，返回需要入库的文件的相对路径；被排除的目录不会进入"""
+        rel_paths = []
+        for root, dirs, files in os.walk(top):
+            rel_root = os.path.relpath(root, self.knowledge_base_path)
+            rel_root = '' if rel_root == os.curdir else rel_root
+            dirs[:] = [d for d in dirs if not self.file_filter.excludes_dir(os.path.join(rel_root, d))]
+            for file in files:
+                rel_path = os.path.join(rel_root, file)
+                if self.is_indexed_file(rel_path, check_parents=False):
+                    rel_paths.append(rel_path)
+        return rel_paths
+    
+    @property
+    def metadata_store(self) -> MetadataStore:
+        """元数据存储，首次使用时打开（metadata_path 变化时重新打开）"""
+        if self._metadata_store is None or self._metadata_store.path != self.metadata_path:
+            self._metadata_store = MetadataStore(self.metadata_path)
+        return self._metadata_store
     
     def load_metadata(self) -> Dict:
-        """加载元数据"""
-        if os.path.exists(self.metadata_path):
-            with open(self.metadata_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {
-            'last_update': None,
-            'file_hashes': {},
-            'total_documents': 0,
-            'total_chunks': 0
-        }
+        """加载全部元数据（旧版JSON结构）"""
+        return self.metadata_store.load()
     
     def save_metadata(self, metadata: Dict):
-        """保存元数据"""
-        with open(self.metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        """用旧版JSON结构的元数据整体替换记录"""
+        self.metadata_store.import_metadata(metadata)
     
-    def calculate_file_hash(self, file_path: str) -> str:
+    def calculate_file_hash(self, file_path: str, algorithm: str = HASH_ALGORITHM) -> str:
         """计算文件哈希值"""
-        hash_md5 = hashlib.md5()
+        hasher = new_hasher(algorithm)
         try:
             with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
+                for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b""):
+                    hasher.update(chunk)
+            return hasher.hexdigest()
         except Exception as e:
             print(f"计算文件哈希失败 {file_path}: {e}")
             return ""
     
-    def scan_documents(self) -> Dict[str, Dict]:
+    @staticmethod
+    def normalize_file_entries(file_hashes: Dict) -> Dict[str, Dict]:
+        """统一元数据中的文件记录格式；旧版只保存了MD5字符串"""
+        return {
+            path: entry if isinstance(entry, dict) else {'hash': entry, 'algorithm': 'md5'}
+            for path, entry in (file_hashes or {}).items()
+        }
+    
+    def scan_documents(self, previous: Optional[Dict] = None) -> Dict[str, Dict]:
         """扫描文档目录，返回文件信息"""
+        return self.scan_files(self.walk_files(self.knowledge_base_path), previous)
+    
+    def scan_files(self, rel_paths, previous: Optional[Dict] = None) -> Dict[str, Dict]:
+        """获取指定文件的信息，不存在、不支持或被过滤规则排除的文件不出现在结果中
+        
+        previous 为上次保存的文件记录。大小和mtime_ns都未变化的文件直接沿用记录中的哈希，
+        只有stat变化的文件才读取内容，并在线程池中并行计算哈希。
+        """
+        previous = self.normalize_file_entries(previous)
         file_info = {}
+        to_hash = []
+        racy_before_ns = time.time_ns() - int(RACY_MTIME_SECONDS * 1e9)
         
-        for root, dirs, files in os.walk(self.knowledge_base_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_ext = os.path.splitext(file)[1].lower()
-                
-                if file_ext in self.file_loaders:
-                    rel_path = os.path.relpath(file_path, self.knowledge_base_path)
-                    file_hash = self.calculate_file_hash(file_path)
-                    file_stat = os.stat(file_path)
-                    
-                    file_info[rel_path] = {
-                        'hash': file_hash,
-                        'size': file_stat.st_size,
-                        'mtime': file_stat.st_mtime,
-                        'extension': file_ext,
-                        'full_path': file_path
-                    }
+        for rel_path in rel_paths:
+            file_path = os.path.join(self.knowledge_base_path, rel_path)
+            file_ext = os.path.splitext(rel_path)[1].lower()
+            if not self.is_indexed_file(rel_path):
+                continue
+            try:
+                file_stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                print(f"读取文件信息失败 {file_path}: {e}")
+                continue
+            if not os.path.isfile(file_path) or not self.file_filter.includes_size(file_stat.st_size):
+                continue
+            
+            info = {
+                'hash': None,
+                'algorithm': HASH_ALGORITHM,
+                'size': file_stat.st_size,
+                'mtime': file_stat.st_mtime,
+                'mtime_ns': file_stat.st_mtime_ns if file_stat.st_mtime_ns < racy_before_ns else None,
+                'extension': file_ext,
+                'full_path': file_path
+            }
+            old = previous.get(rel_path)
+            if (old and old.get('hash') and old.get('algorithm') == HASH_ALGORITHM
+                    and old.get('size') == info['size'] and old.get('mtime_ns') is not None
+                    and old.get('mtime_ns') == file_stat.st_mtime_ns):
+                info['hash'] = old['hash']
+            else:
+                to_hash.append(rel_path)
+            file_info[rel_path] = info
+        
+        if to_hash:
+            with ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="file-hash") as executor:
+                hashes = executor.map(lambda path: self.calculate_file_hash(file_info[path]['full_path']), to_hash)
+                for rel_path, file_hash in zip(to_hash, hashes):
+                    file_info[rel_path]['hash'] = file_hash
+                    if not file_hash:
+                        # 哈希失败时不记录stat，下次扫描重试
+                        file_info[rel_path]['mtime_ns'] = None
         
         return file_info
     
-    def detect_changes(self, current_files: Dict, metadata: Dict) -> Tuple[Set[str], Set[str], Set[str]]:
-        """检测文件变更"""
-        old_hashes = metadata.get('file_hashes', {})
+    def expand_changed_paths(self, changes) -> Set[str]:
+        """把监控到的变更路径展开为需要重新检查的文件
+        
+        目录创建或移入时遍历其中的文件；目录删除或移出时取记录中位于该目录下的文件。
+        """
+        paths = set()
+        for rel_path, event_type in changes:
+            rel_path = os.path.normpath(rel_path)
+            full_path = os.path.join(self.knowledge_base_path, rel_path)
+            if os.path.isdir(full_path):
+                if not self.file_filter.excludes_tree(rel_path):
+                    paths.update(self.walk_files(full_path))
+            elif os.path.splitext(rel_path)[1].lower() in self.file_loaders:
+                paths.add(rel_path)
+            else:
+                paths.update(self.metadata_store.paths_under(rel_path))
+        return paths
+    
+    def detect_changes(self, current_files: Dict, previous: Dict) -> Tuple[Set[str], Set[str], Set[str]]:
+        """检测文件变更；previous 为上次保存的文件记录（加载失败待重试的文件哈希为None，视为修改）"""
+        old_hashes = self.normalize_file_entries(previous)
         
         # 新增文件
         added_files = set(current_files.keys()) - set(old_hashes.keys())
@@ -120,65 +772,201 @@ class IncrementalUpdater:
         # 修改文件
         modified_files = set()
         for file_path in set(current_files.keys()) & set(old_hashes.keys()):
-            if current_files[file_path]['hash'] != old_hashes[file_path]['hash']:
+            old = old_hashes[file_path]
+            current_hash = current_files[file_path]['hash']
+            if old.get('algorithm', 'md5') != current_files[file_path].get('algorithm', HASH_ALGORITHM):
+                # 旧版元数据使用其他哈希算法，按旧算法重新计算一次再比较
+                current_hash = self.calculate_file_hash(current_files[file_path]['full_path'], old.get('algorithm', 'md5'))
+            if current_hash != old.get('hash'):
                 modified_files.add(file_path)
         
         return added_files, modified_files, deleted_files
     
-    def load_document(self, file_path: str, file_ext: str) -> List:
-        """加载单个文档"""
+    @staticmethod
+    def file_records(current_files: Dict) -> Dict[str, Dict]:
+        """需要持久化的文件记录（哈希及用于快速比对的stat信息）"""
+        return {
+            path: {key: info.get(key) for key in ('hash', 'algorithm', 'size', 'mtime', 'mtime_ns')}
+            for path, info in current_files.items()
+        }
+    
+    def load_file_chunks(self, rel_path: str, file_info: Dict) -> Optional[List]:
+        """在当前进程中加载并分割单个文件，失败时返回None（与没有内容的文件返回的空列表区分）"""
         try:
-            loader_class = self.file_loaders[file_ext]
-            loader = loader_class(file_path)
-            return loader.load()
+            return load_and_split(self.file_loaders[file_info['extension']], self.text_splitter, rel_path, file_info)
         except Exception as e:
-            print(f"加载文档失败 {file_path}: {e}")
-            return []
+            print(f"加载文档失败 {file_info['full_path']}: {e}")
+            return None
+    
+    def process_documents(self, file_paths: List[str], current_files: Dict):
+        """加载并分割变更文件，按完成顺序逐个产出 (相对路径, 文档块列表)
+        
+        多个文件时在进程池中并行解析，每个文件最多 LOAD_TIMEOUT_SECONDS 秒；超时或失败的
+        文件产出None。单个文件或 LOAD_WORKERS<=1 时在当前进程中加载，不受超时限制。
+        """
+        if LOAD_WORKERS <= 1 or len(file_paths) <= 1:
+            for rel_path in file_paths:
+                chunks = self.load_file_chunks(rel_path, current_files[rel_path])
+                if chunks is not None:
+                    print(f"处理文档: {rel_path} ({len(chunks)} 个文档块)")
+                yield rel_path, chunks
+            return
+        
+        yield from self._process_documents_parallel(file_paths, current_files)
     
-    def process_documents(self, file_paths: List[str], current_files: Dict) -> List:
-        """处理文档列表"""
-        all_documents = []
+    def _process_documents_parallel(self, file_paths: List[str], current_files: Dict):
+        # 同时提交的文件数不超过进程数，提交时刻即开始处理的时刻，可据此计算超时
+        num_workers = min(LOAD_WORKERS, len(file_paths))
+        ctx = mp.get_context("spawn")
+        results = queue.Queue()
+        waiting = deque(file_paths)
+        in_flight: Dict[str, float] = {}
+        
+        def new_pool():
+            # 加载进程以较低的CPU和I/O优先级运行，不与服务进程争抢
+            return ctx.Pool(num_workers, initializer=lower_process_priority,
+                            initargs=(self.governor.worker_nice, self.governor.worker_ionice), maxtasksperchild=50)
+        
+        pool = new_pool()
         
-        for rel_path in file_paths:
+        def submit(rel_path: str):
             file_info = current_files[rel_path]
-            full_path = file_info['full_path']
-            file_ext = file_info['extension']
-            
-            print(f"处理文档: {rel_path}")
-            documents = self.load_document(full_path, file_ext)
-            
-            # 为文档添加元数据
-            for doc in documents:
-                doc.metadata.update({
-                    'file_path': rel_path,
-                    'file_hash': file_info['hash'],
-                    'file_size': file_info['size'],
-                    'last_modified': file_info['mtime']
-                })
-            
-            all_documents.extend(documents)
+            pool.apply_async(
+                load_and_split,
+                (self.file_loaders[file_info['extension']], self.text_splitter, rel_path, file_info),
+                callback=lambda chunks: results.put((rel_path, chunks, None)),
+                error_callback=lambda error: results.put((rel_path, None, error))
+            )
+            in_flight[rel_path] = time.time() + LOAD_TIMEOUT_SECONDS
         
-        return all_documents
+        try:
+            while waiting or in_flight:
+                while waiting and len(in_flight) < num_workers:
+                    submit(waiting.popleft())
+                
+                timeout = max(0.0, min(in_flight.values()) - time.time())
+                try:
+                    rel_path, chunks, error = results.get(timeout=timeout)
+                except queue.Empty:
+                    pass
+                else:
+                    # 超时后被终止的任务可能仍有结果到达，忽略
+                    if in_flight.pop(rel_path, None) is not None:
+                        if error is not None:
+                            print(f"加载文档失败 {current_files[rel_path]['full_path']}: {error}")
+                            chunks = None
+                        else:
+                            print(f"处理文档: {rel_path} ({len(chunks)} 个文档块)")
+                        yield rel_path, chunks
+                    continue
+                
+                now = time.time()
+                expired = [path for path, deadline in in_flight.items() if deadline <= now]
+                if not expired:
+                    continue
+                # 无法单独终止某个任务：终止整个进程池，其余进行中的文件重新排队
+                for rel_path in expired:
+                    del in_flight[rel_path]
+                    print(f"⚠️ 加载文档超时（{LOAD_TIMEOUT_SECONDS:.0f}s），跳过: {rel_path}")
+                waiting.extendleft(in_flight)
+                in_flight.clear()
+                pool.terminate()
+                pool = new_pool()
+                for rel_path in expired:
+                    yield rel_path, None
+        finally:
+            pool.terminate()
     
     def load_existing_vector_store(self):
         """加载现有向量存储"""
         try:
             if os.path.exists(self.vector_store_path):
-                return FAISS.load_local(self.vector_store_path, self.embeddings)
+                # 向量存储由本项目生成，可以安全反序列化
+                return FAISS.load_local(self.vector_store_path, self.embeddings, allow_dangerous_deserialization=True)
             return None
         except Exception as e:
             print(f"加载向量存储失败: {e}")
             return None
     
-    def remove_documents_from_vector_store(self, vector_store, file_paths: Set[str]):
-        """从向量存储中删除文档（模拟实现）"""
-        # 注意：FAISS不直接支持删除，这里提供一个概念性实现
-        # 实际应用中可能需要重建向量存储或使用支持删除的向量数据库
-        print(f"需要删除的文档: {file_paths}")
-        print("警告: FAISS不支持直接删除，建议使用支持删除操作的向量数据库")
+    def chunks_in_vector_store(self, vector_store, file_paths: Set[str]) -> Dict[str, List[Dict]]:
+        """在向量存储中查找文件的文档块记录
+        
+        用于元数据中还没有 file_chunks 的旧向量存储（例如由ingest.py生成）：
+        按文档元数据中的 file_path 或 source 匹配，并计算内容哈希。
+        """
+        records = {path: [] for path in file_paths}
+        docstore = getattr(getattr(vector_store, 'docstore', None), '_dict', None)
+        if not docstore or not file_paths:
+            return records
+        for doc_id, doc in docstore.items():
+            path = doc.metadata.get('file_path')
+            if path is None and doc.metadata.get('source'):
+                path = os.path.relpath(doc.metadata['source'], self.knowledge_base_path)
+            if path in records:
+                records[path].append({'id': doc_id, 'hash': chunk_hash(doc)})
+        return records
+    
+    def old_chunk_records(self, legacy_store, file_paths: Set[str]) -> Dict[str, List[Dict]]:
+        """文件上次写入向量存储的文档块记录；legacy_store 不为None时在其中查找没有记录的文件"""
+        records = self.metadata_store.chunk_records(file_paths)
+        missing = set(file_paths) - set(records)
+        if missing and legacy_store is not None:
+            records.update(self.chunks_in_vector_store(legacy_store, missing))
+        return records
+    
+    def diff_chunks(self, chunks: List, old_records: Dict[str, List[Dict]]) -> Tuple[List, List[str], List[str], Dict[str, List[Dict]], Dict[str, Any]]:
+        """比较文件新旧文档块
+        
+        返回 (需要嵌入的新块, 新块ID, 需要删除的旧块ID, 每个文件的新文档块记录, 沿用的ID到新文档块)。
+        内容哈希相同的块沿用原ID，不重新嵌入；重复的块按出现次数逐一匹配。
+        old_records 中没有得到任何文档块的文件记录为空列表。
+        """
+        new_chunks, new_ids, reused = [], [], {}
+        new_records = {path: [] for path in old_records}
+        reusable = {}
+        for path, records in old_records.items():
+            for record in records:
+                reusable.setdefault((path, record['hash']), []).append(record['id'])
+        
+        for chunk in chunks:
+            path = chunk.metadata['file_path']
+            digest = chunk_hash(chunk)
+            chunk.metadata['chunk_hash'] = digest
+            matches = reusable.get((path, digest))
+            if matches:
+                chunk_id = matches.pop(0)
+                reused[chunk_id] = chunk
+            else:
+                chunk_id = str(uuid.uuid4())
+                new_chunks.append(chunk)
+                new_ids.append(chunk_id)
+            new_records.setdefault(path, []).append({'id': chunk_id, 'hash': digest})
+        
+        removed_ids = [chunk_id for ids in reusable.values() for chunk_id in ids]
+        return new_chunks, new_ids, removed_ids, new_records, reused
+    
+    def refresh_reused_documents(self, vector_store, reused: Dict[str, Any]):
+        """沿用的文档块向量不变，但文件哈希、修改时间和在文件中的位置等元数据换成本次加载的值"""
+        docstore = getattr(getattr(vector_store, 'docstore', None), '_dict', None)
+        if docstore is None:
+            return
+        for chunk_id, chunk in reused.items():
+            if chunk_id in docstore:
+                chunk.id = chunk_id
+                docstore[chunk_id] = chunk
+    
+    def remove_documents_from_vector_store(self, vector_store, chunk_ids: List[str]):
+        """按文档块ID从向量存储中删除"""
+        if vector_store is None or not chunk_ids:
+            return vector_store
+        stored_ids = set(vector_store.index_to_docstore_id.values())
+        existing = [chunk_id for chunk_id in chunk_ids if chunk_id in stored_ids]
+        if existing:
+            print(f"从向量存储删除 {len(existing)} 个文档块...")
+            vector_store.delete(existing)
         return vector_store
     
-    def update_vector_store(self, vector_store, new_chunks: List, operation: str = "add"):
+    def update_vector_store(self, vector_store, new_chunks: List, ids: Optional[List[str]] = None):
         """更新向量存储"""
         if not new_chunks:
             return vector_store
@@ -187,28 +975,173 @@ class IncrementalUpdater:
             if vector_store is None:
                 # 创建新的向量存储
                 print("创建新的向量存储...")
-                return FAISS.from_documents(new_chunks, self.embeddings)
+                return FAISS.from_documents(new_chunks, self.embeddings, ids=ids)
             else:
                 # 添加新文档到现有向量存储
                 print(f"向现有向量存储添加 {len(new_chunks)} 个文档块...")
-                new_vector_store = FAISS.from_documents(new_chunks, self.embeddings)
+                new_vector_store = FAISS.from_documents(new_chunks, self.embeddings, ids=ids)
                 vector_store.merge_from(new_vector_store)
                 return vector_store
         except Exception as e:
             print(f"更新向量存储失败: {e}")
-            return vector_store
+            raise
+    
+    def publish_vector_store(self, vector_store):
+        """保存向量存储并替换发布目录
+        
+        先完整写入同级的临时目录，再用两次rename换下旧目录，服务进程加载时不会读到写了一半、
+        或新旧混杂的 index.faiss/index.pkl（两次rename之间目录短暂不存在，加载会失败而不是读到错误的索引）。
+        """
+        parent = os.path.dirname(os.path.abspath(self.vector_store_path))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.vector_store-', dir=parent)
+        retired = None
+        try:
+            os.chmod(staging, 0o755)
+            vector_store.save_local(staging)
+            if os.path.exists(self.vector_store_path):
+                retired = f"{staging}.old"
+                os.rename(self.vector_store_path, retired)
+            os.rename(staging, self.vector_store_path)
+        except Exception:
+            if retired and not os.path.exists(self.vector_store_path):
+                os.rename(retired, self.vector_store_path)
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if retired:
+            shutil.rmtree(retired, ignore_errors=True)
+    
+    def index_health(self, vector_store) -> Dict:
+        """向量索引状态
+        
+        orphans 为索引中没有文档块记录的向量（更新中断、旧版向量存储遗留等，会被检索到但不再对应任何文件），
+        missing 为有记录但不在索引中的文档块，churn 为上次重建或压缩以来新嵌入和删除的文档块数。
+        trainable 表示能否用已存储的向量重新训练（见 retrainable_ivf）。
+        """
+        recorded = self.metadata_store.chunk_ids()
+        indexed = set(vector_store.index_to_docstore_id.values())
+        return {
+            'vectors': vector_store.index.ntotal,
+            'orphans': len(indexed - recorded),
+            'missing': len(recorded - indexed),
+            'trainable': retrainable_ivf(vector_store.index) is not None,
+            'churn': self.metadata_store.churn_since_rebuild()
+        }
+    
+    def rebuild_index(self, vector_store, retrain: bool = False):
+        """用索引中已存储的向量重建向量存储（不调用嵌入模型），只保留有文档块记录的向量
+        
+        新索引与原索引类型和参数相同；retrain 时对IVFFlat索引用保留的向量重新训练聚类中心，
+        有损编码的索引不重新训练，沿用原量化器。
+        """
+        recorded = self.metadata_store.chunk_ids()
+        index = vector_store.index
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            # IVF索引按位置取回向量需要直接映射
+            ivf.make_direct_map()
+        positions = [position for position, doc_id in sorted(vector_store.index_to_docstore_id.items())
+                     if doc_id in recorded]
+        doc_ids = [vector_store.index_to_docstore_id[position] for position in positions]
+        vectors = (index.reconstruct_batch(np.array(positions, dtype=np.int64)) if positions
+                   else np.empty((0, index.d), dtype=np.float32))
+        
+        new_index = faiss.clone_index(index)
+        new_index.reset()
+        if retrain and retrainable_ivf(index) is None:
+            print("⚠️ 索引使用有损编码或预变换，已存储的向量是旧量化器的近似值，不能据此重新训练；"
+                  "需要重新训练时请使用 --force-rebuild 重新嵌入")
+            retrain = False
+        if retrain and ivf is not None:
+            new_ivf = faiss.extract_index_ivf(new_index)
+            if len(vectors) >= new_ivf.nlist:
+                new_ivf.quantizer.reset()
+                new_ivf.is_trained = False
+                new_index.is_trained = False
+                new_index.train(vectors)
+            else:
+                print(f"⚠️ 向量数 {len(vectors)} 少于聚类中心数 {new_ivf.nlist}，沿用原聚类中心")
+        new_index.add(vectors)
+        
+        docstore = InMemoryDocstore({doc_id: vector_store.docstore.search(doc_id) for doc_id in doc_ids})
+        return FAISS(self.embeddings, new_index, docstore, dict(enumerate(doc_ids)),
+                     relevance_score_fn=vector_store.override_relevance_score_fn,
+                     normalize_L2=vector_store._normalize_L2,
+                     distance_strategy=vector_store.distance_strategy)
+    
+    @property
+    def lock_path(self) -> str:
+        return f"{self.metadata_path}.lock"
     
     def incremental_update(self, force_rebuild: bool = False) -> Dict:
-        """执行增量更新"""
+        """执行增量更新（扫描整个知识库目录）"""
+        with file_lock(self.lock_path):
+            return self._incremental_update(force_rebuild)
+    
+    def update_files(self, changes) -> Dict:
+        """只检查指定路径的增量更新
+        
+        changes 为 (相对路径, 事件类型) 的集合，由文件监控收集；其余文件沿用元数据中的记录，
+        不再遍历和哈希整个知识库。遗漏的事件由定时的全量 incremental_update() 兜底。
+        """
+        with file_lock(self.lock_path):
+            return self._update_files(changes)
+    
+    def compact(self, force: bool = False) -> Dict:
+        """压缩向量索引：孤儿向量或IVF索引的变更量超过阈值（或 force）时，用已存储的向量重建并发布
+        
+        不重新嵌入；与增量更新共用文件锁，在调度器的更新队列中执行，不占用服务进程。
+        """
+        with file_lock(self.lock_path):
+            return self._compact(force)
+    
+    def _compact(self, force: bool) -> Dict:
+        start_time = time.time()
+        vector_store = self.load_existing_vector_store()
+        if vector_store is None or self.metadata_store.latest_version() is None:
+            # 没有文档块记录时无法区分孤儿向量
+            print("没有可压缩的向量存储，跳过压缩")
+            return {'status': 'skipped', 'duration': time.time() - start_time}
+        
+        health = self.index_health(vector_store)
+        vectors = max(health['vectors'], 1)
+        retrain = health['trainable'] and (force or health['churn'] / vectors > self.compact_churn_ratio)
+        if not health['trainable'] and faiss.try_extract_index_ivf(vector_store.index) is not None:
+            print("ℹ️ IVF索引使用有损编码，压缩时沿用原聚类中心和量化器，不重新训练")
+        print(f"索引状态: 向量 {health['vectors']}, 孤儿 {health['orphans']}, 缺失 {health['missing']}, "
+              f"上次重建以来变更 {health['churn']}")
+        if health['missing']:
+            print(f"⚠️ {health['missing']} 个已记录的文档块不在索引中，压缩无法恢复，请使用 --force-rebuild 重建")
+        if not force and not retrain and health['orphans'] / vectors <= self.compact_orphan_ratio:
+            print("索引无需压缩")
+            return {'status': 'skipped', 'duration': time.time() - start_time, 'health': health}
+        
+        self.governor.wait()
+        print(f"压缩向量索引{'并重新训练聚类中心' if retrain else ''}...")
+        compacted = self.rebuild_index(vector_store, retrain)
+        self.publish_vector_store(compacted)
+        self.metadata_store.apply({}, version={'kind': 'compact', 'removed': health['orphans']})
+        
+        duration = time.time() - start_time
+        print(f"索引压缩完成，移除 {health['orphans']} 个孤儿向量，耗时 {duration:.2f} 秒")
+        return {
+            'status': 'compacted',
+            'duration': duration,
+            'vectors': compacted.index.ntotal,
+            'orphans_removed': health['orphans'],
+            'retrained': retrain
+        }
+    
+    def _incremental_update(self, force_rebuild: bool) -> Dict:
         start_time = time.time()
         print("开始增量更新...")
         
-        # 加载元数据
-        metadata = self.load_metadata()
+        # 加载文件记录
+        previous = self.metadata_store.file_records()
         
         # 扫描当前文档
         print("扫描文档目录...")
-        current_files = self.scan_documents()
+        current_files = self.scan_documents(previous)
         print(f"发现 {len(current_files)} 个支持的文档")
         
         if force_rebuild:
@@ -218,13 +1151,49 @@ class IncrementalUpdater:
             deleted_files = set()
         else:
             # 检测变更
-            added_files, modified_files, deleted_files = self.detect_changes(current_files, metadata)
+            added_files, modified_files, deleted_files = self.detect_changes(current_files, previous)
+        
+        return self.apply_changes(previous, current_files, added_files, modified_files, deleted_files,
+                                  force_rebuild, start_time)
+    
+    def _update_files(self, changes) -> Dict:
+        start_time = time.time()
+        store = self.metadata_store
+        
+        paths = self.expand_changed_paths(changes)
+        # 上次加载失败、等待重试的文件一并检查
+        paths |= store.pending_paths()
+        print(f"开始增量更新，检查 {len(paths)} 个变更路径...")
+        
+        # 只读取和比较这些路径的记录，其余文件的记录不读取也不改写
+        previous = store.file_records(paths)
+        current_files = self.scan_files(paths, previous)
+        
+        added_files, modified_files, deleted_files = self.detect_changes(current_files, previous)
+        return self.apply_changes(previous, current_files, added_files, modified_files, deleted_files,
+                                  False, start_time)
+    
+    def apply_changes(self, previous: Dict, current_files: Dict, added_files: Set[str], modified_files: Set[str],
+                      deleted_files: Set[str], force_rebuild: bool, start_time: float) -> Dict:
+        """把检测到的文件变更写入向量存储并保存元数据
         
+        previous 和 current_files 为本次检查的文件上次保存的记录和当前信息（按变更路径更新时只含这些路径），
+        元数据中只改写记录发生变化的文件。
+        """
         print(f"变更统计: 新增 {len(added_files)}, 修改 {len(modified_files)}, 删除 {len(deleted_files)}")
+        store = self.metadata_store
+        previous = {} if force_rebuild else self.normalize_file_entries(previous)
+        changed_records = {
+            path: record for path, record in self.file_records(current_files).items()
+            if previous.get(path) != record
+        }
         
         # 如果没有变更，直接返回
         if not added_files and not modified_files and not deleted_files and not force_rebuild:
             print("没有检测到文档变更，跳过更新")
+            # 仅mtime变化（如touch）的文件已重新哈希，记录新的stat，下次扫描可走快速路径
+            if changed_records:
+                store.apply(changed_records)
             return {
                 'status': 'no_changes',
                 'duration': time.time() - start_time,
@@ -237,40 +1206,69 @@ class IncrementalUpdater:
         
         # 加载现有向量存储
         vector_store = None if force_rebuild else self.load_existing_vector_store()
+        # 还没有记录过文档块时（旧版向量存储），从向量存储的文档库中查找
+        legacy_store = vector_store if store.latest_version() is None else None
+        file_chunks = {}
+        chunk_changes = {'embedded': 0, 'reused': 0, 'removed': 0}
         
         # 处理删除的文件
         if deleted_files:
-            vector_store = self.remove_documents_from_vector_store(vector_store, deleted_files)
+            old_records = self.old_chunk_records(legacy_store, deleted_files)
+            removed_ids = [record['id'] for records in old_records.values() for record in records]
+            vector_store = self.remove_documents_from_vector_store(vector_store, removed_ids)
+            chunk_changes['removed'] += len(removed_ids)
         
-        # 处理新增和修改的文件
+        # 处理新增和修改的文件：按加载完成顺序逐个比较文档块，只嵌入内容变化的部分
         changed_files = list(added_files | modified_files)
         if changed_files:
             print(f"处理 {len(changed_files)} 个变更文档...")
-            documents = self.process_documents(changed_files, current_files)
+            old_records = {} if force_rebuild else self.old_chunk_records(legacy_store, set(changed_files))
+            # FAISS.delete每次都要重建整个ID映射，旧文档块攒到写入新块时一并删除
+            pending_chunks, pending_ids, pending_removed = [], [], []
             
-            if documents:
-                print(f"分割 {len(documents)} 个文档...")
-                chunks = self.text_splitter.split_documents(documents)
-                print(f"生成 {len(chunks)} 个文档块")
+            for rel_path, chunks in self.process_documents(changed_files, current_files):
+                if chunks is None:
+                    # 加载失败或超时的文件保留旧的文档块，且不记录哈希，下次更新重试；
+                    # 成功加载但没有内容的文件按正常文件处理，删除旧文档块并记录为没有文档块
+                    changed_records[rel_path] = dict(changed_records[rel_path], hash=None, mtime_ns=None)
+                    continue
+                new_chunks, new_ids, removed_ids, new_records, reused = self.diff_chunks(
+                    chunks, {rel_path: old_records.get(rel_path, [])}
+                )
+                self.refresh_reused_documents(vector_store, reused)
+                pending_removed.extend(removed_ids)
+                file_chunks.update(new_records)
+                pending_chunks.extend(new_chunks)
+                pending_ids.extend(new_ids)
+                chunk_changes['embedded'] += len(new_chunks)
+                chunk_changes['reused'] += len(chunks) - len(new_chunks)
+                chunk_changes['removed'] += len(removed_ids)
                 
-                # 更新向量存储
-                vector_store = self.update_vector_store(vector_store, chunks)
+                # 内存超过限制时提前写入已累积的文档块
+                if len(pending_chunks) >= EMBED_BATCH_SIZE or (pending_chunks and self.governor.over_memory_limit()):
+                    self.governor.wait()
+                    vector_store = self.remove_documents_from_vector_store(vector_store, pending_removed)
+                    vector_store = self.update_vector_store(vector_store, pending_chunks, pending_ids)
+                    pending_chunks, pending_ids, pending_removed = [], [], []
+            
+            if pending_chunks:
+                self.governor.wait()
+            vector_store = self.remove_documents_from_vector_store(vector_store, pending_removed)
+            vector_store = self.update_vector_store(vector_store, pending_chunks, pending_ids)
+            print(f"文档块变更: 新增 {chunk_changes['embedded']}, 沿用 {chunk_changes['reused']}, "
+                  f"删除 {chunk_changes['removed']}")
         
         # 保存向量存储
         if vector_store:
             print("保存向量存储...")
-            if not os.path.exists(self.vector_store_path):
-                os.makedirs(self.vector_store_path)
-            vector_store.save_local(self.vector_store_path)
-        
-        # 更新元数据
-        new_metadata = {
-            'last_update': datetime.now().isoformat(),
-            'file_hashes': {path: info['hash'] for path, info in current_files.items()},
-            'total_documents': len(current_files),
-            'total_chunks': len(chunks) if 'chunks' in locals() else metadata.get('total_chunks', 0)
-        }
-        self.save_metadata(new_metadata)
+            self.publish_vector_store(vector_store)
+        
+        # 更新元数据：只写入变更文件的记录和文档块
+        totals = store.apply(changed_records, deleted_files, file_chunks, replace=force_rebuild, version={
+            'force_rebuild': force_rebuild,
+            'embedded': chunk_changes['embedded'],
+            'removed': chunk_changes['removed']
+        })
         
         duration = time.time() - start_time
         print(f"增量更新完成，耗时 {duration:.2f} 秒")
@@ -283,7 +1281,8 @@ class IncrementalUpdater:
                 'modified': len(modified_files),
                 'deleted': len(deleted_files)
             },
-            'total_documents': len(current_files)
+            'chunks': chunk_changes,
+            'total_documents': totals['total_documents']
         }
 
 def main():
@@ -292,6 +1291,7 @@ def main():
     
     parser = argparse.ArgumentParser(description='增量更新知识库向量存储')
     parser.add_argument('--force-rebuild', action='store_true', help='强制重建整个向量存储')
+    parser.add_argument('--compact', action='store_true', help='用已存储的向量压缩重建向量索引（不重新嵌入）')
     parser.add_argument('--verbose', '-v', action='store_true', help='详细输出')
     
     args = parser.parse_args()
@@ -299,6 +1299,12 @@ def main():
     updater = IncrementalUpdater()
     
     try:
+        if args.compact:
+            result = updater.compact(force=True)
+            if args.verbose:
+                print(json.dumps(result, indent=2, ensure_ascii=False))
+            return 0
+        
         result = updater.incremental_update(force_rebuild=args.force_rebuild)
         
         if args.verbose:
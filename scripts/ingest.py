@@ -1,4 +1,5 @@
 import os
+import sys
 from dotenv import load_dotenv
 from langchain_community.document_loaders import (
     DirectoryLoader, 
@@ -7,9 +8,12 @@ from langchain_community.document_loaders import (
     UnstructuredWordDocumentLoader
 )
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import OllamaEmbeddings
+from langchain_ollama import OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.ollama_client import get_ollama_client
+
 # 加载环境变量
 load_dotenv(dotenv_path=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env')))
 
@@ -85,7 +89,8 @@ def ingest_data():
 
     # 创建嵌入
     print(f"正在使用Ollama模型 '{OLLAMA_EMBEDDING_MODEL}' 创建文本嵌入...")
-    embeddings = OllamaEmbeddings(model=OLLAMA_EMBEDDING_MODEL)
+    ollama_client = get_ollama_client()
+    embeddings = ollama_client.bind(OllamaEmbeddings(model=OLLAMA_EMBEDDING_MODEL, base_url=ollama_client.base_url))
 
     # 创建并保存FAISS向量存储
     print("正在创建并保存FAISS向量存储...")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+离线查看请求链路
+
+读取 TRACE_EXPORTER=file 时写出的JSONL追踪文件，按请求分组，
+以缩进树的形式打印最慢的若干条链路及每个span的属性。
+
+使用方法:
+    python scripts/inspect_traces.py
+    python scripts/inspect_traces.py --file logs/traces.jsonl --top 5 --min-ms 2000
+    python scripts/inspect_traces.py --trace-id 4bf92f3577b34da6a3ce929d0e0e4736
+"""
+
+import os
+import sys
+import json
+import argparse
+from typing import Dict, List
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DEFAULT_TRACE_FILE = os.path.join(PROJECT_ROOT, 'logs', 'traces.jsonl')
+
+def load_traces(path: str) -> Dict[str, List[Dict]]:
+    """读取追踪文件，按trace_id分组"""
+    traces = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                span = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            traces.setdefault(span['trace_id'], []).append(span)
+    return traces
+
+def root_span(spans: List[Dict]) -> Dict:
+    """返回链路的根span（本文件中没有父span的span）"""
+    span_ids = {span['span_id'] for span in spans}
+    roots = [span for span in spans if span['parent_id'] not in span_ids]
+    return min(roots, key=lambda span: span['start_time']) if roots else spans[0]
+
+def print_tree(spans: List[Dict]):
+    """按父子关系缩进打印span"""
+    children = {}
+    for span in spans:
+        children.setdefault(span['parent_id'], []).append(span)
+
+    def walk(span: Dict, depth: int):
+        status = "" if span['status'] == 'ok' else f" ❌ {span.get('error')}"
+        attributes = ", ".join(f"{k}={v}" for k, v in span['attributes'].items())
+        print(f"{'  ' * depth}{span['name']}  {span['duration_ms']:.1f}ms{status}")
+        if attributes:
+            print(f"{'  ' * depth}    {attributes}")
+        for child in sorted(children.get(span['span_id'], []), key=lambda s: s['start_time']):
+            walk(child, depth + 1)
+
+    walk(root_span(spans), 0)
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='查看本地导出的请求链路')
+    parser.add_argument('--file', default=DEFAULT_TRACE_FILE, help='JSONL追踪文件')
+    parser.add_argument('--top', type=int, default=10, help='打印最慢的链路数')
+    parser.add_argument('--min-ms', type=float, default=0, help='只显示耗时不低于该值的链路')
+    parser.add_argument('--trace-id', help='只显示指定的链路')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file):
+        print(f"❌ 追踪文件不存在: {args.file}")
+        return 1
+
+    traces = load_traces(args.file)
+    if args.trace_id:
+        traces = {args.trace_id: traces.get(args.trace_id, [])}
+        if not traces[args.trace_id]:
+            print(f"❌ 未找到链路: {args.trace_id}")
+            return 1
+
+    ranked = sorted(
+        ((trace_id, spans, root_span(spans)) for trace_id, spans in traces.items()),
+        key=lambda item: item[2]['duration_ms'] or 0,
+        reverse=True
+    )
+    ranked = [item for item in ranked if (item[2]['duration_ms'] or 0) >= args.min_ms][:args.top]
+
+    print(f"共 {len(traces)} 条链路，显示 {len(ranked)} 条\n")
+    for trace_id, spans, _ in ranked:
+        print(f"trace_id: {trace_id}")
+        print_tree(spans)
+        print()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+端到端压测
+
+启动本地Ollama替身服务（scripts/fake_ollama_server.py）和合成向量库
+（scripts/build_synthetic_corpus.py），再以子进程方式分别启动 app.main 和
+app.lora_main（Ollama模式），在固定并发数下持续调用 /ask，记录吞吐、
+p50/p95/p99延迟、状态码分布和服务进程RSS峰值。结果保存为JSON并附带当前
+git提交，可用 --baseline 与之前的结果对比，作为性能回归检查。
+
+替身服务的嵌入/生成延迟固定，因此不同提交之间的差异只来自本服务自身。
+
+使用方法:
+    python scripts/load_test.py
+    python scripts/load_test.py --apps main --chunks 1000 100000 1000000 --concurrency 1 8 32 --requests 200
+    python scripts/load_test.py --token-latency-ms 5 --tokens 32 --env MAX_CONCURRENT_REQUESTS=8
+    python scripts/load_test.py --baseline benchmark_results/load_test_baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+import psutil
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+OUTPUT_DIR = os.path.join(PROJECT_ROOT, 'benchmark_results')
+EVALUATION_DATASET = os.path.join(PROJECT_ROOT, 'evaluation_dataset.json')
+
+sys.path.insert(0, PROJECT_ROOT)
+from scripts.build_synthetic_corpus import ensure_corpus
+from app.stats import percentile
+
+# 被测应用
+APPS = {
+    'main': 'app.main:app',
+    'lora_main': 'app.lora_main:app'
+}
+
+DEFAULT_QUERIES = [
+    "产品的保修期是多久？",
+    "设备安装需要哪些步骤？",
+    "如何联系售后服务？",
+    "设备的工作温度范围是多少？"
+]
+
+def load_queries(path: str = EVALUATION_DATASET) -> List[str]:
+    """从评估数据集中读取用户问题，读取失败时使用内置问题"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            dataset = json.load(f)
+        queries = [
+            message['content']
+            for item in dataset
+            for message in item.get('messages', [])
+            if message.get('role') == 'user'
+        ]
+        return queries or DEFAULT_QUERIES
+    except (OSError, ValueError):
+        return DEFAULT_QUERIES
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=PROJECT_ROOT, capture_output=True, text=True, timeout=10
+        )
+        return result.stdout.strip() or None
+    except Exception:
+        return None
+
+def summarize_latencies(latencies: List[float]) -> Dict[str, float]:
+    """延迟分布（毫秒）"""
+    if not latencies:
+        return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    return {
+        'mean': round(1000 * sum(latencies) / len(latencies), 1),
+        'p50': round(1000 * percentile(latencies, 0.50), 1),
+        'p95': round(1000 * percentile(latencies, 0.95), 1),
+        'p99': round(1000 * percentile(latencies, 0.99), 1),
+        'max': round(1000 * max(latencies), 1)
+    }
+
+def process_rss(pid: int) -> int:
+    """进程及其子进程的RSS总和（字节）"""
+    try:
+        process = psutil.Process(pid)
+        total = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+    except psutil.Error:
+        return 0
+
+class RssSampler:
+    """在后台线程中定时采样服务进程RSS，记录峰值"""
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.start_rss = process_rss(pid)
+        self.peak_rss = self.start_rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, process_rss(self.pid))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, process_rss(self.pid))
+
+def start_process(name: str, command: List[str], env: Dict[str, str], log_dir: str) -> subprocess.Popen:
+    """启动子进程，输出写入日志文件"""
+    os.makedirs(log_dir, exist_ok=True)
+    log = open(os.path.join(log_dir, f"{name}.log"), 'w', encoding='utf-8')
+    return subprocess.Popen(command, cwd=PROJECT_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def stop_process(process: subprocess.Popen):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float) -> bool:
+    """轮询url直到返回200；进程提前退出或超时返回False"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    return False
+
+async def run_load(base_url: str, queries: List[str], concurrency: int, total_requests: int,
+                   timeout: float = 120.0) -> Dict:
+    """以固定并发发送total_requests个 /ask 请求，返回吞吐、延迟分布和状态码统计"""
+    latencies = []
+    status_counts: Dict[str, int] = {}
+    next_request = 0
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal next_request
+        while next_request < total_requests:
+            i = next_request
+            next_request += 1
+            started = time.perf_counter()
+            try:
+                response = await client.post("/ask", json={"query": queries[i % len(queries)]})
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            status_counts[status] = status_counts.get(status, 0) + 1
+            if status == '200':
+                latencies.append(elapsed)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        duration = time.perf_counter() - started
+
+    return {
+        'concurrency': concurrency,
+        'requests': total_requests,
+        'succeeded': len(latencies),
+        'errors': total_requests - len(latencies),
+        'status_counts': status_counts,
+        'duration_seconds': round(duration, 3),
+        'throughput_rps': round(len(latencies) / duration, 3) if duration > 0 else 0.0,
+        'latency_ms': summarize_latencies(latencies)
+    }
+
+def app_env(fake_url: str, corpus: str, extra_env: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """被测应用的环境变量：指向替身服务和合成向量库，使用Ollama模式"""
+    env = dict(
+        os.environ,
+        OLLAMA_BASE_URL=fake_url,
+        VECTOR_STORE_PATH=corpus,
+        OLLAMA_EMBEDDING_MODEL='fake-embed',
+        OLLAMA_CHAT_MODEL='fake-chat',
+        USE_LORA_DEFAULT='false',
+        # 压测客户端来自同一地址，关闭限流以免429掩盖真实延迟
+        RATE_LIMIT_PER_MINUTE='0',
+        PYTHONUNBUFFERED='1'
+    )
+    env.update(extra_env or {})
+    return env
+
+def start_fake_ollama(args, log_dir: str):
+    """启动Ollama替身服务，返回 (进程, 地址)；启动失败时进程已退出"""
+    port = free_port()
+    process = start_process(
+        'fake_ollama',
+        [
+            sys.executable, os.path.join('scripts', 'fake_ollama_server.py'),
+            '--port', str(port), '--dim', str(args.dim),
+            '--embed-latency-ms', str(args.embed_latency_ms),
+            '--prefill-ms', str(args.prefill_ms),
+            '--token-latency-ms', str(args.token_latency_ms),
+            '--tokens', str(args.tokens)
+        ],
+        dict(os.environ), log_dir
+    )
+    url = f"http://127.0.0.1:{port}"
+    if not wait_until_ready(f"{url}/api/tags", process, 60):
+        stop_process(process)
+    return process, url
+
+def benchmark_app(app_name: str, corpus: str, fake_url: str, args, queries: List[str]) -> List[Dict]:
+    """启动一个应用，依次在各并发级别下压测"""
+    port = free_port()
+    env = app_env(fake_url, corpus, args.extra_env)
+
+    process = start_process(
+        f"{app_name}_{os.path.basename(corpus)}",
+        [sys.executable, '-m', 'uvicorn', APPS[app_name], '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+        env, args.log_dir
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    results = []
+    try:
+        started = time.time()
+        if not wait_until_ready(f"{base_url}/ready", process, args.startup_timeout):
+            print(f"❌ {app_name} 未能就绪，日志见 {args.log_dir}")
+            return [{'app': app_name, 'error': 'not_ready'}]
+        ready_seconds = time.time() - started
+        idle_rss = process_rss(process.pid)
+        print(f"✅ {app_name} 已就绪 ({ready_seconds:.1f}s, RSS {idle_rss / 1024 / 1024:.0f}MB)")
+
+        # 预热：让连接池、嵌入和生成路径都走一遍
+        asyncio.run(run_load(base_url, queries, 1, args.warmup))
+
+        for concurrency in args.concurrency:
+            with RssSampler(process.pid) as sampler:
+                result = asyncio.run(run_load(base_url, queries, concurrency, args.requests, args.request_timeout))
+            result.update({
+                'app': app_name,
+                'ready_seconds': round(ready_seconds, 2),
+                'rss_mb': {
+                    'idle': round(idle_rss / 1024 / 1024, 1),
+                    'start': round(sampler.start_rss / 1024 / 1024, 1),
+                    'peak': round(sampler.peak_rss / 1024 / 1024, 1)
+                }
+            })
+            latency = result['latency_ms']
+            print(
+                f"  并发 {concurrency:>3}: {result['throughput_rps']:.2f} req/s, "
+                f"p50 {latency['p50']:.0f}ms, p95 {latency['p95']:.0f}ms, p99 {latency['p99']:.0f}ms, "
+                f"错误 {result['errors']}, RSS峰值 {result['rss_mb']['peak']:.0f}MB"
+            )
+            results.append(result)
+    finally:
+        stop_process(process)
+    return results
+
+def result_key(result: Dict) -> str:
+    return f"{result.get('app')}/{result.get('chunks')}/c{result.get('concurrency')}"
+
+def compare_with_baseline(results: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    """与基线比较吞吐和p95延迟，返回超出允许回退比例的说明"""
+    previous = {result_key(r): r for r in baseline.get('results', []) if 'latency_ms' in r}
+    regressions = []
+    for current in results['results']:
+        base = previous.get(result_key(current))
+        if base is None or 'latency_ms' not in current:
+            continue
+        key = result_key(current)
+        if current['latency_ms']['p95'] > base['latency_ms']['p95'] * (1 + max_regression):
+            regressions.append(
+                f"{key}: p95 {current['latency_ms']['p95']:.0f}ms > 基线 {base['latency_ms']['p95']:.0f}ms × {1 + max_regression:.2f}"
+            )
+        if current['throughput_rps'] < base['throughput_rps'] * (1 - max_regression):
+            regressions.append(
+                f"{key}: 吞吐 {current['throughput_rps']:.2f} req/s < 基线 {base['throughput_rps']:.2f} req/s × {1 - max_regression:.2f}"
+            )
+    return regressions
+
+def parse_env(items: List[str]) -> Dict[str, str]:
+    env = {}
+    for item in items or []:
+        key, _, value = item.partition('=')
+        env[key] = value
+    return env
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='端到端压测（使用本地Ollama替身服务）')
+    parser.add_argument('--apps', nargs='+', choices=list(APPS), default=list(APPS), help='被测应用')
+    parser.add_argument('--chunks', nargs='+', type=int, default=[1000, 100000], help='合成向量库规模（文本块数）')
+    parser.add_argument('--dim', type=int, default=768, help='向量维度')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16], help='并发级别')
+    parser.add_argument('--requests', type=int, default=100, help='每个并发级别的请求数')
+    parser.add_argument('--warmup', type=int, default=3, help='预热请求数')
+    parser.add_argument('--embed-latency-ms', type=float, default=20.0, help='替身服务嵌入延迟')
+    parser.add_argument('--prefill-ms', type=float, default=200.0, help='替身服务首token延迟')
+    parser.add_argument('--token-latency-ms', type=float, default=15.0, help='替身服务每token延迟')
+    parser.add_argument('--tokens', type=int, default=64, help='替身服务每次回答的token数')
+    parser.add_argument('--env', action='append', dest='env_items', metavar='KEY=VALUE', help='传给被测应用的额外环境变量')
+    parser.add_argument('--startup-timeout', type=float, default=300.0, help='等待应用就绪的最长时间（秒）')
+    parser.add_argument('--request-timeout', type=float, default=120.0, help='单个请求的超时时间（秒）')
+    parser.add_argument('--output', default=os.path.join(OUTPUT_DIR, 'load_test.json'), help='结果文件路径')
+    parser.add_argument('--baseline', help='基线结果文件，用于回归检查')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='允许的最大回退比例')
+
+    args = parser.parse_args()
+    args.extra_env = parse_env(args.env_items)
+    args.log_dir = os.path.join(OUTPUT_DIR, 'logs')
+
+    # 先读取基线，允许基线与输出为同一文件
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    queries = load_queries()
+    fake_server, fake_url = start_fake_ollama(args, args.log_dir)
+
+    results = {
+        'timestamp': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'dim': args.dim,
+            'requests': args.requests,
+            'embed_latency_ms': args.embed_latency_ms,
+            'prefill_ms': args.prefill_ms,
+            'token_latency_ms': args.token_latency_ms,
+            'tokens': args.tokens,
+            'env': args.extra_env
+        },
+        'results': []
+    }
+
+    failed = False
+    try:
+        if fake_server.poll() is not None:
+            print("❌ Ollama替身服务启动失败")
+            return 1
+        print(f"✅ Ollama替身服务: {fake_url}")
+
+        for chunks in args.chunks:
+            corpus = ensure_corpus(chunks, args.dim)
+            for app_name in args.apps:
+                print(f"\n🚀 压测 {app_name}，向量库 {chunks} 个文本块")
+                for result in benchmark_app(app_name, corpus, fake_url, args, queries):
+                    result['chunks'] = chunks
+                    results['results'].append(result)
+                    failed = failed or 'error' in result
+    finally:
+        stop_process(fake_server)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"\n结果已保存: {args.output}")
+
+    if baseline is not None:
+        regressions = compare_with_baseline(results, baseline, args.max_regression)
+        for message in regressions:
+            print(f"❌ 性能回退 {message}")
+        failed = failed or bool(regressions)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
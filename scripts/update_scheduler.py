@@ -9,31 +9,229 @@ import time
 import json
 import schedule
 import threading
+from collections import deque
+from concurrent.futures import Future
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-from incremental_update import IncrementalUpdater
+from incremental_update import IncrementalUpdater, ResourceGovernor, SCHEDULER_CONFIG_PATH
+from app.stats import percentile
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# 更新任务优先级：手动 > 文件监控 > 定时 > 索引压缩
+JOB_PRIORITIES = {'compact': -1, 'scheduled': 0, 'watch': 1, 'manual': 2}
+
+class UpdateJob:
+    """一次待执行的更新；合并进来的请求共享同一个结果"""
+    
+    def __init__(self, kind: str, changes=None, force_rebuild: bool = False, changed_at: Optional[float] = None):
+        self.kind = kind
+        self.priority = JOB_PRIORITIES[kind]
+        self.changes = set(changes or ())
+        self.force_rebuild = force_rebuild
+        # 最早一个待处理文件变更的发生时间，用于计算索引新鲜度延迟
+        self.changed_at = changed_at
+        self.futures: List[Future] = []
+        self.submitted_at = time.time()
+    
+    def merge(self, kind: str, changes=None, force_rebuild: bool = False, changed_at: Optional[float] = None):
+        if JOB_PRIORITIES[kind] > self.priority:
+            self.kind = kind
+            self.priority = JOB_PRIORITIES[kind]
+        self.changes |= set(changes or ())
+        self.force_rebuild = self.force_rebuild or force_rebuild
+        if changed_at is not None:
+            self.changed_at = changed_at if self.changed_at is None else min(self.changed_at, changed_at)
+
+class UpdateQueue:
+    """单线程执行所有更新请求的任务队列
+    
+    定时更新、文件监控和手动更新都提交到这里，由一个后台线程依次执行，避免并发修改
+    同一个向量存储。排队中的同类请求合并为一个任务：全量更新（定时/手动）之间合并，
+    文件监控的变更路径合并；全量更新执行时顺带完成排队中的文件监控任务。
+    索引压缩只在没有其他任务排队时执行。
+    跨进程的互斥由 IncrementalUpdater 内部的文件锁保证。
+    """
+    
+    def __init__(self, updater: IncrementalUpdater, on_complete: Optional[Callable] = None):
+        self.updater = updater
+        self.on_complete = on_complete
+        self.condition = threading.Condition()
+        self.full_job: Optional[UpdateJob] = None
+        self.watch_job: Optional[UpdateJob] = None
+        self.compact_job: Optional[UpdateJob] = None
+        self.running_job: Optional[UpdateJob] = None
+        # 执行失败的文件监控变更，并入下一次文件监控任务重试
+        self.retry_changes = set()
+        self.stopped = False
+        self.worker: Optional[threading.Thread] = None
+        self.stats = {'submitted': 0, 'executed': 0, 'coalesced': 0, 'failed': 0}
+    
+    def submit(self, kind: str, changes=None, force_rebuild: bool = False,
+               changed_at: Optional[float] = None) -> Future:
+        """提交更新请求，返回在任务完成时得到结果的Future"""
+        future = Future()
+        with self.condition:
+            if self.stopped:
+                future.set_exception(RuntimeError("更新队列已停止"))
+                return future
+            self.stats['submitted'] += 1
+            if kind == 'watch':
+                job_attr = 'watch_job'
+            elif kind == 'compact':
+                job_attr = 'compact_job'
+            else:
+                job_attr = 'full_job'
+            job = getattr(self, job_attr)
+            if job is None:
+                job = UpdateJob(kind, changes, force_rebuild, changed_at)
+                setattr(self, job_attr, job)
+            else:
+                job.merge(kind, changes, force_rebuild, changed_at)
+                self.stats['coalesced'] += 1
+            job.futures.append(future)
+            self.condition.notify()
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name="update-worker", daemon=True)
+                self.worker.start()
+        return future
+    
+    def next_job(self) -> Optional[UpdateJob]:
+        """按优先级取出下一个任务；全量更新覆盖排队中的文件监控变更"""
+        full, watch = self.full_job, self.watch_job
+        if full is None and watch is None:
+            job, self.compact_job = self.compact_job, None
+            return job
+        if full is not None and (watch is None or full.priority >= watch.priority):
+            self.full_job = None
+            if watch is not None:
+                self.watch_job = None
+                full.merge(full.kind, changed_at=watch.changed_at)
+                full.futures.extend(watch.futures)
+                self.stats['coalesced'] += 1
+            return full
+        self.watch_job = None
+        return watch
+    
+    def execute(self, job: UpdateJob) -> Dict:
+        if job.kind == 'compact':
+            return self.updater.compact(force=job.force_rebuild)
+        if job.kind == 'watch':
+            changes = job.changes | self.retry_changes
+            self.retry_changes = set()
+            try:
+                return self.updater.update_files(changes)
+            except Exception:
+                self.retry_changes |= changes
+                raise
+        result = self.updater.incremental_update(force_rebuild=job.force_rebuild)
+        # 全量扫描已覆盖之前失败的文件监控变更
+        self.retry_changes = set()
+        return result
+    
+    def run(self):
+        """后台线程：依次执行任务"""
+        while True:
+            with self.condition:
+                while not self.stopped and self.full_job is None and self.watch_job is None and self.compact_job is None:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                job = self.next_job()
+                self.running_job = job
+            
+            result, error = None, None
+            try:
+                result = self.execute(job)
+                self.stats['executed'] += 1
+            except Exception as e:
+                error = e
+                self.stats['failed'] += 1
+            
+            if self.on_complete:
+                try:
+                    self.on_complete(job, result, error)
+                except Exception as e:
+                    print(f"⚠️ 更新结果回调失败: {e}")
+            for future in job.futures:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+            
+            with self.condition:
+                self.running_job = None
+                self.condition.notify_all()
+    
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """等待队列清空且没有正在执行的任务"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.full_job or self.watch_job or self.compact_job or self.running_job:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+    
+    def stop(self, timeout: Optional[float] = None):
+        """停止接收新任务，等待当前任务结束，取消排队中的任务"""
+        with self.condition:
+            self.stopped = True
+            pending = [job for job in (self.full_job, self.watch_job, self.compact_job) if job is not None]
+            self.full_job = self.watch_job = self.compact_job = None
+            self.condition.notify_all()
+        for job in pending:
+            for future in job.futures:
+                future.cancel()
+        if self.worker is not None and self.worker is not threading.current_thread():
+            self.worker.join(timeout)
 
 class KnowledgeBaseWatcher(FileSystemEventHandler):
-    """知识库文件监控器"""
+    """知识库文件监控器
+    
+    自适应防抖：等待时间取最近事件间隔的两倍，限制在 [min_quiet_seconds, debounce_seconds]
+    之间，单次保存很快触发更新，持续写入时等待写入停顿。无论事件是否停止，最早的变更
+    超过 max_delay_seconds 或待处理路径达到 max_batch_size 时立即提交，保证索引滞后有上限。
+    """
     
-    def __init__(self, updater: IncrementalUpdater, debounce_seconds: int = 30):
+    def __init__(self, updater: IncrementalUpdater, debounce_seconds: float = 30,
+                 job_queue: Optional[UpdateQueue] = None, min_quiet_seconds: float = 2,
+                 max_delay_seconds: float = 120, max_batch_size: int = 500):
         self.updater = updater
         self.debounce_seconds = debounce_seconds
+        self.min_quiet_seconds = min(min_quiet_seconds, debounce_seconds)
+        self.max_delay_seconds = max_delay_seconds
+        self.max_batch_size = max_batch_size
+        self.job_queue = job_queue or UpdateQueue(updater)
+        # watchdog线程写入、定时器线程取出，需加锁
+        self.lock = threading.Lock()
         self.pending_updates = set()
+        self.first_event_time = None
+        self.last_event_time = None
+        self.event_gap = None
         self.last_update_time = None
         self.update_timer = None
         
         # 支持的文件扩展名
         self.supported_extensions = {'.md', '.pdf', '.docx', '.doc'}
     
+    def relative_path(self, path: str) -> str:
+        return os.path.relpath(path, self.updater.knowledge_base_path)
+    
     def is_supported_file(self, file_path: str) -> bool:
-        """检查是否为支持的文件类型"""
-        return Path(file_path).suffix.lower() in self.supported_extensions
+        """检查是否为支持的文件类型，且不在过滤规则排除的范围内"""
+        return (Path(file_path).suffix.lower() in self.supported_extensions
+                and self.updater.file_filter.includes_path(self.relative_path(file_path)))
+    
+    def is_watched_dir(self, dir_path: str) -> bool:
+        """目录及其上级目录都未被排除（如 .git、node_modules）"""
+        return not self.updater.file_filter.excludes_tree(self.relative_path(dir_path))
     
     def on_modified(self, event):
         """文件修改事件"""
@@ -47,12 +245,21 @@ class KnowledgeBaseWatcher(FileSystemEventHandler):
     
     def on_deleted(self, event):
         """文件删除事件"""
-        if not event.is_directory and self.is_supported_file(event.src_path):
+        # 删除目录时由 update_files 找出其中已入库的文件
+        if event.is_directory:
+            if self.is_watched_dir(event.src_path):
+                self.schedule_update(event.src_path, 'deleted')
+        elif self.is_supported_file(event.src_path):
             self.schedule_update(event.src_path, 'deleted')
     
     def on_moved(self, event):
         """文件移动事件"""
-        if not event.is_directory:
+        if event.is_directory:
+            if self.is_watched_dir(event.src_path):
+                self.schedule_update(event.src_path, 'deleted')
+            if self.is_watched_dir(event.dest_path):
+                self.schedule_update(event.dest_path, 'created')
+        else:
             if self.is_supported_file(event.src_path):
                 self.schedule_update(event.src_path, 'deleted')
             if self.is_supported_file(event.dest_path):
@@ -60,50 +267,78 @@ class KnowledgeBaseWatcher(FileSystemEventHandler):
     
     def schedule_update(self, file_path: str, event_type: str):
         """调度更新"""
-        rel_path = os.path.relpath(file_path, self.updater.knowledge_base_path)
-        self.pending_updates.add((rel_path, event_type))
-        
+        rel_path = self.relative_path(file_path)
         print(f"检测到文件变更: {rel_path} ({event_type})")
         
-        # 取消之前的定时器
-        if self.update_timer:
-            self.update_timer.cancel()
-        
-        # 设置新的定时器（防抖动）
-        self.update_timer = threading.Timer(self.debounce_seconds, self.execute_update)
-        self.update_timer.start()
-    
-    def execute_update(self):
-        """执行更新"""
-        if not self.pending_updates:
-            return
-        
-        print(f"\n执行增量更新，处理 {len(self.pending_updates)} 个变更...")
-        
-        try:
-            result = self.updater.incremental_update()
+        now = time.time()
+        with self.lock:
+            self.pending_updates.add((rel_path, event_type))
+            if self.first_event_time is None:
+                self.first_event_time = now
             
-            if result['status'] == 'success':
-                print(f"✅ 自动更新成功! 耗时 {result['duration']:.2f} 秒")
-                print(f"   变更统计: +{result['changes']['added']} ~{result['changes']['modified']} -{result['changes']['deleted']}")
-            else:
-                print(f"ℹ️ 更新状态: {result['status']}")
+            # 事件间隔的指数移动平均；停顿超过最大防抖时间视为新一轮写入
+            if self.last_event_time is not None:
+                gap = now - self.last_event_time
+                if gap > self.debounce_seconds:
+                    self.event_gap = None
+                else:
+                    self.event_gap = gap if self.event_gap is None else 0.3 * gap + 0.7 * self.event_gap
+            self.last_event_time = now
             
-            self.last_update_time = datetime.now()
+            # 取消之前的定时器
+            if self.update_timer:
+                self.update_timer.cancel()
             
-        except Exception as e:
-            print(f"❌ 自动更新失败: {e}")
-        
-        finally:
-            self.pending_updates.clear()
+            # 设置新的定时器（防抖动）
+            self.update_timer = threading.Timer(self.flush_delay(now), self.execute_update)
+            self.update_timer.daemon = True
+            self.update_timer.start()
+    
+    def flush_delay(self, now: float) -> float:
+        """距离提交更新的等待时间（调用方持有锁）"""
+        if len(self.pending_updates) >= self.max_batch_size:
+            return 0.0
+        if self.event_gap is None:
+            quiet = self.min_quiet_seconds
+        else:
+            quiet = min(self.debounce_seconds, max(self.min_quiet_seconds, 2 * self.event_gap))
+        deadline = self.first_event_time + self.max_delay_seconds
+        return max(0.0, min(now + quiet, deadline) - now)
+    
+    def execute_update(self) -> Optional[Future]:
+        """防抖结束：把监控到的变更路径提交到更新队列"""
+        # 先取出待处理的变更，之后到达的事件留给下一次
+        with self.lock:
+            changes = self.pending_updates
+            changed_at = self.first_event_time
+            self.pending_updates = set()
+            self.first_event_time = None
             self.update_timer = None
+        if not changes:
+            return None
+        
+        print(f"\n提交增量更新，处理 {len(changes)} 个变更...")
+        self.last_update_time = datetime.now()
+        return self.job_queue.submit('watch', changes, changed_at=changed_at)
+    
+    def cancel(self):
+        """取消尚未触发的防抖定时器"""
+        with self.lock:
+            if self.update_timer:
+                self.update_timer.cancel()
+                self.update_timer = None
 
 class UpdateScheduler:
     """更新调度器"""
     
-    def __init__(self, config_path: str = None):
-        self.updater = IncrementalUpdater()
+    def __init__(self, config_path: str = SCHEDULER_CONFIG_PATH):
+        # 默认读取 config/scheduler_config.json，使过滤、资源调节和索引压缩配置一致生效
         self.config = self.load_config(config_path)
+        self.governor = ResourceGovernor.from_config(self.config)
+        self.updater = IncrementalUpdater(filters=self.config.get('filters'), compaction=self.config.get('compaction'),
+                                          governor=self.governor)
+        # 所有更新都经由同一个队列串行执行
+        self.job_queue = UpdateQueue(self.updater, self.on_update_complete)
         self.watcher = None
         self.observer = None
         self.is_running = False
@@ -114,8 +349,12 @@ class UpdateScheduler:
             'file_watch_updates': 0,
             'manual_updates': 0,
             'last_scheduled_update': None,
-            'last_file_watch_update': None
+            'last_file_watch_update': None,
+            'compactions': 0,
+            'last_compaction': None
         }
+        # 文件变更到写入向量存储的延迟（秒）
+        self.freshness_samples = deque(maxlen=200)
     
     def load_config(self, config_path: str = None) -> Dict:
         """加载配置"""
@@ -127,7 +366,14 @@ class UpdateScheduler:
             },
             'file_watch': {
                 'enabled': True,
-                'debounce_seconds': 30
+                'debounce_seconds': 30,
+                'min_quiet_seconds': 2,
+                'max_delay_seconds': 120,
+                'max_batch_size': 500
+            },
+            'compaction': {
+                'enabled': True,
+                'time': '03:30'
             },
             'logging': {
                 'enabled': True,
@@ -163,13 +409,28 @@ class UpdateScheduler:
             schedule.every().day.at(update_time).do(self.run_scheduled_update)
             print(f"设置定时更新: 每天 {update_time}")
     
+    def setup_compaction(self):
+        """设置定时索引压缩检查"""
+        compaction = self.config.get('compaction', {})
+        if not compaction.get('enabled') or not compaction.get('time'):
+            return
+        
+        schedule.every().day.at(compaction['time']).do(self.run_compaction)
+        print(f"设置索引压缩检查: 每天 {compaction['time']}")
+    
     def setup_file_watcher(self):
         """设置文件监控"""
         if not self.config['file_watch']['enabled']:
             return
         
-        debounce_seconds = self.config['file_watch']['debounce_seconds']
-        self.watcher = KnowledgeBaseWatcher(self.updater, debounce_seconds)
+        watch_config = self.config['file_watch']
+        debounce_seconds = watch_config.get('debounce_seconds', 30)
+        self.watcher = KnowledgeBaseWatcher(
+            self.updater, debounce_seconds, self.job_queue,
+            min_quiet_seconds=watch_config.get('min_quiet_seconds', 2),
+            max_delay_seconds=watch_config.get('max_delay_seconds', 120),
+            max_batch_size=watch_config.get('max_batch_size', 500)
+        )
         
         self.observer = Observer()
         self.observer.schedule(
@@ -178,26 +439,85 @@ class UpdateScheduler:
             recursive=True
         )
         
-        print(f"设置文件监控: {self.updater.knowledge_base_path} (防抖动 {debounce_seconds}s)")
+        print(f"设置文件监控: {self.updater.knowledge_base_path} "
+              f"(防抖动 {self.watcher.min_quiet_seconds}-{debounce_seconds}s, 最长延迟 {self.watcher.max_delay_seconds}s)")
     
-    def run_scheduled_update(self):
-        """运行定时更新"""
-        print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 执行定时更新...")
+    def on_update_complete(self, job: UpdateJob, result: Optional[Dict], error: Optional[Exception]):
+        """更新队列中的任务完成后记录统计并输出结果"""
+        label = {'scheduled': '定时更新', 'watch': '自动更新', 'manual': '手动更新', 'compact': '索引压缩'}[job.kind]
+        if error is not None:
+            print(f"❌ {label}失败: {error}")
+            self.write_metrics()
+            return
         
-        try:
-            result = self.updater.incremental_update()
-            
+        if job.changed_at is not None:
+            self.freshness_samples.append(time.time() - job.changed_at)
+        now = datetime.now().isoformat()
+        if job.kind == 'scheduled':
             self.stats['scheduled_updates'] += 1
-            self.stats['last_scheduled_update'] = datetime.now().isoformat()
-            
-            if result['status'] == 'success':
-                print(f"✅ 定时更新成功! 耗时 {result['duration']:.2f} 秒")
-                print(f"   变更统计: +{result['changes']['added']} ~{result['changes']['modified']} -{result['changes']['deleted']}")
-            elif result['status'] == 'no_changes':
-                print("ℹ️ 知识库已是最新状态")
-            
-        except Exception as e:
-            print(f"❌ 定时更新失败: {e}")
+            self.stats['last_scheduled_update'] = now
+        elif job.kind == 'watch':
+            self.stats['file_watch_updates'] += 1
+            self.stats['last_file_watch_update'] = now
+        elif job.kind == 'compact':
+            if result['status'] == 'compacted':
+                self.stats['compactions'] += 1
+                self.stats['last_compaction'] = now
+        else:
+            self.stats['manual_updates'] += 1
+        
+        if result['status'] == 'success':
+            print(f"✅ {label}成功! 耗时 {result['duration']:.2f} 秒")
+            print(f"   变更统计: +{result['changes']['added']} ~{result['changes']['modified']} -{result['changes']['deleted']}")
+        elif result['status'] == 'no_changes':
+            print("ℹ️ 知识库已是最新状态")
+        elif result['status'] == 'compacted':
+            print(f"✅ {label}成功! 移除 {result['orphans_removed']} 个孤儿向量，耗时 {result['duration']:.2f} 秒")
+        self.write_metrics()
+    
+    def freshness_stats(self) -> Dict:
+        """索引新鲜度延迟统计（秒）：从文件变更到更新完成"""
+        samples = sorted(self.freshness_samples)
+        if not samples:
+            return {'samples': 0}
+        return {
+            'samples': len(samples),
+            'last': round(self.freshness_samples[-1], 2),
+            'p50': round(percentile(samples, 0.5), 2),
+            'p95': round(percentile(samples, 0.95), 2),
+            'max': round(samples[-1], 2)
+        }
+    
+    def write_metrics(self):
+        """把调度器统计写入 monitoring.metrics_file"""
+        monitoring = self.config.get('monitoring', {})
+        metrics_file = monitoring.get('metrics_file')
+        if not monitoring.get('enabled') or not metrics_file:
+            return
+        path = os.path.join(PROJECT_ROOT, metrics_file)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'timestamp': datetime.now().isoformat(),
+                    'updates': self.stats,
+                    'queue': self.job_queue.stats,
+                    'throttling': self.governor.stats,
+                    'freshness_seconds': self.freshness_stats()
+                }, f, indent=2, ensure_ascii=False)
+        except OSError as e:
+            print(f"⚠️ 写入更新指标失败: {e}")
+    
+    def run_scheduled_update(self):
+        """提交定时更新（全量扫描，兜底处理文件监控遗漏的变更）"""
+        print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 提交定时更新...")
+        # 不阻塞调度循环；已有全量更新在排队时会合并
+        self.job_queue.submit('scheduled')
+    
+    def run_compaction(self):
+        """提交索引压缩检查，在没有其他更新排队时执行"""
+        print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 提交索引压缩检查...")
+        self.job_queue.submit('compact')
     
     def start(self):
         """启动调度器"""
@@ -210,6 +530,9 @@ class UpdateScheduler:
         # 设置定时更新
         self.setup_scheduled_updates()
         
+        # 设置索引压缩
+        self.setup_compaction()
+        
         # 设置文件监控
         self.setup_file_watcher()
         
@@ -247,6 +570,11 @@ class UpdateScheduler:
             self.observer.stop()
             self.observer.join()
             print("文件监控已停止")
+        if self.watcher:
+            self.watcher.cancel()
+        
+        # 等待正在执行的更新结束
+        self.job_queue.stop()
         
         # 取消定时任务
         schedule.clear()
@@ -261,6 +589,11 @@ class UpdateScheduler:
         print(f"定时更新次数: {self.stats['scheduled_updates']}")
         print(f"文件监控更新次数: {self.stats['file_watch_updates']}")
         print(f"手动更新次数: {self.stats['manual_updates']}")
+        print(f"索引压缩次数: {self.stats['compactions']}")
+        print(f"合并的重复请求: {self.job_queue.stats['coalesced']}")
+        freshness = self.freshness_stats()
+        if freshness['samples']:
+            print(f"索引新鲜度延迟: p50 {freshness['p50']}s, p95 {freshness['p95']}s, 最大 {freshness['max']}s")
         
         if self.stats['last_scheduled_update']:
             print(f"最后定时更新: {self.stats['last_scheduled_update']}")
@@ -273,20 +606,9 @@ class UpdateScheduler:
         print("执行手动更新...")
         
         try:
-            result = self.updater.incremental_update(force_rebuild=force_rebuild)
-            
-            self.stats['manual_updates'] += 1
-            
-            if result['status'] == 'success':
-                print(f"✅ 手动更新成功! 耗时 {result['duration']:.2f} 秒")
-                print(f"   变更统计: +{result['changes']['added']} ~{result['changes']['modified']} -{result['changes']['deleted']}")
-            elif result['status'] == 'no_changes':
-                print("ℹ️ 知识库已是最新状态")
-            
-            return result
-            
+            # 手动更新优先于排队中的其他任务，等待其完成
+            return self.job_queue.submit('manual', force_rebuild=force_rebuild).result()
         except Exception as e:
-            print(f"❌ 手动更新失败: {e}")
             return {'status': 'error', 'error': str(e)}
 
 def main():
@@ -294,7 +616,7 @@ def main():
     import argparse
     
     parser = argparse.ArgumentParser(description='知识库更新调度器')
-    parser.add_argument('--config', help='配置文件路径')
+    parser.add_argument('--config', default=SCHEDULER_CONFIG_PATH, help='配置文件路径（默认 config/scheduler_config.json）')
     parser.add_argument('--manual', action='store_true', help='执行手动更新后退出')
     parser.add_argument('--force-rebuild', action='store_true', help='强制重建向量存储')
     parser.add_argument('--daemon', action='store_true', help='以守护进程模式运行')
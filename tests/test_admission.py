@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+准入控制单元测试
+"""
+
+import pytest
+import os
+import sys
+import asyncio
+from unittest.mock import Mock, AsyncMock, patch
+from fastapi.testclient import TestClient
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app.main as main_module
+import app.admission as admission_module
+from app.readiness import ReadinessState
+from app.admission import AdmissionController, AdmissionRejected, RateLimiter, TokenBucket
+
+class TestTokenBucket:
+    """令牌桶测试类"""
+
+    def test_burst_then_reject(self):
+        """测试突发容量用尽后返回等待时间"""
+        bucket = TokenBucket(rate_per_second=1.0, capacity=2)
+
+        assert bucket.try_consume() == 0
+        assert bucket.try_consume() == 0
+        assert bucket.try_consume() > 0
+
+    def test_cost_above_burst_charged_as_debt(self):
+        """测试超过突发容量的批量请求放行后记为欠账，后续请求被限流"""
+        limiter = RateLimiter(per_minute=60, burst=10)
+
+        limiter.check("key:a", cost=64)
+        with pytest.raises(AdmissionRejected) as exc_info:
+            limiter.check("key:a", cost=64)
+
+        assert exc_info.value.status_code == 429
+        assert exc_info.value.retry_after >= 60
+        assert limiter._buckets["key:a"].tokens < 0
+
+    def test_refund(self):
+        """测试退还的令牌不超过容量"""
+        bucket = TokenBucket(rate_per_second=0.001, capacity=2)
+        bucket.try_consume(2)
+
+        bucket.refund(5)
+
+        assert bucket.tokens == 2
+
+    def test_rate_limiter_per_client(self):
+        """测试不同客户端使用独立的令牌桶"""
+        limiter = RateLimiter(per_minute=60, burst=1)
+
+        limiter.check("key:a")
+        limiter.check("key:b")
+        with pytest.raises(AdmissionRejected) as exc_info:
+            limiter.check("key:a")
+
+        assert exc_info.value.status_code == 429
+        assert exc_info.value.retry_after >= 1
+        assert limiter.rejected == 1
+
+    def test_rate_limiter_disabled(self):
+        """测试速率为0时不限流"""
+        limiter = RateLimiter(per_minute=0, burst=1)
+
+        for _ in range(10):
+            limiter.check("key:a")
+
+class TestAdmissionController:
+    """准入控制器测试类"""
+
+    @pytest.mark.asyncio
+    async def test_queue_full_rejects_immediately(self):
+        """测试队列已满时立即返回503"""
+        controller = AdmissionController(max_concurrency=1, max_queue_depth=1, max_wait_seconds=5,
+                                         rate_limiter=RateLimiter(per_minute=0))
+        await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+
+        with pytest.raises(AdmissionRejected) as exc_info:
+            await controller.acquire()
+        assert exc_info.value.status_code == 503
+        assert controller.stats()["queue_depth"] == 1
+
+        controller.release(0.1)
+        await waiter
+        controller.release(0.1)
+        assert controller.stats()["rejected_queue_full"] == 1
+        assert controller.stats()["admitted"] == 2
+
+    @pytest.mark.asyncio
+    async def test_queue_full_refunds_tokens(self):
+        """测试因队列已满被拒绝的请求退还令牌"""
+        limiter = RateLimiter(per_minute=60, burst=2)
+        controller = AdmissionController(max_concurrency=1, max_queue_depth=0, max_wait_seconds=5,
+                                         rate_limiter=limiter)
+        await controller.acquire("key:a")
+
+        with pytest.raises(AdmissionRejected) as exc_info:
+            await controller.acquire("key:a")
+
+        assert exc_info.value.status_code == 503
+        assert limiter._buckets["key:a"].tokens == pytest.approx(1, abs=0.01)
+        controller.release(0.1)
+
+    @pytest.mark.asyncio
+    async def test_wait_timeout(self):
+        """测试排队超时返回503并恢复队列长度"""
+        controller = AdmissionController(max_concurrency=1, max_queue_depth=4, max_wait_seconds=0.05,
+                                         rate_limiter=RateLimiter(per_minute=0))
+        await controller.acquire()
+
+        with pytest.raises(AdmissionRejected) as exc_info:
+            await controller.acquire()
+
+        assert exc_info.value.status_code == 503
+        assert controller.queue_depth == 0
+        assert controller.rejected_timeout == 1
+
+    @pytest.mark.asyncio
+    async def test_admit_releases_on_error(self):
+        """测试处理出错时也会释放名额"""
+        controller = AdmissionController(max_concurrency=1, rate_limiter=RateLimiter(per_minute=0))
+
+        with pytest.raises(ValueError):
+            async with controller.admit():
+                raise ValueError("处理失败")
+
+        assert controller.in_flight == 0
+        async with controller.admit():
+            assert controller.in_flight == 1
+
+class TestAdmissionAPI:
+    """API准入控制测试类"""
+
+    @pytest.fixture
+    def client(self, monkeypatch):
+        """创建限流较严的测试客户端"""
+        handler = Mock()
+        handler.warmup = AsyncMock(return_value={})
+        handler.get_answer = AsyncMock(return_value={"answer": "测试回答", "source_documents": []})
+        monkeypatch.setattr(admission_module, "API_KEYS", frozenset({"test-key", "other"}))
+        monkeypatch.setattr(main_module, "readiness", ReadinessState())
+        monkeypatch.setattr(main_module, "admission",
+                            AdmissionController(max_concurrency=1, rate_limiter=RateLimiter(per_minute=60, burst=1)))
+        with patch('app.main.RAGHandler', return_value=handler):
+            with TestClient(main_module.app) as client:
+                yield client
+
+    def test_rate_limited_with_retry_after(self, client):
+        """测试超过速率时返回429和Retry-After"""
+        headers = {"X-API-Key": "test-key"}
+
+        assert client.post("/ask", json={"query": "问题"}, headers=headers).status_code == 200
+        response = client.post("/ask", json={"query": "问题"}, headers=headers)
+
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+
+        # 其他API密钥不受影响
+        assert client.post("/ask", json={"query": "问题"}, headers={"X-API-Key": "other"}).status_code == 200
+
+    def test_unregistered_keys_share_client_bucket(self, client):
+        """测试轮换未登记的API密钥不能绕过按客户端地址的限流"""
+        assert client.post("/ask", json={"query": "问题"}, headers={"X-API-Key": "random-1"}).status_code == 200
+        response = client.post("/ask", json={"query": "问题"}, headers={"X-API-Key": "random-2"})
+
+        assert response.status_code == 429
+
+    def test_ready_exposes_admission_stats(self, client):
+        """测试就绪检查返回队列指标"""
+        client.post("/ask", json={"query": "问题"})
+
+        stats = client.get("/ready").json()["admission"]
+
+        assert stats["admitted"] == 1
+        assert stats["queue_depth"] == 0
+        assert "p95" in stats["queue_wait_seconds"]
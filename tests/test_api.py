@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+API层单元测试
+"""
+
+import pytest
+import os
+import sys
+import asyncio
+import threading
+from unittest.mock import Mock, AsyncMock, patch
+from fastapi.testclient import TestClient
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app.main as main_module
+from app.readiness import ReadinessState
+
+class TestReadiness:
+    """就绪检查测试类"""
+    
+    @pytest.fixture
+    def mock_handler(self):
+        """模拟RAG处理器"""
+        handler = Mock()
+        handler.warmup = AsyncMock(return_value={"embed": 0.1, "retrieve": 0.01, "generate": 0.5})
+        handler.get_answer = AsyncMock(return_value={"answer": "测试回答", "source_documents": []})
+        return handler
+    
+    @pytest.fixture
+    def client(self, mock_handler):
+        """创建测试客户端"""
+        main_module.readiness = ReadinessState()
+        with patch('app.main.RAGHandler', return_value=mock_handler):
+            with TestClient(main_module.app) as client:
+                yield client
+    
+    def test_ready_after_warmup(self, client, mock_handler):
+        """测试预热完成后就绪检查返回200"""
+        response = client.get("/ready")
+        
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+        mock_handler.warmup.assert_awaited_once()
+    
+    def test_not_ready_before_warmup(self, client):
+        """测试预热完成前返回503"""
+        main_module.readiness.mark_not_ready("warming_up")
+        
+        response = client.get("/ready")
+        
+        assert response.status_code == 503
+        assert response.json()["status"] == "warming_up"
+    
+    def test_warmup_failure(self):
+        """测试预热重试次数用尽后保持未就绪"""
+        handler = Mock()
+        handler.warmup = AsyncMock(side_effect=ConnectionError("Ollama不可用"))
+        state = ReadinessState(max_attempts=3, retry_delay=0)
+        
+        assert asyncio.run(state.run_warmup(handler)) is False
+        assert not state.is_ready
+        assert handler.warmup.await_count == 3
+        assert "Ollama不可用" in state.to_dict()["error"]
+    
+    def test_warmup_retry_with_backoff(self):
+        """测试预热失败后按指数退避重试，成功后变为就绪"""
+        handler = Mock()
+        handler.warmup = AsyncMock(side_effect=[ConnectionError("Ollama不可用"), ConnectionError("Ollama不可用"), {}])
+        state = ReadinessState(max_attempts=5, retry_delay=1, max_retry_delay=1.5)
+        
+        with patch('app.readiness.asyncio.sleep', new=AsyncMock()) as sleep:
+            assert asyncio.run(state.run_warmup(handler)) is True
+        
+        assert state.is_ready
+        assert state.to_dict()["warmup_attempts"] == 3
+        assert [call.args[0] for call in sleep.await_args_list] == [1, 1.5]
+    
+    def test_ask(self, client):
+        """测试问答端点"""
+        response = client.post("/ask", json={"query": "测试问题"})
+        
+        assert response.status_code == 200
+        assert response.json()["answer"] == "测试回答"
+
+class TestAskBatch:
+    """批量问答测试类"""
+    
+    @pytest.fixture
+    def client(self):
+        """创建测试客户端"""
+        handler = Mock()
+        handler.warmup = AsyncMock(return_value={})
+        handler.get_answers = AsyncMock(side_effect=lambda queries: [
+            {"query": q, "answer": f"回答:{q}", "source_documents": []} for q in queries
+        ])
+        with patch('app.main.RAGHandler', return_value=handler):
+            with TestClient(main_module.app) as client:
+                yield client
+    
+    def test_results_in_input_order(self, client):
+        """测试批量结果与输入顺序一致"""
+        response = client.post("/ask_batch", json={"queries": ["问题1", "问题2", "问题3"]})
+        
+        assert response.status_code == 200
+        assert [r["answer"] for r in response.json()["results"]] == ["回答:问题1", "回答:问题2", "回答:问题3"]
+    
+    def test_batch_size_limit(self, client):
+        """测试超过最大问题数时返回400"""
+        queries = ["问题"] * (main_module.MAX_BATCH_QUERIES + 1)
+        
+        response = client.post("/ask_batch", json={"queries": queries})
+        
+        assert response.status_code == 400
+    
+    def test_handler_batch_pipeline(self):
+        """测试处理器批量流程：一次嵌入、一次检索、逐项错误"""
+        from app.rag_handler import RAGHandler
+        from langchain_core.messages import AIMessage
+        
+        handler = RAGHandler.__new__(RAGHandler)
+        handler.embeddings = Mock()
+        handler.embeddings.aembed_documents = AsyncMock(return_value=[[1.0], [2.0]])
+        handler.prompt = Mock()
+        handler.prompt.invoke = Mock(side_effect=lambda values: values["input"])
+        handler.llm = Mock()
+        handler.llm.abatch = AsyncMock(return_value=[AIMessage(content="答案A"), RuntimeError("超时")])
+        handler.vector_store = Mock()
+        
+        search_threads = []
+        def search(*args):
+            search_threads.append(threading.current_thread())
+            return [[], []]
+        
+        with patch('app.rag_handler.batch_similarity_search', side_effect=search) as mock_search:
+            results = asyncio.run(handler.get_answers(["问题A", "", "问题B"]))
+        
+        handler.embeddings.aembed_documents.assert_awaited_once_with(["问题A", "问题B"])
+        mock_search.assert_called_once()
+        # FAISS检索不在事件循环线程中执行
+        assert search_threads[0] is not threading.main_thread()
+        assert results[0]["answer"] == "答案A"
+        assert results[1]["error"] == "问题不能为空"
+        assert "超时" in results[2]["error"]
+
+class TestLoRAModelSwitch:
+    """LoRA服务模型切换测试类"""
+    
+    @pytest.fixture
+    def lora_client(self, monkeypatch):
+        """使用模拟处理器的LoRA服务客户端（不执行启动事件）"""
+        import app.lora_main as lora_main
+        from app.admission import AdmissionController, RateLimiter
+        
+        handler = Mock(use_lora=True, base_model_name="base", lora_model_path="lora")
+        handler.switch_model = Mock(side_effect=lambda use_lora: setattr(handler, "use_lora", use_lora))
+        handler.warmup = AsyncMock(return_value={})
+        handler.get_answer = AsyncMock(return_value={"answer": "测试回答", "source_documents": []})
+        handler.lora_backend = None
+        state = ReadinessState()
+        state.state = "ready"
+        monkeypatch.setattr(lora_main, "rag_handler", handler)
+        monkeypatch.setattr(lora_main, "readiness", state)
+        monkeypatch.setattr(lora_main, "admission", AdmissionController(rate_limiter=RateLimiter(per_minute=0)))
+        return TestClient(lora_main.app), handler, state
+    
+    def test_ask_with_other_mode_rewarms(self, lora_client):
+        """测试 /ask 请求切换模型模式时与 /switch_model 一样重新预热"""
+        client, handler, state = lora_client
+        
+        response = client.post("/ask", json={"query": "问题", "use_lora": False})
+        
+        assert response.status_code == 200
+        handler.switch_model.assert_called_once_with(False)
+        handler.warmup.assert_awaited_once()
+        assert state.is_ready
+        assert state.warmup_task is not None
+    
+    def test_same_mode_does_not_rewarm(self, lora_client):
+        """测试模式未变化时不切换也不预热"""
+        client, handler, state = lora_client
+        
+        client.post("/ask", json={"query": "问题", "use_lora": True})
+        
+        handler.switch_model.assert_not_called()
+        handler.warmup.assert_not_awaited()
+
+if __name__ == "__main__":
+    pytest.main([__file__])
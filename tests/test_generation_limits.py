@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+生成长度限制单元测试
+"""
+
+import pytest
+import os
+import sys
+import numpy as np
+from unittest.mock import patch
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.generation_limits import AnswerLengthStats, StopSequenceCriteria, DeadlineCriteria, load_answer_lengths
+
+class TestAnswerLengthStats:
+    """回答长度统计测试类"""
+    
+    def test_uses_max_tokens_without_samples(self):
+        """测试样本不足时使用最大上限"""
+        stats = AnswerLengthStats(max_tokens=512, min_samples=20)
+        stats.record_many("ask", [10] * 5)
+        
+        assert stats.token_cap("ask") == 512
+    
+    def test_learns_cap_from_percentile(self):
+        """测试按分位数和余量计算上限"""
+        stats = AnswerLengthStats(max_tokens=512, min_tokens=16, percentile=0.95, headroom=1.5, min_samples=20)
+        stats.record_many("ask", list(range(1, 101)))
+        
+        assert stats.token_cap("ask") == 143  # ceil(95 * 1.5)
+    
+    def test_falls_back_until_route_has_min_samples(self):
+        """测试路由样本不足时使用默认路由的上限，样本达到min_samples后切换为自身上限"""
+        stats = AnswerLengthStats(max_tokens=512, min_tokens=16, headroom=1.0, min_samples=20)
+        stats.record_many("default", [100] * 20)
+        stats.record("ask", 40)
+
+        assert stats.token_cap("ask", fallback_route="default") == 100
+
+        stats.record_many("ask", [40] * 18)
+        assert stats.token_cap("ask", fallback_route="default") == 100
+
+        stats.record("ask", 40)
+        assert stats.token_cap("ask", fallback_route="default") == 40
+
+    def test_cap_is_clamped(self):
+        """测试上限被限制在[min_tokens, max_tokens]内"""
+        stats = AnswerLengthStats(max_tokens=256, min_tokens=64, min_samples=1)
+        stats.record_many("short", [5] * 10)
+        stats.record_many("long", [1000] * 10)
+        
+        assert stats.token_cap("short") == 64
+        assert stats.token_cap("long") == 256
+    
+    def test_seed_from_finetune_dataset(self):
+        """测试从微调数据集读取回答长度"""
+        lengths = load_answer_lengths(len)
+        
+        assert len(lengths) > 0
+        assert all(length > 0 for length in lengths)
+
+class TestStoppingCriteria:
+    """提前结束条件测试类"""
+    
+    def test_stop_sequence_in_generated_tail(self):
+        """测试生成部分以停止序列结尾时结束"""
+        criteria = StopSequenceCriteria([[7, 8]], prompt_length=3)
+        
+        assert criteria(np.array([[1, 2, 3, 5, 7, 8]]), None) is True
+        assert criteria(np.array([[1, 2, 3, 7, 8, 5]]), None) is False
+    
+    def test_stop_sequence_ignores_prompt(self):
+        """测试提示中的停止序列不触发结束"""
+        criteria = StopSequenceCriteria([[7, 8]], prompt_length=3)
+        
+        assert criteria(np.array([[1, 7, 8]]), None) is False
+    
+    def test_deadline(self):
+        """测试超过截止时间后结束"""
+        with patch('app.generation_limits.time.monotonic', side_effect=[100.0, 100.5, 102.0]):
+            criteria = DeadlineCriteria(1.0)
+            
+            assert criteria(np.array([[1]]), None) is False
+            assert criteria(np.array([[1]]), None) is True
+            assert criteria.triggered
+
+if __name__ == "__main__":
+    pytest.main([__file__])
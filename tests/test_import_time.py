@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+导入耗时回归测试
+"""
+
+import pytest
+import os
+import sys
+import json
+import subprocess
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from scripts.benchmark_import_time import PROJECT_ROOT, HEAVY_PACKAGES, parse_importtime, slowest_packages
+
+class TestImportTime:
+    """导入耗时测试类"""
+    
+    def test_parse_importtime(self):
+        """测试解析 -X importtime 输出"""
+        stderr = (
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       120 |        120 |     langchain_core.utils\n"
+            "import time:       300 |        420 |   langchain_core\n"
+            "import time:        80 |        500 | app.rag_handler\n"
+        )
+        
+        entries = parse_importtime(stderr)
+        
+        assert [e['depth'] for e in entries] == [2, 1, 0]
+        assert entries[2] == {'module': 'app.rag_handler', 'depth': 0, 'self_us': 80, 'cumulative_us': 500}
+        assert slowest_packages(entries)[0] == {'package': 'langchain_core', 'self_ms': 0.42}
+    
+    @pytest.mark.slow
+    def test_lora_handler_import_skips_heavy_packages(self):
+        """测试导入LoRA处理器模块时不加载torch/transformers/peft"""
+        code = (
+            "import sys, json; import app.lora_rag_handler; "
+            f"print(json.dumps([m for m in {HEAVY_PACKAGES!r} if m in sys.modules]))"
+        )
+        result = subprocess.run([sys.executable, '-c', code], cwd=PROJECT_ROOT, capture_output=True, text=True)
+        
+        assert result.returncode == 0, result.stderr
+        assert json.loads(result.stdout.strip().splitlines()[-1]) == []
+
+if __name__ == "__main__":
+    pytest.main([__file__])
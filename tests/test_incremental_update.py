@@ -0,0 +1,626 @@
+#!/usr/bin/env python3
+"""
+增量更新模块单元测试
+"""
+
+import pytest
+import os
+import sys
+import time
+import json
+import shutil
+import sqlite3
+import hashlib
+import multiprocessing as mp
+from datetime import datetime
+from unittest.mock import patch
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.document_loaders import TextLoader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import scripts.incremental_update as incremental_update
+from scripts.incremental_update import (IncrementalUpdater, FileFilter, ResourceGovernor, load_file_filter,
+                                        lower_process_priority)
+
+def write_file(path, content: str, mtime_ns: int = None):
+    """写入文件并设置mtime（默认设为较早的时间，避免被视为刚写入的文件）"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    mtime_ns = mtime_ns or 1_600_000_000 * 10**9
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+@pytest.fixture
+def updater(tmp_path):
+    """指向临时目录的增量更新器"""
+    updater = IncrementalUpdater(filters={}, governor=ResourceGovernor())
+    updater.knowledge_base_path = str(tmp_path / "notes")
+    updater.vector_store_path = str(tmp_path / "vector_store")
+    updater.metadata_path = str(tmp_path / "update_metadata.db")
+    write_file(os.path.join(updater.knowledge_base_path, "a.md"), "# 产品A\n\n保修一年。")
+    write_file(os.path.join(updater.knowledge_base_path, "sub", "b.md"), "# 产品B\n\n保修两年。")
+    write_file(os.path.join(updater.knowledge_base_path, "ignore.txt"), "不支持的类型")
+    return updater
+
+class CountingEmbedding(DeterministicFakeEmbedding):
+    """记录嵌入过的文本"""
+    embedded: list = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+@pytest.fixture
+def chunk_updater(updater):
+    """使用假嵌入和纯文本加载器、按段落分块的增量更新器"""
+    updater.embeddings = CountingEmbedding(size=8, embedded=[])
+    updater.file_loaders = {'.md': lambda path: TextLoader(path, encoding='utf-8')}
+    updater.text_splitter = RecursiveCharacterTextSplitter(chunk_size=10, chunk_overlap=0,
+                                                           separators=["\n\n"], keep_separator=False)
+    return updater
+
+def text_loader(path):
+    """纯文本加载器（模块级函数，可传给加载进程）"""
+    return TextLoader(path, encoding='utf-8')
+
+def hanging_text_loader(path):
+    """文件名含hang时模拟卡住的解析"""
+    if 'hang' in os.path.basename(path):
+        time.sleep(60)
+    return TextLoader(path, encoding='utf-8')
+
+def broken_text_loader(path):
+    if 'broken' in os.path.basename(path):
+        raise ValueError("无法解析")
+    return TextLoader(path, encoding='utf-8')
+
+def paragraphs(*items):
+    return "\n\n".join(items)
+
+class TestChangeDetection:
+    """变更检测测试类"""
+
+    def test_scan_hashes_supported_files(self, updater):
+        """测试首次扫描哈希所有支持的文件"""
+        files = updater.scan_documents()
+
+        assert set(files) == {"a.md", os.path.join("sub", "b.md")}
+        assert all(info['hash'] for info in files.values())
+        assert files["a.md"]['mtime_ns'] == 1_600_000_000 * 10**9
+
+    def test_unchanged_stat_skips_hashing(self, updater):
+        """测试大小和mtime都未变化的文件沿用记录中的哈希，不再读取内容"""
+        previous = updater.file_records(updater.scan_documents())
+
+        with patch.object(updater, 'calculate_file_hash') as calculate:
+            files = updater.scan_documents(previous)
+
+        calculate.assert_not_called()
+        assert updater.file_records(files) == previous
+
+    def test_changed_stat_rehashes(self, updater):
+        """测试stat变化的文件重新哈希，内容相同时不视为修改"""
+        metadata = {'file_hashes': updater.file_records(updater.scan_documents())}
+        path_a = os.path.join(updater.knowledge_base_path, "a.md")
+        path_b = os.path.join(updater.knowledge_base_path, "sub", "b.md")
+        write_file(path_a, "# 产品A\n\n保修三年。", mtime_ns=1_600_000_100 * 10**9)
+        write_file(path_b, "# 产品B\n\n保修两年。", mtime_ns=1_600_000_100 * 10**9)
+
+        files = updater.scan_documents(metadata['file_hashes'])
+        added, modified, deleted = updater.detect_changes(files, metadata['file_hashes'])
+
+        assert modified == {"a.md"}
+        assert not added and not deleted
+
+    def test_recent_mtime_not_trusted(self, updater):
+        """测试刚写入的文件不记录mtime_ns，下次扫描仍会重新哈希"""
+        path = os.path.join(updater.knowledge_base_path, "new.md")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("刚写入")
+
+        files = updater.scan_documents()
+
+        assert files["new.md"]['hash']
+        assert files["new.md"]['mtime_ns'] is None
+
+    def test_legacy_md5_metadata(self, updater):
+        """测试兼容旧版只保存MD5字符串的元数据"""
+        path_a = os.path.join(updater.knowledge_base_path, "a.md")
+        with open(path_a, 'rb') as f:
+            legacy_hash = hashlib.md5(f.read()).hexdigest()
+        metadata = {'file_hashes': {"a.md": legacy_hash, "deleted.md": "0" * 32}}
+
+        files = updater.scan_documents(metadata['file_hashes'])
+        added, modified, deleted = updater.detect_changes(files, metadata['file_hashes'])
+
+        assert added == {os.path.join("sub", "b.md")}
+        assert not modified
+        assert deleted == {"deleted.md"}
+
+    def test_no_changes_persists_stat(self, updater):
+        """测试无变更时也保存新的stat记录，使下次扫描走快速路径"""
+        updater.save_metadata({'file_hashes': updater.file_records(updater.scan_documents())})
+        path_a = os.path.join(updater.knowledge_base_path, "a.md")
+        os.utime(path_a, ns=(1_600_000_200 * 10**9, 1_600_000_200 * 10**9))
+
+        result = updater.incremental_update()
+
+        assert result['status'] == 'no_changes'
+        assert updater.load_metadata()['file_hashes']["a.md"]['mtime_ns'] == 1_600_000_200 * 10**9
+
+class TestChunkDiff:
+    """文档块级增量更新测试类"""
+
+    def test_modified_file_embeds_changed_chunks_only(self, chunk_updater):
+        """测试修改一个段落时只嵌入该段落，删除其旧文档块"""
+        path = os.path.join(chunk_updater.knowledge_base_path, "manual.md")
+        write_file(path, paragraphs("第一段：安装说明", "第二段：保修一年", "第三段：联系方式"))
+        chunk_updater.incremental_update()
+        chunk_updater.embeddings.embedded.clear()
+
+        write_file(path, paragraphs("第一段：安装说明", "第二段：保修两年", "第三段：联系方式"),
+                   mtime_ns=1_600_000_100 * 10**9)
+        result = chunk_updater.incremental_update()
+
+        assert chunk_updater.embeddings.embedded == ["第二段：保修两年"]
+        assert result['chunks'] == {'embedded': 1, 'reused': 2, 'removed': 1}
+        store = chunk_updater.load_existing_vector_store()
+        contents = {doc.page_content for doc in store.docstore._dict.values()}
+        assert "第二段：保修一年" not in contents
+        assert "第二段：保修两年" in contents
+        records = chunk_updater.load_metadata()['file_chunks']["manual.md"]
+        assert len(records) == 3
+        assert all(store.docstore.search(record['id']).metadata['file_path'] == "manual.md" for record in records)
+
+    def test_reused_chunk_metadata_refreshed(self, chunk_updater):
+        """测试沿用的文档块更新为本次加载的文件哈希和修改时间"""
+        path = os.path.join(chunk_updater.knowledge_base_path, "manual.md")
+        write_file(path, paragraphs("第一段：安装说明", "第二段：保修一年"))
+        chunk_updater.incremental_update()
+
+        write_file(path, paragraphs("第一段：安装说明", "第二段：保修两年"), mtime_ns=1_600_000_100 * 10**9)
+        chunk_updater.incremental_update()
+
+        file_hash = chunk_updater.load_metadata()['file_hashes']["manual.md"]['hash']
+        store = chunk_updater.load_existing_vector_store()
+        reused = next(doc for doc in store.docstore._dict.values() if doc.page_content == "第一段：安装说明")
+        assert reused.metadata['file_hash'] == file_hash
+        assert reused.metadata['last_modified'] == 1_600_000_100
+
+    def test_empty_file_recorded_without_chunks(self, chunk_updater):
+        """测试内容被清空的文件删除旧文档块并记录为已处理，不再反复重试"""
+        chunk_updater.incremental_update()
+        write_file(os.path.join(chunk_updater.knowledge_base_path, "a.md"), "", mtime_ns=1_600_000_100 * 10**9)
+
+        result = chunk_updater.incremental_update()
+
+        assert result['chunks']['removed'] == 2
+        assert chunk_updater.load_metadata()['file_chunks'].get("a.md", []) == []
+        assert chunk_updater.load_metadata()['file_hashes']["a.md"]['hash']
+        assert not chunk_updater.metadata_store.pending_paths()
+        assert chunk_updater.incremental_update()['status'] == 'no_changes'
+
+    def test_old_chunks_deleted_once_per_flush(self, chunk_updater):
+        """测试多个修改文件的旧文档块在写入新块时一次删除"""
+        chunk_updater.incremental_update()
+        write_file(os.path.join(chunk_updater.knowledge_base_path, "a.md"), "# 产品A\n\n保修三年。",
+                   mtime_ns=1_600_000_100 * 10**9)
+        write_file(os.path.join(chunk_updater.knowledge_base_path, "sub", "b.md"), "# 产品B\n\n保修四年。",
+                   mtime_ns=1_600_000_100 * 10**9)
+
+        with patch.object(FAISS, 'delete', autospec=True, side_effect=FAISS.delete) as delete:
+            result = chunk_updater.incremental_update()
+
+        assert delete.call_count == 1
+        assert len(delete.call_args.args[1]) == result['chunks']['removed'] == 2
+        store = chunk_updater.load_existing_vector_store()
+        assert store.index.ntotal == len(store.docstore._dict)
+
+    def test_deleted_file_removes_chunks(self, chunk_updater):
+        """测试删除文件时从向量存储中删除其全部文档块"""
+        chunk_updater.incremental_update()
+        removed_ids = [record['id'] for record in chunk_updater.load_metadata()['file_chunks']["a.md"]]
+        os.remove(os.path.join(chunk_updater.knowledge_base_path, "a.md"))
+
+        result = chunk_updater.incremental_update()
+
+        store = chunk_updater.load_existing_vector_store()
+        paths = {doc.metadata['file_path'] for doc in store.docstore._dict.values()}
+        assert paths == {os.path.join("sub", "b.md")}
+        assert store.index.ntotal == len(store.docstore._dict)
+        assert result['chunks']['removed'] == len(removed_ids)
+        assert not set(removed_ids) & set(store.docstore._dict)
+        assert "a.md" not in chunk_updater.load_metadata()['file_chunks']
+
+    def test_legacy_store_chunks_found_by_source(self, chunk_updater):
+        """测试旧版向量存储（无文档块记录）按source元数据找到文件的旧文档块"""
+        from langchain_community.vectorstores import FAISS
+        from langchain_core.documents import Document
+
+        path = os.path.join(chunk_updater.knowledge_base_path, "a.md")
+        FAISS.from_documents(
+            [Document(page_content="旧内容", metadata={"source": path})],
+            chunk_updater.embeddings
+        ).save_local(chunk_updater.vector_store_path)
+
+        chunk_updater.incremental_update()
+
+        store = chunk_updater.load_existing_vector_store()
+        contents = {doc.page_content for doc in store.docstore._dict.values()}
+        assert "旧内容" not in contents
+
+class TestTargetedUpdate:
+    """按变更路径增量更新测试类"""
+
+    def test_update_files_checks_only_given_paths(self, chunk_updater):
+        """测试只检查指定路径，不遍历整个知识库"""
+        chunk_updater.incremental_update()
+        path_a = os.path.join(chunk_updater.knowledge_base_path, "a.md")
+        write_file(path_a, "# 产品A\n\n保修三年。", mtime_ns=1_600_000_100 * 10**9)
+        write_file(os.path.join(chunk_updater.knowledge_base_path, "new.md"), "# 新产品")
+
+        with patch.object(chunk_updater, 'scan_documents') as scan_documents:
+            result = chunk_updater.update_files({("a.md", "modified")})
+
+        scan_documents.assert_not_called()
+        assert result['changes'] == {'added': 0, 'modified': 1, 'deleted': 0}
+        file_hashes = chunk_updater.load_metadata()['file_hashes']
+        assert set(file_hashes) == {"a.md", os.path.join("sub", "b.md")}
+
+    def test_update_files_deleted_and_moved(self, chunk_updater):
+        """测试删除和移动（删除+创建）事件"""
+        chunk_updater.incremental_update()
+        kb = chunk_updater.knowledge_base_path
+        os.rename(os.path.join(kb, "a.md"), os.path.join(kb, "c.md"))
+
+        result = chunk_updater.update_files({("a.md", "deleted"), ("c.md", "created")})
+
+        assert result['changes'] == {'added': 1, 'modified': 0, 'deleted': 1}
+        assert set(chunk_updater.load_metadata()['file_chunks']) == {"c.md", os.path.join("sub", "b.md")}
+
+    def test_update_files_directory_removed(self, chunk_updater):
+        """测试删除目录时删除其中已入库的文件"""
+        chunk_updater.incremental_update()
+        shutil.rmtree(os.path.join(chunk_updater.knowledge_base_path, "sub"))
+
+        result = chunk_updater.update_files({("sub", "deleted")})
+
+        assert result['changes']['deleted'] == 1
+        assert set(chunk_updater.load_metadata()['file_hashes']) == {"a.md"}
+
+class TestParallelLoading:
+    """变更文件并行加载测试类"""
+
+    @pytest.fixture
+    def parallel_updater(self, chunk_updater, monkeypatch):
+        monkeypatch.setattr(incremental_update, "LOAD_WORKERS", 2)
+        chunk_updater.file_loaders = {'.md': text_loader}
+        return chunk_updater
+
+    def test_parallel_load(self, parallel_updater):
+        """测试多个文件在进程池中加载、分割并写入向量存储"""
+        result = parallel_updater.incremental_update()
+
+        assert result['changes']['added'] == 2
+        assert result['chunks']['embedded'] == 4
+        records = parallel_updater.load_metadata()['file_chunks']
+        assert set(records) == {"a.md", os.path.join("sub", "b.md")}
+
+    def test_hanging_file_times_out(self, parallel_updater, monkeypatch):
+        """测试卡住的文件超时后被跳过，其余文件正常处理，且下次更新重试"""
+        monkeypatch.setattr(incremental_update, "LOAD_TIMEOUT_SECONDS", 8)
+        parallel_updater.file_loaders = {'.md': hanging_text_loader}
+        write_file(os.path.join(parallel_updater.knowledge_base_path, "hang.md"), "卡住")
+
+        started = time.time()
+        parallel_updater.incremental_update()
+
+        assert time.time() - started < 30
+        metadata = parallel_updater.load_metadata()
+        assert set(metadata['file_chunks']) == {"a.md", os.path.join("sub", "b.md")}
+        assert "hang.md" not in metadata['file_hashes']
+
+    def test_failed_file_keeps_others(self, parallel_updater):
+        """测试解析失败的文件不影响同批其他文件"""
+        parallel_updater.file_loaders = {'.md': broken_text_loader}
+        write_file(os.path.join(parallel_updater.knowledge_base_path, "broken.md"), "损坏")
+
+        result = parallel_updater.incremental_update()
+
+        assert result['chunks']['embedded'] == 4
+        assert "broken.md" not in parallel_updater.load_metadata()['file_hashes']
+
+DEFAULT_FILTERS = {
+    "include_patterns": ["*.md", "*.pdf", "*.docx", "*.doc"],
+    "exclude_patterns": [".*", "*~", "*.tmp", "*.bak", "node_modules/**", ".git/**", "drafts/old/**"],
+    "min_file_size_bytes": 10,
+    "max_file_size_mb": 1
+}
+
+class TestFileFilter:
+    """文件过滤规则测试类"""
+
+    def test_patterns(self):
+        """测试包含/排除模式"""
+        file_filter = FileFilter.from_config(DEFAULT_FILTERS)
+
+        assert file_filter.includes_path("manual.md")
+        assert file_filter.includes_path(os.path.join("产品", "手册.PDF"))
+        assert not file_filter.includes_path("notes.txt")
+        assert not file_filter.includes_path("manual.md.tmp")
+        assert not file_filter.includes_path(".hidden.md")
+        assert not file_filter.includes_path(os.path.join("vendor", "node_modules", "pkg", "README.md"))
+        assert not file_filter.includes_path(os.path.join(".git", "info.md"))
+        assert not file_filter.includes_path(os.path.join("drafts", "old", "a.md"))
+        assert file_filter.includes_path(os.path.join("other", "drafts", "old", "a.md"))
+
+    def test_sizes(self):
+        """测试文件大小限制"""
+        file_filter = FileFilter.from_config(DEFAULT_FILTERS)
+
+        assert not file_filter.includes_size(9)
+        assert file_filter.includes_size(10)
+        assert not file_filter.includes_size(2 * 1024 * 1024)
+
+    def test_empty_filter_allows_all(self):
+        """测试没有过滤配置时不过滤"""
+        file_filter = FileFilter()
+
+        assert file_filter.includes_path(os.path.join(".git", "a.md"))
+        assert file_filter.includes_size(0)
+
+    def test_default_config(self):
+        """测试从仓库的调度器配置读取过滤规则"""
+        file_filter = load_file_filter()
+
+        assert not file_filter.includes_path(os.path.join("node_modules", "a.md"))
+        assert file_filter.min_size == 10
+
+    def test_walk_prunes_excluded_dirs(self, updater):
+        """测试遍历时不进入被排除的目录，并应用大小限制"""
+        updater.file_filter = FileFilter.from_config(DEFAULT_FILTERS)
+        kb = updater.knowledge_base_path
+        write_file(os.path.join(kb, "node_modules", "pkg", "README.md"), "# 第三方包说明文档")
+        write_file(os.path.join(kb, ".git", "notes.md"), "# git内部文件内容")
+        write_file(os.path.join(kb, "tiny.md"), "短")
+        write_file(os.path.join(kb, "a.md~"), "# 编辑器备份文件")
+        walked = []
+        real_walk = os.walk
+
+        def recording_walk(top, *args, **kwargs):
+            for root, dirs, files in real_walk(top, *args, **kwargs):
+                walked.append(os.path.relpath(root, kb))
+                yield root, dirs, files
+
+        with patch('scripts.incremental_update.os.walk', recording_walk):
+            files = updater.scan_documents()
+
+        assert set(files) == {"a.md", os.path.join("sub", "b.md")}
+        assert not any(path.startswith(("node_modules", ".git")) for path in walked)
+
+    def test_update_files_applies_filter(self, updater):
+        """测试按变更路径更新时同样应用过滤规则"""
+        updater.file_filter = FileFilter.from_config(DEFAULT_FILTERS)
+        kb = updater.knowledge_base_path
+        write_file(os.path.join(kb, "node_modules", "x.md"), "# 第三方包说明文档")
+
+        assert updater.expand_changed_paths({("node_modules", "created")}) == set()
+        assert updater.scan_files([os.path.join("node_modules", "x.md")]) == {}
+
+class TestMetadataStore:
+    """SQLite元数据存储测试类"""
+
+    def rowids(self, updater):
+        with sqlite3.connect(updater.metadata_path) as conn:
+            return dict(conn.execute("SELECT path, rowid FROM files").fetchall())
+
+    def test_wal_mode_and_versions(self, chunk_updater):
+        """测试使用WAL模式，每次更新向量存储追加一条索引版本记录"""
+        chunk_updater.incremental_update()
+        write_file(os.path.join(chunk_updater.knowledge_base_path, "a.md"), "# 产品A\n\n保修三年。",
+                   mtime_ns=1_600_000_100 * 10**9)
+        chunk_updater.incremental_update()
+
+        with sqlite3.connect(chunk_updater.metadata_path) as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        latest = chunk_updater.metadata_store.latest_version()
+        assert latest['version'] == 2
+        assert latest['embedded'] == 1 and latest['removed'] == 1
+        assert latest['total_documents'] == 2 and latest['total_chunks'] == 4
+
+    def test_update_rewrites_changed_rows_only(self, chunk_updater):
+        """测试只改写变更文件的记录，其余文件的行保持不变"""
+        chunk_updater.incremental_update()
+        before = self.rowids(chunk_updater)
+        write_file(os.path.join(chunk_updater.knowledge_base_path, "a.md"), "# 产品A\n\n保修三年。",
+                   mtime_ns=1_600_000_100 * 10**9)
+
+        chunk_updater.update_files({("a.md", "modified")})
+
+        after = self.rowids(chunk_updater)
+        assert after[os.path.join("sub", "b.md")] == before[os.path.join("sub", "b.md")]
+        assert after["a.md"] != before["a.md"]
+
+    def test_migrate_legacy_json(self, chunk_updater, tmp_path):
+        """测试首次打开时导入旧版 update_metadata.json，并重命名为 .bak"""
+        chunk_updater.incremental_update()
+        legacy = chunk_updater.load_metadata()
+        os.remove(chunk_updater.metadata_path)
+        legacy_path = tmp_path / "update_metadata.json"
+        legacy_path.write_text(json.dumps(legacy, ensure_ascii=False), encoding='utf-8')
+        chunk_updater.metadata_path = str(tmp_path / "migrated.db")
+        os.rename(legacy_path, tmp_path / "migrated.json")
+        chunk_updater.embeddings.embedded.clear()
+
+        result = chunk_updater.incremental_update()
+
+        assert result['status'] == 'no_changes'
+        assert chunk_updater.embeddings.embedded == []
+        assert chunk_updater.load_metadata()['file_chunks'] == legacy['file_chunks']
+        assert not os.path.exists(tmp_path / "migrated.json")
+        assert os.path.exists(tmp_path / "migrated.json.bak")
+
+class TestCompaction:
+    """向量索引压缩测试类"""
+
+    def add_orphans(self, updater, count):
+        """向向量存储中加入没有文档块记录的向量"""
+        store = updater.load_existing_vector_store()
+        store.add_texts([f"遗留内容{i}" for i in range(count)])
+        store.save_local(updater.vector_store_path)
+
+    def test_below_threshold_skipped(self, chunk_updater):
+        """测试没有孤儿向量时不重建"""
+        chunk_updater.incremental_update()
+
+        result = chunk_updater.compact()
+
+        assert result['status'] == 'skipped'
+        assert result['health']['orphans'] == 0
+
+    def test_orphans_removed_without_embedding(self, chunk_updater, tmp_path):
+        """测试用已存储的向量重建索引、移除孤儿向量，不调用嵌入模型，并原子替换目录"""
+        chunk_updater.incremental_update()
+        self.add_orphans(chunk_updater, 2)
+        chunk_updater.embeddings.embedded.clear()
+
+        result = chunk_updater.compact()
+
+        assert result['status'] == 'compacted'
+        assert result['orphans_removed'] == 2
+        assert chunk_updater.embeddings.embedded == []
+        store = chunk_updater.load_existing_vector_store()
+        assert store.index.ntotal == len(store.docstore._dict) == 4
+        assert set(store.index_to_docstore_id.values()) == chunk_updater.metadata_store.chunk_ids()
+        query = chunk_updater.embeddings.embed_query("保修两年。")
+        assert store.similarity_search_by_vector(query, k=1)[0].page_content == "保修两年。"
+        assert not [name for name in os.listdir(tmp_path) if name.startswith('.vector_store-')]
+        assert chunk_updater.metadata_store.latest_version()['kind'] == 'compact'
+
+    def test_ivf_retrained_after_churn(self, chunk_updater):
+        """测试IVF索引在变更量超过阈值时重建并重新训练聚类中心"""
+        import faiss
+
+        chunk_updater.incremental_update()
+        store = chunk_updater.load_existing_vector_store()
+        vectors = store.index.reconstruct_n(0, store.index.ntotal)
+        ivf = faiss.index_factory(store.index.d, "IVF2,Flat")
+        ivf.train(vectors)
+        ivf.add(vectors)
+        store.index = ivf
+        store.save_local(chunk_updater.vector_store_path)
+
+        result = chunk_updater.compact()
+
+        assert result['status'] == 'compacted'
+        assert result['retrained']
+        store = chunk_updater.load_existing_vector_store()
+        assert faiss.extract_index_ivf(store.index).nlist == 2
+        assert store.index.ntotal == 4
+        assert chunk_updater.compact()['status'] == 'skipped'
+
+    def test_lossy_ivf_not_retrained(self, chunk_updater):
+        """测试有损编码的IVF索引压缩时不用解码后的近似向量重新训练"""
+        import faiss
+
+        chunk_updater.incremental_update()
+        store = chunk_updater.load_existing_vector_store()
+        vectors = store.index.reconstruct_n(0, store.index.ntotal)
+        ivf = faiss.index_factory(store.index.d, "IVF2,SQ8")
+        ivf.train(vectors)
+        ivf.add(vectors)
+        centroids = faiss.extract_index_ivf(ivf).quantizer.reconstruct_n(0, 2)
+        store.index = ivf
+        store.save_local(chunk_updater.vector_store_path)
+
+        result = chunk_updater.compact(force=True)
+
+        assert result['status'] == 'compacted'
+        assert not result['retrained']
+        store = chunk_updater.load_existing_vector_store()
+        assert store.index.ntotal == 4
+        assert (faiss.extract_index_ivf(store.index).quantizer.reconstruct_n(0, 2) == centroids).all()
+
+def io_priority_class():
+    """在加载进程中读取I/O优先级类别"""
+    import psutil
+    return int(psutil.Process().ionice().ioclass)
+
+class TestResourceGovernor:
+    """更新资源调节器测试类"""
+
+    def test_from_config(self):
+        """测试读取调度器配置中的内存阈值和 throttling 配置"""
+        governor = ResourceGovernor.from_config({
+            'performance': {'max_memory_usage_mb': 2048},
+            'monitoring': {'alert_thresholds': {'memory_usage_percent': 80}},
+            'throttling': {'max_cpu_percent': 85, 'quiet_hours': {'start': '09:00', 'end': '18:00',
+                                                                 'batch_pause_seconds': 2}}
+        })
+
+        assert governor.max_memory_mb == 2048
+        assert governor.max_memory_percent == 80
+        assert governor.max_cpu_percent == 85
+        assert governor.quiet_hours == ('09:00', '18:00')
+        assert ResourceGovernor.from_config({'throttling': {'enabled': False},
+                                             'performance': {'max_memory_usage_mb': 1}}).max_memory_mb is None
+
+    def test_quiet_hours_across_midnight(self):
+        """测试跨午夜的时段"""
+        governor = ResourceGovernor(quiet_hours=('22:00', '06:00'))
+
+        assert governor.in_quiet_hours(datetime(2024, 1, 1, 23, 30))
+        assert governor.in_quiet_hours(datetime(2024, 1, 1, 5, 59))
+        assert not governor.in_quiet_hours(datetime(2024, 1, 1, 12, 0))
+
+    def test_wait_pauses_until_pressure_clears(self):
+        """测试资源紧张时暂停，恢复后继续"""
+        governor = ResourceGovernor()
+
+        with patch.object(governor, 'pressure', side_effect=["CPU 95%", "CPU 92%", None]), \
+                patch('scripts.incremental_update.time.sleep') as sleep:
+            governor.wait()
+
+        assert [call.args[0] for call in sleep.call_args_list] == [1.0, 2.0]
+        assert governor.stats['pauses'] == 1
+        assert governor.stats['paused_seconds'] == 3.0
+
+    def test_wait_bounded(self):
+        """测试资源持续紧张时最多暂停 max_pause_seconds"""
+        governor = ResourceGovernor(max_pause_seconds=10)
+
+        with patch.object(governor, 'pressure', return_value="API延迟 900ms"), \
+                patch('scripts.incremental_update.time.sleep') as sleep:
+            governor.wait()
+
+        assert sum(call.args[0] for call in sleep.call_args_list) == 10
+
+    def test_api_latency_probe(self):
+        """测试API服务未运行时不视为延迟过高"""
+        governor = ResourceGovernor(api_url="http://127.0.0.1:9/ready", max_api_latency_ms=100)
+
+        assert governor.pressure() is None
+
+    def test_memory_limit_flushes_early(self, chunk_updater):
+        """测试进程内存超过限制时每个文件的文档块单独写入，不等凑满批次"""
+        chunk_updater.governor = ResourceGovernor(max_memory_mb=1)
+
+        with patch.object(chunk_updater, 'update_vector_store', wraps=chunk_updater.update_vector_store) as update:
+            chunk_updater.incremental_update()
+
+        assert len([call for call in update.call_args_list if call.args[1]]) == 2
+
+    @pytest.mark.skipif(not sys.platform.startswith('linux'), reason="需要Linux的nice和ionice")
+    def test_worker_priority(self):
+        """测试加载进程以较低的CPU和I/O优先级运行"""
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(1, initializer=lower_process_priority, initargs=(5, 'idle')) as pool:
+            niceness = pool.apply(os.nice, (0,))
+            ioclass = pool.apply(io_priority_class)
+
+        assert niceness == min(19, os.nice(0) + 5)
+        assert ioclass == 3  # IOPRIO_CLASS_IDLE
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+LoRA推理进程池单元测试
+"""
+
+import pytest
+import os
+import sys
+import time
+import asyncio
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.inference_pool import InferencePool, plan_core_groups
+
+class EchoModel:
+    """模拟模型：返回带进程号的提示"""
+    
+    def __init__(self, prefix: str = "echo"):
+        self.prefix = prefix
+    
+    def generate(self, prompt: str, route: str = "default") -> str:
+        if prompt == "boom":
+            raise ValueError("生成失败")
+        return f"{self.prefix}:{os.getpid()}:{prompt}"
+
+def create_echo_model(**kwargs):
+    """模型工厂"""
+    return EchoModel(**kwargs)
+
+class TestPlanCoreGroups:
+    """核心分组测试类"""
+    
+    def test_disjoint_groups(self):
+        """测试核心组互不重叠"""
+        groups = plan_core_groups(4, 4, list(range(32)))
+        
+        assert groups[0] == [0, 1, 2, 3]
+        assert groups[3] == [12, 13, 14, 15]
+    
+    def test_default_threads_split_cores(self):
+        """测试默认按可用核心均分"""
+        groups = plan_core_groups(2, None, list(range(8)))
+        
+        assert groups == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    
+    def test_oversubscribed_disables_pinning(self):
+        """测试核心不足时不绑定"""
+        assert plan_core_groups(4, 4, list(range(8))) == [None] * 4
+
+class TestInferencePool:
+    """推理进程池测试类"""
+    
+    def create_pool(self, restart_backoff: float):
+        return InferencePool(
+            {"prefix": "test"},
+            num_workers=2,
+            threads_per_worker=1,
+            model_factory=create_echo_model,
+            start_method="fork",
+            startup_timeout=30,
+            restart_backoff=restart_backoff
+        ).start()
+    
+    @pytest.fixture
+    def pool(self):
+        """创建两个副本的进程池（退出的副本在测试期间不会重启）"""
+        pool = self.create_pool(restart_backoff=60)
+        yield pool
+        pool.shutdown()
+    
+    def test_generate(self, pool):
+        """测试同步生成"""
+        result = pool.generate("你好")
+        
+        assert result.startswith("test:")
+        assert result.endswith(":你好")
+    
+    def test_requests_spread_across_workers(self, pool):
+        """测试并发请求分发到多个副本"""
+        async def run():
+            return await asyncio.gather(*[pool.agenerate(str(i)) for i in range(20)])
+        
+        results = asyncio.run(run())
+        
+        assert [r.split(":")[2] for r in results] == [str(i) for i in range(20)]
+        assert len({r.split(":")[1] for r in results}) == 2
+    
+    def test_worker_error_propagates(self, pool):
+        """测试副本内的异常传回调用方"""
+        with pytest.raises(RuntimeError, match="生成失败"):
+            pool.generate("boom")
+        
+        assert pool.stats()["outstanding"] == [0, 0]
+
+    def test_dead_worker_not_picked(self, pool):
+        """测试副本退出后，新请求只分配给存活的副本"""
+        dead = pool._processes[0]
+        dead.kill()
+        dead.join(5)
+
+        results = [pool.submit("generate", str(i)).result(timeout=5) for i in range(10)]
+
+        assert {r.split(":")[1] for r in results} == {str(pool._processes[1].pid)}
+        assert pool.stats()["live_workers"] == 1
+
+    def test_dead_worker_restarted(self):
+        """测试退出的副本按退避时间重启，重启完成前不分配请求"""
+        pool = self.create_pool(restart_backoff=0.2)
+        try:
+            old_pid = pool._processes[0].pid
+            pool._processes[0].kill()
+            pool._processes[0].join(5)
+
+            assert pool.generate("你好").split(":")[1] == str(pool._processes[1].pid)
+            deadline = time.time() + 10
+            while pool.stats()["live_workers"] < 2 and time.time() < deadline:
+                time.sleep(0.05)
+
+            stats = pool.stats()
+            assert stats["live_workers"] == 2
+            assert stats["restarts"] == 1
+            assert pool._processes[0].pid != old_pid
+            results = [pool.submit("generate", str(i)) for i in range(10)]
+            assert len({future.result(timeout=5).split(":")[1] for future in results}) == 2
+        finally:
+            pool.shutdown()
+
+    def test_no_live_workers_fails_fast(self, pool):
+        """测试所有副本都退出后提交请求立即失败"""
+        for process in pool._processes:
+            process.kill()
+            process.join(5)
+
+        with pytest.raises(RuntimeError, match="没有存活"):
+            pool.generate("你好")
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+压测工具单元测试
+"""
+
+import pytest
+import os
+import sys
+import json
+from fastapi.testclient import TestClient
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from scripts.fake_ollama_server import FakeOllamaConfig, create_app, fake_embedding
+from scripts.build_synthetic_corpus import build_corpus
+from scripts.load_test import summarize_latencies, compare_with_baseline
+
+@pytest.fixture
+def fake_client():
+    """创建零延迟的Ollama替身服务客户端"""
+    config = FakeOllamaConfig(dim=16, embed_latency_ms=0, embed_per_item_ms=0,
+                              prefill_ms=0, token_latency_ms=0, tokens=5)
+    with TestClient(create_app(config)) as client:
+        yield client
+
+class TestFakeOllamaServer:
+    """Ollama替身服务测试类"""
+
+    def test_embed(self, fake_client):
+        """测试嵌入接口返回确定性的向量"""
+        response = fake_client.post("/api/embed", json={"model": "fake", "input": ["甲", "乙", "甲"]})
+
+        embeddings = response.json()["embeddings"]
+        assert len(embeddings) == 3
+        assert len(embeddings[0]) == 16
+        assert embeddings[0] == embeddings[2]
+        assert embeddings[0] != embeddings[1]
+        assert embeddings[0] == fake_embedding("甲", 16)
+
+    def test_chat_stream(self, fake_client):
+        """测试流式对话返回逐token片段和Ollama统计字段"""
+        response = fake_client.post("/api/chat", json={
+            "model": "fake",
+            "messages": [{"role": "user", "content": "问题"}],
+            "stream": True
+        })
+
+        chunks = [json.loads(line) for line in response.text.splitlines() if line]
+        assert len(chunks) == 6
+        assert all(not chunk["done"] for chunk in chunks[:-1])
+        final = chunks[-1]
+        assert final["done"]
+        assert final["eval_count"] == 5
+        assert final["prompt_eval_count"] == 2
+        assert "eval_duration" in final and "prompt_eval_duration" in final
+
+    def test_chat_non_stream(self, fake_client):
+        """测试非流式对话返回完整回答"""
+        response = fake_client.post("/api/chat", json={
+            "model": "fake",
+            "messages": [{"role": "user", "content": "问题"}],
+            "stream": False
+        })
+
+        body = response.json()
+        assert body["done"]
+        assert body["message"]["content"].startswith("回答0")
+        assert body["eval_count"] == 5
+
+class TestSyntheticCorpus:
+    """合成向量库测试类"""
+
+    def test_build_and_load(self, tmp_path):
+        """测试合成向量库可被FAISS.load_local加载并检索"""
+        from langchain_community.vectorstores import FAISS
+        from langchain_core.embeddings import FakeEmbeddings
+
+        path = build_corpus(str(tmp_path / "corpus"), chunks=120, dim=16)
+        store = FAISS.load_local(path, FakeEmbeddings(size=16), allow_dangerous_deserialization=True)
+
+        assert store.index.ntotal == 120
+        docs = store.similarity_search_by_vector(fake_embedding("问题", 16), k=3)
+        assert len(docs) == 3
+        assert docs[0].metadata["source"].startswith("synthetic_")
+
+class TestLoadTestReport:
+    """压测结果统计测试类"""
+
+    def test_summarize_latencies(self):
+        """测试延迟分位数（毫秒，最近秩）"""
+        summary = summarize_latencies([i / 1000 for i in range(1, 101)])
+
+        assert summary["p50"] == 50.0
+        assert summary["p95"] == 95.0
+        assert summary["p99"] == 99.0
+        assert summary["max"] == 100.0
+        assert summarize_latencies([])["p99"] == 0.0
+
+    def test_compare_with_baseline(self):
+        """测试p95和吞吐超出允许比例时报告回退"""
+        def result(p95, rps):
+            return {"app": "main", "chunks": 1000, "concurrency": 4,
+                    "throughput_rps": rps, "latency_ms": {"p95": p95}}
+
+        baseline = {"results": [result(100.0, 10.0)]}
+
+        assert compare_with_baseline({"results": [result(110.0, 9.0)]}, baseline, 0.2) == []
+        regressions = compare_with_baseline({"results": [result(150.0, 7.0)]}, baseline, 0.2)
+        assert len(regressions) == 2
+        assert regressions[0].startswith("main/1000/c4")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+LoRA模型辅助生成（推测解码）单元测试
+"""
+
+import pytest
+import os
+import sys
+from unittest.mock import Mock, patch
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("peft")
+
+from app.lora_model import LoRALanguageModel
+from app.generation_limits import AnswerLengthStats
+
+PROMPT_IDS = [[1, 2, 3]]
+
+def create_model(draft_model=None):
+    """不加载权重，只设置生成所需属性的模型包装器"""
+    model = LoRALanguageModel.__new__(LoRALanguageModel)
+    model.max_length = 2048
+    model.max_new_tokens = 512
+    model.temperature = 0.7
+    model.device = "cpu"
+    model.deadline_seconds = 30
+    model.stop_token_sequences = []
+    model.length_stats = AnswerLengthStats()
+    model.cache_dir = None
+    model.draft_model_name = None
+    model.num_assistant_tokens = 5
+    model.base_model = torch.nn.Linear(2, 2)
+    model.draft_model = draft_model
+    model.last_generation_stats = None
+    model.tokenizer = Mock(pad_token_id=0, eos_token_id=2)
+    model.tokenizer.return_value = {
+        "input_ids": torch.tensor(PROMPT_IDS),
+        "attention_mask": torch.ones(1, len(PROMPT_IDS[0]), dtype=torch.long)
+    }
+    model.tokenizer.decode.return_value = " 回答 "
+    model.model = Mock()
+    return model
+
+class TestSpeculativeStats:
+    """辅助生成统计测试类"""
+
+    def test_acceptance_rate(self):
+        """测试接受的草稿token数 = 新token数 - 目标模型前向次数"""
+        model = create_model()
+        stats = {"new_tokens": 30, "target_passes": 10, "draft_passes": 40, "duration": 1.0}
+
+        model._log_speculative_stats(stats)
+
+        assert stats["accepted_draft_tokens"] == 20
+        assert stats["acceptance_rate"] == pytest.approx(0.5)
+        assert stats["tokens_per_target_pass"] == pytest.approx(3.0)
+
+    def test_no_draft_tokens(self):
+        """测试没有草稿前向和目标前向时不除零，接受数不为负"""
+        model = create_model()
+        stats = {"new_tokens": 0, "target_passes": 0, "draft_passes": 0, "duration": 0.0}
+
+        model._log_speculative_stats(stats)
+
+        assert stats["accepted_draft_tokens"] == 0
+        assert stats["acceptance_rate"] == 0.0
+        assert stats["tokens_per_target_pass"] == 0.0
+
+    def test_forward_pass_counter(self):
+        """测试前向计数钩子在移除后不再计数"""
+        model = create_model()
+        module = torch.nn.Linear(2, 2)
+        counter = {"target": 0}
+
+        handle = model._count_forward_passes(module, counter, "target")
+        module(torch.zeros(1, 2))
+        module(torch.zeros(1, 2))
+        handle.remove()
+        module(torch.zeros(1, 2))
+
+        assert counter["target"] == 2
+
+    def test_generation_counts_passes(self):
+        """测试辅助生成时统计目标模型和草稿模型的前向次数"""
+        draft_model = torch.nn.Linear(2, 2)
+        model = create_model(draft_model)
+
+        def generate(**kwargs):
+            # 3轮验证，每轮草稿模型推测4个token，共产出9个新token
+            for _ in range(3):
+                for _ in range(4):
+                    draft_model(torch.zeros(1, 2))
+                model.base_model(torch.zeros(1, 2))
+            return torch.tensor([PROMPT_IDS[0] + list(range(10, 19))])
+        model.model.generate.side_effect = generate
+
+        response, stats = model._generate_with_stats("问题")
+
+        assert response == "回答"
+        assert model.model.generate.call_args.kwargs["assistant_model"] is draft_model
+        assert model.last_generation_stats["target_passes"] == 3
+        assert model.last_generation_stats["draft_passes"] == 12
+        assert model.last_generation_stats["accepted_draft_tokens"] == 6
+        assert model.last_generation_stats["acceptance_rate"] == pytest.approx(0.5)
+        assert stats["completion_tokens"] == 9
+
+class TestDraftModelFallback:
+    """草稿模型加载失败回退测试类"""
+
+    def test_load_failure_disables_draft_model(self):
+        """测试草稿模型加载失败时关闭辅助生成，并使用常规解码"""
+        model = create_model()
+        model.draft_model_name = "missing/draft-model"
+        model.model.generate.return_value = torch.tensor([PROMPT_IDS[0] + [7, 8]])
+
+        with patch('app.lora_model.AutoModelForCausalLM.from_pretrained', side_effect=OSError("模型不存在")):
+            model._load_draft_model(torch.float32, None)
+        response, stats = model._generate_with_stats("问题")
+
+        assert model.draft_model is None
+        assert response == "回答"
+        assert stats["completion_tokens"] == 2
+        assert "assistant_model" not in model.model.generate.call_args.kwargs
+        assert model.last_generation_stats is None
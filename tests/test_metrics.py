@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+监控指标单元测试
+"""
+
+import pytest
+import os
+import sys
+import asyncio
+from unittest.mock import Mock, AsyncMock, patch
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app.main as main_module
+from app.generation_limits import FirstTokenTimer
+from app.metrics import track_stage, observe_ollama_response
+
+def stage_count(backend: str, stage: str) -> float:
+    """读取某个阶段直方图的样本数"""
+    value = REGISTRY.get_sample_value(
+        "rag_stage_duration_seconds_count", {"backend": backend, "stage": stage}
+    )
+    return value or 0.0
+
+class TestStageMetrics:
+    """阶段耗时测试类"""
+
+    def test_track_stage(self):
+        """测试阶段耗时写入直方图和timings字典"""
+        before = stage_count("test", "embed")
+        timings = {}
+
+        with track_stage("test", "embed", timings):
+            pass
+
+        assert stage_count("test", "embed") == before + 1
+        assert timings["embed"] >= 0
+
+    def test_ollama_response_metadata(self):
+        """测试从Ollama响应元数据中记录预填充、解码和token数"""
+        before_prefill = stage_count("ollama", "prefill")
+        before_tokens = REGISTRY.get_sample_value("rag_generated_tokens_total", {"backend": "ollama"}) or 0
+        message = Mock(response_metadata={
+            "prompt_eval_duration": 200_000_000,
+            "eval_duration": 1_000_000_000,
+            "eval_count": 21,
+            "prompt_eval_count": 300
+        })
+
+        observe_ollama_response(message)
+
+        assert stage_count("ollama", "prefill") == before_prefill + 1
+        assert REGISTRY.get_sample_value("rag_generated_tokens_total", {"backend": "ollama"}) == before_tokens + 21
+
+    def test_first_token_timer(self):
+        """测试首个token计时把生成耗时分为预填充和解码"""
+        timer = FirstTokenTimer()
+        input_ids = Mock()
+        input_ids.__len__ = Mock(return_value=1)
+
+        assert timer(input_ids, None) is False
+        first_token_at = timer.first_token_at
+        timer(input_ids, None)
+
+        prefill, decode = timer.split(first_token_at + 0.5)
+        assert timer.first_token_at == first_token_at
+        assert prefill >= 0
+        assert decode == pytest.approx(0.5)
+
+    def test_handler_records_stages(self):
+        """测试处理器按嵌入、检索、提示、生成四个阶段记录耗时"""
+        from app.rag_handler import RAGHandler
+        from langchain_core.documents import Document
+        from langchain_core.messages import AIMessage
+
+        handler = RAGHandler.__new__(RAGHandler)
+        handler.embeddings = Mock()
+        handler.embeddings.aembed_query = AsyncMock(return_value=[1.0])
+        handler.vector_store = Mock()
+        handler.vector_store.asimilarity_search_by_vector = AsyncMock(return_value=[Document(page_content="上下文")])
+        handler.prompt = Mock()
+        handler.prompt.invoke = Mock(side_effect=lambda values: values["context"])
+        handler.llm = Mock()
+        handler.llm.ainvoke = AsyncMock(return_value=AIMessage(content="答案"))
+        before = {stage: stage_count("ollama", stage) for stage in ("embed", "search", "prompt", "generate", "total")}
+
+        result = asyncio.run(handler.get_answer("问题"))
+
+        assert result["answer"] == "答案"
+        assert result["source_documents"][0]["content"] == "上下文"
+        handler.llm.ainvoke.assert_awaited_once_with("上下文")
+        for stage, count in before.items():
+            assert stage_count("ollama", stage) == count + 1
+
+class TestMetricsEndpoint:
+    """/metrics端点测试类"""
+
+    def test_metrics_exposition(self):
+        """测试/metrics返回Prometheus文本格式，包含队列指标"""
+        handler = Mock()
+        handler.warmup = AsyncMock(return_value={})
+        handler.get_answer = AsyncMock(return_value={"answer": "测试回答", "source_documents": []})
+
+        with patch('app.main.RAGHandler', return_value=handler):
+            with TestClient(main_module.app) as client:
+                client.post("/ask", json={"query": "问题"})
+                response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "rag_admission_queue_depth 0.0" in response.text
+        assert "rag_admission_wait_seconds_count" in response.text
+        assert 'rag_admission_rejected_total{reason="queue_full"} 0.0' in response.text
+        assert "rag_model_memory_bytes" in response.text
+
+class TestRequestTimings:
+    """请求耗时明细测试类"""
+
+    def test_timings_off_by_default(self):
+        """测试默认不返回timings，且不走流式调用"""
+        handler = self._make_handler()
+
+        result = asyncio.run(handler.get_answer("问题"))
+
+        assert "timings" not in result
+        handler.llm.astream.assert_not_called()
+
+    def test_timings_with_streaming_ttft(self):
+        """测试开启后返回各阶段耗时、首个token耗时和token数"""
+        handler = self._make_handler()
+
+        result = asyncio.run(handler.get_answer("问题", include_timings=True))
+
+        timings = result["timings"]
+        assert result["answer"] == "答案"
+        for field in ("embedding_ms", "retrieval_ms", "prompt_ms", "ttft_ms", "generation_ms", "total_ms"):
+            assert timings[field] >= 0
+        assert timings["ttft_ms"] <= timings["generation_ms"]
+        assert timings["rerank_ms"] is None
+        assert timings["prompt_tokens"] == 30
+        assert timings["completion_tokens"] == 2
+
+    def test_header_enables_timings(self):
+        """测试X-Include-Timings请求头开启耗时明细"""
+        handler = Mock()
+        handler.warmup = AsyncMock(return_value={})
+        handler.get_answer = AsyncMock(return_value={"answer": "测试回答", "source_documents": []})
+
+        with patch('app.main.RAGHandler', return_value=handler):
+            with TestClient(main_module.app) as client:
+                client.post("/ask", json={"query": "问题"})
+                client.post("/ask", json={"query": "问题"}, headers={"X-Include-Timings": "true"})
+
+        assert handler.get_answer.await_args_list[0].kwargs == {"include_timings": False}
+        assert handler.get_answer.await_args_list[1].kwargs == {"include_timings": True}
+
+    @staticmethod
+    def _make_handler():
+        """构造使用模拟组件的RAG处理器"""
+        from app.rag_handler import RAGHandler
+        from langchain_core.documents import Document
+        from langchain_core.messages import AIMessage, AIMessageChunk
+
+        async def astream(model_input, config=None):
+            yield AIMessageChunk(content="答")
+            yield AIMessageChunk(content="案", usage_metadata={"input_tokens": 30, "output_tokens": 2, "total_tokens": 32})
+
+        handler = RAGHandler.__new__(RAGHandler)
+        handler.embeddings = Mock()
+        handler.embeddings.aembed_query = AsyncMock(return_value=[1.0])
+        handler.vector_store = Mock()
+        handler.vector_store.asimilarity_search_by_vector = AsyncMock(return_value=[Document(page_content="上下文")])
+        handler.prompt = Mock()
+        handler.prompt.invoke = Mock(side_effect=lambda values: values["context"])
+        handler.llm = Mock()
+        handler.llm.ainvoke = AsyncMock(return_value=AIMessage(content="答案"))
+        handler.llm.astream = Mock(side_effect=astream)
+        return handler
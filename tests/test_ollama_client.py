@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+共享Ollama客户端单元测试
+"""
+
+import pytest
+import os
+import sys
+import time
+import asyncio
+import httpx
+from unittest.mock import Mock, AsyncMock, patch
+from fastapi.testclient import TestClient
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app.main as main_module
+from app.ollama_client import OllamaClient, CircuitBreaker, CircuitOpenError
+from scripts.fake_ollama_server import FakeOllamaConfig, create_app
+
+def fake_ollama_client(**kwargs) -> OllamaClient:
+    """创建连接到进程内替身服务的客户端"""
+    config = FakeOllamaConfig(dim=8, embed_latency_ms=0, embed_per_item_ms=0,
+                              prefill_ms=0, token_latency_ms=0, tokens=3)
+    return OllamaClient(
+        base_url="http://fake-ollama",
+        transport_factory=lambda: httpx.ASGITransport(app=create_app(config)),
+        **kwargs
+    )
+
+def mock_transport_client(handler, **kwargs) -> OllamaClient:
+    """创建使用httpx.MockTransport的客户端，handler决定每次请求的响应"""
+    kwargs.setdefault("max_retries", 0)
+    return OllamaClient(
+        base_url="http://fake-ollama",
+        transport_factory=lambda: httpx.MockTransport(handler),
+        sync_transport_factory=lambda: httpx.MockTransport(handler),
+        **kwargs
+    )
+
+class TestCircuitBreaker:
+    """熔断器测试类"""
+
+    def test_opens_after_threshold(self):
+        """测试连续失败达到阈值后熔断"""
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+
+        breaker.record_failure()
+        breaker.before_request()
+        breaker.record_failure()
+
+        assert breaker.state == "open"
+        with pytest.raises(CircuitOpenError) as exc_info:
+            breaker.before_request()
+        assert exc_info.value.retry_after > 0
+
+    def test_half_open_probe(self):
+        """测试冷却结束后只放行一个探测请求，成功后恢复"""
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+
+        assert breaker.state == "half_open"
+        breaker.before_request()
+        with pytest.raises(CircuitOpenError):
+            breaker.before_request()
+
+        breaker.record_success()
+        assert breaker.state == "closed"
+        breaker.before_request()
+
+    def test_failed_probe_reopens(self):
+        """测试探测请求失败时重新熔断"""
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        breaker.before_request()
+
+        breaker.record_failure()
+
+        assert breaker.state == "open"
+        assert breaker.open_count == 2
+
+    def test_abandoned_probe_allows_next_probe(self):
+        """测试探测请求被放弃后，下一个请求可以重新探测"""
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        assert breaker.before_request()
+
+        breaker.abandon_probe()
+
+        assert breaker.before_request()
+
+class TestOllamaClient:
+    """共享客户端测试类"""
+
+    def test_langchain_models_use_shared_client(self):
+        """测试绑定后的嵌入和聊天模型经共享客户端访问替身服务"""
+        from langchain_ollama import OllamaEmbeddings, ChatOllama
+
+        client = fake_ollama_client()
+        embeddings = client.bind(OllamaEmbeddings(model="fake-embed", base_url=client.base_url))
+        llm = client.bind(ChatOllama(model="fake-chat", base_url=client.base_url))
+
+        async def run():
+            vector = await embeddings.aembed_query("问题")
+            message = await llm.ainvoke("问题")
+            return vector, message
+
+        vector, message = asyncio.run(run())
+        # 新的事件循环上重新创建连接池
+        vector_again, _ = asyncio.run(run())
+
+        assert len(vector) == 8
+        assert vector == vector_again
+        assert message.content.startswith("回答0")
+        assert message.response_metadata["eval_count"] == 3
+        assert client.stats()["in_flight"] == 0
+
+    def test_bind_ignores_other_models(self):
+        """测试不含Ollama客户端的模型保持不变"""
+        client = fake_ollama_client()
+        model = object()
+
+        assert client.bind(model) is model
+
+    def test_retries_connection_errors(self):
+        """测试连接失败后重试成功"""
+        attempts = []
+
+        def handler(request):
+            attempts.append(request.url.path)
+            if len(attempts) < 3:
+                raise httpx.ConnectError("connection refused")
+            return httpx.Response(200, json={"models": []})
+
+        client = mock_transport_client(handler, max_retries=2)
+        client.async_transport.backoff_seconds = 0
+
+        assert asyncio.run(client.ping())
+        assert len(attempts) == 3
+        assert client.stats()["retries"] == 2
+        assert client.breaker.state == "closed"
+
+    def test_circuit_opens_on_failures(self):
+        """测试连续失败后熔断，熔断期间不再发出请求"""
+        attempts = []
+
+        def handler(request):
+            attempts.append(request.url.path)
+            return httpx.Response(503, json={"error": "server busy"})
+
+        client = mock_transport_client(handler, breaker_threshold=2, breaker_reset_seconds=60)
+
+        for _ in range(4):
+            assert not asyncio.run(client.ping())
+
+        assert len(attempts) == 2
+        assert client.stats()["circuit"]["state"] == "open"
+
+    def test_cancelled_probe_does_not_stick(self):
+        """测试半开探测请求因ping超时被取消后，服务恢复时熔断器能正常关闭"""
+        state = {"mode": "down"}
+
+        async def handler(request):
+            if state["mode"] == "down":
+                raise httpx.ConnectError("connection refused")
+            if state["mode"] == "hang":
+                await asyncio.sleep(10)
+            return httpx.Response(200, json={"models": []})
+
+        client = OllamaClient(
+            base_url="http://fake-ollama", max_retries=0,
+            breaker_threshold=1, breaker_reset_seconds=0.01,
+            transport_factory=lambda: httpx.MockTransport(handler)
+        )
+        assert not asyncio.run(client.ping())
+        time.sleep(0.02)
+
+        state["mode"] = "hang"
+        assert not asyncio.run(client.ping(timeout=0.05))
+        state["mode"] = "up"
+
+        assert asyncio.run(client.ping())
+        assert client.breaker.state == "closed"
+
+    def test_concurrency_limit(self):
+        """测试同时发往Ollama的请求数不超过上限"""
+        active = 0
+        peak = 0
+
+        async def handler(request):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return httpx.Response(200, json={"models": []})
+
+        client = OllamaClient(
+            base_url="http://fake-ollama",
+            max_concurrency=2,
+            transport_factory=lambda: httpx.MockTransport(handler)
+        )
+
+        async def run():
+            return await asyncio.gather(*(client.ping() for _ in range(6)))
+
+        assert all(asyncio.run(run()))
+        assert peak == 2
+
+    def test_sync_client(self):
+        """测试同步脚本（ingest、增量更新）共用的同步客户端"""
+        def handler(request):
+            return httpx.Response(200, json={"model": "fake", "embeddings": [[0.1, 0.2]]})
+
+        client = mock_transport_client(handler)
+
+        response = client.client.embed(model="fake", input=["文本"])
+
+        assert response["embeddings"] == [[0.1, 0.2]]
+        assert client.sync_transport.in_flight == 0
+
+class TestCircuitOpenResponse:
+    """熔断时API响应测试类"""
+
+    def test_ask_returns_503(self):
+        """测试Ollama熔断时 /ask 快速返回503和Retry-After"""
+        handler = Mock()
+        handler.warmup = AsyncMock(return_value={})
+        handler.get_answer = AsyncMock(side_effect=CircuitOpenError(12))
+
+        with patch('app.main.RAGHandler', return_value=handler):
+            with TestClient(main_module.app) as client:
+                response = client.post("/ask", json={"query": "问题"})
+
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "12"
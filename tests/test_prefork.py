@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+pre-fork多进程服务单元测试
+"""
+
+import pytest
+import os
+import gc
+import sys
+import socket
+from unittest.mock import Mock, AsyncMock, patch
+from fastapi.testclient import TestClient
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app.prefork as prefork
+import app.main as main_module
+from app.prefork import PreforkServer, create_listen_socket, take_preloaded_handler
+
+def mock_handler():
+    handler = Mock()
+    handler.warmup = AsyncMock(return_value={})
+    handler.get_answer = AsyncMock(return_value={"answer": "回答", "sources": []})
+    return handler
+
+class TestPreloadedHandler:
+    """预加载处理器测试类"""
+
+    def test_default_none(self):
+        """测试非pre-fork模式下没有预加载的处理器"""
+        assert take_preloaded_handler() is None
+
+    def test_startup_uses_preloaded_handler(self, monkeypatch):
+        """测试worker启动时直接使用主进程加载的处理器，不再重新加载"""
+        handler = mock_handler()
+        monkeypatch.setattr(prefork, "_preloaded_handler", handler)
+
+        with patch('app.main.RAGHandler') as rag_handler_class:
+            with TestClient(main_module.app) as client:
+                response = client.post("/ask", json={"query": "问题"})
+
+        rag_handler_class.assert_not_called()
+        assert response.status_code == 200
+        handler.get_answer.assert_awaited_once()
+
+class TestPreforkServer:
+    """pre-fork服务测试类"""
+
+    def test_listen_socket_inheritable(self):
+        """测试监听套接字可被fork出的worker继承"""
+        sock = create_listen_socket("127.0.0.1", 0)
+        try:
+            assert sock.get_inheritable()
+            assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN)
+        finally:
+            sock.close()
+
+    def test_default_threads_split_cores(self):
+        """测试默认按核心数平分计算线程，至少为1"""
+        server = PreforkServer("main", workers=10000)
+
+        assert server.threads_per_worker == 1
+
+    def test_preload_freezes_gc(self, monkeypatch):
+        """测试主进程加载处理器后冻结GC，并关闭推理进程池"""
+        handler = mock_handler()
+        monkeypatch.setenv("INFERENCE_WORKERS", "4")
+        monkeypatch.setenv("OMP_NUM_THREADS", "1")
+        monkeypatch.setattr(main_module, "build_rag_handler", lambda: handler)
+        server = PreforkServer("main", workers=2)
+
+        try:
+            server.preload()
+            assert server.handler is handler
+            assert os.environ["INFERENCE_WORKERS"] == "1"
+            assert gc.get_freeze_count() > 0
+        finally:
+            gc.unfreeze()
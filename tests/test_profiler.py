@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+采样分析单元测试
+"""
+
+import pytest
+import os
+import sys
+import time
+import asyncio
+import threading
+from unittest.mock import Mock, AsyncMock, patch
+from fastapi.testclient import TestClient
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app.main as main_module
+import app.profiler as profiler_module
+from app.profiler import SamplingProfiler, profile, run_profile, verify_admin_token, _frame_label
+
+def busy_inference_loop(stop: threading.Event):
+    """模拟推理线程中的热点函数"""
+    while not stop.is_set():
+        sum(i * i for i in range(1000))
+
+@pytest.fixture
+def busy_thread():
+    """启动一个名为lora-inference_0的忙碌线程"""
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_inference_loop, args=(stop,), name="lora-inference_0", daemon=True)
+    thread.start()
+    yield thread
+    stop.set()
+    thread.join()
+
+class TestSamplingProfiler:
+    """采样分析器测试类"""
+
+    def test_collapsed_stacks(self, busy_thread):
+        """测试折叠栈包含线程名和热点函数"""
+        sampler = SamplingProfiler(interval=0.002)
+
+        stats = sampler.run(0.2)
+        collapsed = sampler.collapsed()
+
+        assert stats["samples"] > 0
+        hot_lines = [line for line in collapsed.splitlines() if "busy_inference_loop" in line]
+        assert hot_lines
+        assert hot_lines[0].startswith("lora-inference_0;")
+        assert int(hot_lines[0].rsplit(" ", 1)[1]) > 0
+        assert "wakeup_delay_p99_ms" in stats["gil"]
+
+    def test_thread_filter(self, busy_thread):
+        """测试按线程名过滤"""
+        sampler = SamplingProfiler(interval=0.002, thread_filter="lora-inference")
+
+        sampler.run(0.1)
+
+        assert all(stack.startswith("lora-inference") for stack in sampler.stacks)
+
+    def test_single_profile_at_a_time(self):
+        """测试同一时间只允许一次分析"""
+        with profiler_module._profile_lock:
+            with pytest.raises(RuntimeError):
+                profile(0.01)
+
+    def test_frame_label_ignores_current_line(self):
+        """测试同一函数在不同行采样得到相同的帧标签"""
+        first = _frame_label(sys._getframe())
+        second = _frame_label(sys._getframe())
+
+        assert first == second
+        assert first.endswith(f":{self.test_frame_label_ignores_current_line.__code__.co_firstlineno})")
+
+    def test_busy_profile_stops_lag_measurement(self):
+        """测试已有分析任务时立即失败，且不留下测量事件循环延迟的任务"""
+        async def run():
+            with profiler_module._profile_lock:
+                start = time.perf_counter()
+                with pytest.raises(RuntimeError):
+                    await run_profile(5)
+                elapsed = time.perf_counter() - start
+            await asyncio.sleep(0)
+            return elapsed, len(asyncio.all_tasks())
+
+        elapsed, tasks = asyncio.run(run())
+
+        assert elapsed < 1
+        assert tasks == 1
+
+    def test_admin_token(self, monkeypatch):
+        """测试未配置ADMIN_TOKEN时管理接口关闭"""
+        monkeypatch.setattr(profiler_module, "ADMIN_TOKEN", "")
+        assert not verify_admin_token("anything")
+
+        monkeypatch.setattr(profiler_module, "ADMIN_TOKEN", "secret")
+        assert verify_admin_token("secret")
+        assert not verify_admin_token("wrong")
+        assert not verify_admin_token(None)
+
+class TestProfileEndpoint:
+    """管理分析端点测试类"""
+
+    @pytest.fixture
+    def client(self, monkeypatch):
+        """创建配置了管理令牌的测试客户端"""
+        monkeypatch.setattr(profiler_module, "ADMIN_TOKEN", "secret")
+        handler = Mock()
+        handler.warmup = AsyncMock(return_value={})
+        with patch('app.main.RAGHandler', return_value=handler):
+            with TestClient(main_module.app) as client:
+                yield client
+
+    def test_requires_token(self, client):
+        """测试缺少令牌时返回403"""
+        response = client.post("/admin/profile", params={"seconds": 0.05})
+
+        assert response.status_code == 403
+
+    def test_profile_json(self, client):
+        """测试返回采样统计和折叠栈"""
+        response = client.post(
+            "/admin/profile",
+            params={"seconds": 0.1, "format": "json"},
+            headers={"X-Admin-Token": "secret"}
+        )
+
+        assert response.status_code == 200
+        body = response.json()
+        assert body["stats"]["samples"] > 0
+        assert "event_loop_lag" in body["stats"]
+        assert body["collapsed"].strip()
+
+    def test_rejects_long_profile(self, client):
+        """测试超过最长分析时间时返回400"""
+        response = client.post(
+            "/admin/profile",
+            params={"seconds": profiler_module.MAX_PROFILE_SECONDS + 1},
+            headers={"X-Admin-Token": "secret"}
+        )
+
+        assert response.status_code == 400
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+批量检索单元测试
+"""
+
+import pytest
+import os
+import sys
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.retrieval import batch_similarity_search, format_context
+
+class TestBatchSimilaritySearch:
+    """批量检索测试类"""
+    
+    @pytest.fixture
+    def vector_store(self):
+        """创建包含三个文档的小型FAISS向量存储"""
+        texts = ["电池容量1500mAh", "报警音量80dB", "无需切断管道"]
+        vectors = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+        return FAISS.from_embeddings(
+            list(zip(texts, vectors)),
+            embedding=None,
+            metadatas=[{"source": f"doc{i}.md"} for i in range(3)]
+        )
+    
+    def test_results_follow_query_order(self, vector_store):
+        """测试结果顺序与查询顺序一致"""
+        results = batch_similarity_search(vector_store, [[0.0, 0.9, 0.1], [0.9, 0.0, 0.1]], k=1)
+        
+        assert [docs[0].page_content for docs in results] == ["报警音量80dB", "电池容量1500mAh"]
+        assert results[0][0].metadata["source"] == "doc1.md"
+    
+    def test_k_larger_than_index(self, vector_store):
+        """测试k大于索引大小时忽略FAISS的-1填充"""
+        results = batch_similarity_search(vector_store, [[1.0, 0.0, 0.0]], k=10)
+        
+        assert len(results[0]) == 3
+    
+    def test_empty_queries(self, vector_store):
+        """测试空查询列表"""
+        assert batch_similarity_search(vector_store, [], k=5) == []
+    
+    def test_format_context(self):
+        """测试上下文拼接"""
+        docs = [Document(page_content="内容1"), Document(page_content="内容2")]
+        
+        assert format_context(docs) == "内容1\n\n内容2"
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+检索索引基准单元测试
+"""
+
+import pytest
+import os
+import sys
+import numpy as np
+from types import SimpleNamespace
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from scripts.benchmark_retrieval import (
+    synthetic_vectors, perturb, pq_subquantizers, default_nlist,
+    index_specs, recall_at_k, run_benchmark
+)
+
+def make_args(**overrides):
+    """基准参数（缩小规模以加快测试）"""
+    args = dict(hnsw_m=[16], ef_construction=40, ef_search=[8, 64], nlist=None, nprobe=[1, 8], pq_m=8)
+    args.update(overrides)
+    return SimpleNamespace(**args)
+
+class TestRetrievalBenchmark:
+    """检索索引基准测试类"""
+
+    def test_recall_at_k(self):
+        """测试recall@k按重合比例计算"""
+        truth = np.array([[1, 2, 3, 4], [5, 6, 7, 8]])
+        approx = np.array([[4, 3, 2, 1], [5, 6, 0, 0]])
+
+        assert recall_at_k(approx, truth) == 0.75
+
+    def test_pq_subquantizers(self):
+        """测试PQ子空间数调整为维度的约数"""
+        assert pq_subquantizers(768, 48) == 48
+        assert pq_subquantizers(1024, 48) == 32
+        assert pq_subquantizers(30, 64) == 30
+
+    def test_default_nlist(self):
+        """测试IVF聚类数保证每个中心有足够训练向量"""
+        assert default_nlist(1000000) == 4000
+        assert default_nlist(1000) == 25
+
+    def test_index_specs_skip_pq(self):
+        """测试向量过少时跳过IVF-PQ"""
+        names = [spec['name'] for spec in index_specs(500, 32, make_args())]
+
+        assert names[0] == 'Flat'
+        assert 'HNSW16' in names
+        assert not any('PQ' in name for name in names)
+
+    def test_sweep(self):
+        """测试扫描结果：Flat召回率为1，参数越大召回率不下降"""
+        vectors = synthetic_vectors(2600, 16, clusters=16)
+        queries = perturb(vectors[:50], 50)
+        specs = index_specs(len(vectors), 16, make_args(pq_m=4))
+
+        results = run_benchmark(vectors, queries, 5, specs)
+
+        by_index = {}
+        for result in results:
+            by_index.setdefault(result['index'], []).append(result)
+        assert by_index['Flat'][0]['recall@5'] == 1.0
+        assert any('PQ' in name for name in by_index)
+        for rows in by_index.values():
+            assert rows[-1]['recall@5'] >= rows[0]['recall@5']
+            assert all(row['qps'] > 0 and row['index_mb'] > 0 for row in rows)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+链路追踪单元测试
+"""
+
+import pytest
+import os
+import sys
+import json
+import asyncio
+from unittest.mock import Mock, AsyncMock, patch
+from fastapi.testclient import TestClient
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app.main as main_module
+import app.profiler as profiler_module
+from app.tracing import Tracer, InMemoryExporter, JsonlFileExporter, tracer, parse_traceparent
+from scripts.inspect_traces import load_traces, root_span
+
+@pytest.fixture
+def exporter(monkeypatch):
+    """把全局tracer切换到新的进程内收集器"""
+    exporter = InMemoryExporter(max_spans=100)
+    monkeypatch.setattr(tracer, "exporter", exporter)
+    return exporter
+
+class TestTracer:
+    """Tracer测试类"""
+
+    def test_nested_spans(self):
+        """测试嵌套span共享trace_id并记录父span"""
+        exporter = InMemoryExporter()
+        local_tracer = Tracer(exporter)
+
+        with local_tracer.start_span("parent") as parent:
+            with local_tracer.start_span("child", {"chunk_count": 5}) as child:
+                pass
+
+        spans = {span["name"]: span for span in exporter.spans()}
+        assert spans["child"]["trace_id"] == parent.trace_id
+        assert spans["child"]["parent_id"] == parent.span_id
+        assert spans["parent"]["parent_id"] is None
+        assert spans["child"]["attributes"] == {"chunk_count": 5}
+        assert child.duration_ms >= 0
+
+    def test_exception_marks_error(self):
+        """测试span内抛出异常时记录错误状态"""
+        exporter = InMemoryExporter()
+        local_tracer = Tracer(exporter)
+
+        with pytest.raises(ValueError):
+            with local_tracer.start_span("failing"):
+                raise ValueError("嵌入失败")
+
+        span = exporter.spans()[0]
+        assert span["status"] == "error"
+        assert "嵌入失败" in span["error"]
+
+    def test_disabled_tracer(self):
+        """测试未配置导出器时返回空span"""
+        with Tracer(None).start_span("noop") as span:
+            span.set_attribute("key", "value")
+
+        assert span.trace_id is None
+
+    def test_concurrent_tasks_isolated(self):
+        """测试并发任务各自的span互不串链"""
+        exporter = InMemoryExporter()
+        local_tracer = Tracer(exporter)
+
+        async def request(name):
+            with local_tracer.start_span(name):
+                await asyncio.sleep(0.01)
+                with local_tracer.start_span(f"{name}.child"):
+                    await asyncio.sleep(0)
+
+        async def run():
+            await asyncio.gather(request("a"), request("b"))
+
+        asyncio.run(run())
+
+        spans = {span["name"]: span for span in exporter.spans()}
+        assert spans["a.child"]["parent_id"] == spans["a"]["span_id"]
+        assert spans["b.child"]["parent_id"] == spans["b"]["span_id"]
+        assert spans["a"]["trace_id"] != spans["b"]["trace_id"]
+
+    def test_file_exporter(self, tmp_path):
+        """测试JSONL导出可被离线工具读取"""
+        path = str(tmp_path / "traces.jsonl")
+        local_tracer = Tracer(JsonlFileExporter(path))
+
+        with local_tracer.start_span("http.request") as root:
+            with local_tracer.start_span("faiss.search", {"query": "长" * 500}):
+                pass
+        local_tracer.exporter.flush()
+
+        traces = load_traces(path)
+        spans = traces[root.trace_id]
+        assert len(spans) == 2
+        assert root_span(spans)["name"] == "http.request"
+        search = next(span for span in spans if span["name"] == "faiss.search")
+        assert len(search["attributes"]["query"]) < 500
+
+    def test_parse_traceparent(self):
+        """测试解析W3C traceparent请求头"""
+        header = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+
+        assert parse_traceparent(header) == ("4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7")
+        assert parse_traceparent("invalid") == (None, None)
+        assert parse_traceparent(None) == (None, None)
+
+class TestPipelineSpans:
+    """RAG流水线span测试类"""
+
+    def test_handler_spans(self, exporter):
+        """测试处理器记录检索、嵌入、FAISS搜索和生成span"""
+        from app.rag_handler import RAGHandler
+        from langchain_core.documents import Document
+        from langchain_core.messages import AIMessage
+
+        handler = RAGHandler.__new__(RAGHandler)
+        handler.embeddings = Mock()
+        handler.embeddings.aembed_query = AsyncMock(return_value=[1.0])
+        handler.vector_store = Mock()
+        handler.vector_store.asimilarity_search_by_vector = AsyncMock(return_value=[
+            Document(page_content="上下文", metadata={"source": "产品手册.docx"})
+        ])
+        handler.prompt = Mock()
+        handler.prompt.invoke = Mock(side_effect=lambda values: values["context"])
+        handler.llm = Mock()
+        handler.llm.ainvoke = AsyncMock(return_value=AIMessage(
+            content="答案", usage_metadata={"input_tokens": 40, "output_tokens": 3, "total_tokens": 43}
+        ))
+
+        asyncio.run(handler.get_answer("问题"))
+
+        spans = {span["name"]: span for span in exporter.spans()}
+        assert set(spans) == {"rag.get_answer", "rag.retrieval", "ollama.embed", "faiss.search", "rag.prompt", "llm.generate"}
+        assert spans["rag.retrieval"]["attributes"]["chunk_count"] == 1
+        assert spans["rag.retrieval"]["attributes"]["sources"] == ["产品手册.docx"]
+        assert spans["llm.generate"]["attributes"]["prompt_tokens"] == 40
+        assert spans["rag.get_answer"]["attributes"]["query_chars"] == 2
+        assert "query" not in spans["rag.get_answer"]["attributes"]
+        assert spans["faiss.search"]["parent_id"] == spans["rag.retrieval"]["span_id"]
+        assert spans["rag.retrieval"]["parent_id"] == spans["rag.get_answer"]["span_id"]
+
+    def test_http_request_span(self, exporter, monkeypatch):
+        """测试HTTP请求根span、X-Trace-Id响应头和 /traces 查询"""
+        monkeypatch.setattr(profiler_module, "ADMIN_TOKEN", "secret")
+        handler = Mock()
+        handler.warmup = AsyncMock(return_value={})
+        handler.get_answer = AsyncMock(return_value={"answer": "测试回答", "source_documents": []})
+
+        with patch('app.main.RAGHandler', return_value=handler):
+            with TestClient(main_module.app) as client:
+                response = client.post("/ask", json={"query": "问题"})
+                trace_id = response.headers["X-Trace-Id"]
+                denied = client.get("/traces", params={"trace_id": trace_id})
+                spans = client.get("/traces", params={"trace_id": trace_id},
+                                   headers={"X-Admin-Token": "secret"}).json()["spans"]
+
+        assert denied.status_code == 403
+        assert spans[0]["name"] == "http.request"
+        assert spans[0]["attributes"]["http.path"] == "/ask"
+        assert spans[0]["attributes"]["http.status_code"] == 200
+
+    def test_traceparent_trace_listed(self, exporter, monkeypatch):
+        """测试带traceparent请求头的链路以本地的http.request为根span出现在 /traces 中"""
+        monkeypatch.setattr(profiler_module, "ADMIN_TOKEN", "secret")
+        handler = Mock()
+        handler.warmup = AsyncMock(return_value={})
+        handler.get_answer = AsyncMock(return_value={"answer": "测试回答", "source_documents": []})
+        traceparent = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+
+        with patch('app.main.RAGHandler', return_value=handler):
+            with TestClient(main_module.app) as client:
+                response = client.post("/ask", json={"query": "问题"}, headers={"traceparent": traceparent})
+                traces = client.get("/traces", headers={"X-Admin-Token": "secret"}).json()["traces"]
+
+        assert response.headers["X-Trace-Id"] == "4bf92f3577b34da6a3ce929d0e0e4736"
+        trace = next(trace for trace in traces if trace["trace_id"] == "4bf92f3577b34da6a3ce929d0e0e4736")
+        assert trace["name"] == "http.request"
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+知识库更新调度器单元测试
+"""
+
+import pytest
+import os
+import sys
+import json
+import time
+import threading
+from unittest.mock import Mock, patch
+
+# 添加项目根目录和scripts目录到Python路径（调度器以脚本方式导入增量更新模块）
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+
+from scripts.update_scheduler import KnowledgeBaseWatcher, UpdateQueue
+from scripts.incremental_update import file_lock, FileFilter
+
+@pytest.fixture
+def updater(tmp_path):
+    """模拟的增量更新器"""
+    updater = Mock()
+    updater.knowledge_base_path = str(tmp_path)
+    updater.file_filter = FileFilter.from_config({"exclude_patterns": ["*.tmp", ".git/**", "node_modules/**"]})
+    updater.update_files.return_value = {
+        'status': 'success', 'duration': 0.1,
+        'changes': {'added': 1, 'modified': 0, 'deleted': 0}
+    }
+    return updater
+
+def event(src_path, dest_path=None, is_directory=False):
+    return Mock(src_path=src_path, dest_path=dest_path, is_directory=is_directory)
+
+class TestKnowledgeBaseWatcher:
+    """文件监控器测试类"""
+
+    def test_execute_update_uses_changed_paths(self, updater, tmp_path):
+        """测试防抖结束后只更新监控到的路径"""
+        watcher = KnowledgeBaseWatcher(updater, debounce_seconds=60)
+        watcher.on_created(event(str(tmp_path / "a.md")))
+        watcher.on_modified(event(str(tmp_path / "ignore.txt")))
+        watcher.update_timer.cancel()
+
+        watcher.execute_update().result(timeout=5)
+
+        updater.update_files.assert_called_once_with({("a.md", "created")})
+        updater.incremental_update.assert_not_called()
+        assert not watcher.pending_updates
+
+    def test_directory_move(self, updater, tmp_path):
+        """测试目录移动记录为源目录删除和目标目录创建"""
+        watcher = KnowledgeBaseWatcher(updater, debounce_seconds=60)
+        watcher.on_moved(event(str(tmp_path / "old"), str(tmp_path / "new"), is_directory=True))
+        watcher.update_timer.cancel()
+
+        assert watcher.pending_updates == {("old", "deleted"), ("new", "created")}
+
+    def test_failed_update_keeps_changes(self, updater, tmp_path):
+        """测试更新失败时保留变更，随下一次文件监控更新重试"""
+        updater.update_files.side_effect = [RuntimeError("Ollama不可用"), updater.update_files.return_value]
+        watcher = KnowledgeBaseWatcher(updater, debounce_seconds=60)
+        watcher.on_deleted(event(str(tmp_path / "a.md")))
+        watcher.update_timer.cancel()
+        with pytest.raises(RuntimeError):
+            watcher.execute_update().result(timeout=5)
+
+        watcher.on_created(event(str(tmp_path / "b.md")))
+        watcher.update_timer.cancel()
+        watcher.execute_update().result(timeout=5)
+
+        updater.update_files.assert_called_with({("a.md", "deleted"), ("b.md", "created")})
+
+    def test_ignores_filtered_paths(self, updater, tmp_path):
+        """测试忽略过滤规则排除的文件和目录中的事件"""
+        watcher = KnowledgeBaseWatcher(updater, debounce_seconds=60)
+        watcher.on_created(event(str(tmp_path / "a.md.tmp")))
+        watcher.on_modified(event(str(tmp_path / ".git" / "notes.md")))
+        watcher.on_moved(event(str(tmp_path / "node_modules" / "pkg"), str(tmp_path / "node_modules" / "pkg2"),
+                               is_directory=True))
+        watcher.on_deleted(event(str(tmp_path / "node_modules"), is_directory=True))
+
+        assert watcher.pending_updates == set()
+        assert watcher.update_timer is None
+
+class BlockingUpdater:
+    """第一次更新阻塞到放行为止，用于在任务执行期间提交其他请求"""
+
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _run(self, call):
+        self.calls.append(call)
+        self.started.set()
+        self.release.wait(5)
+        return {'status': 'no_changes', 'duration': 0, 'changes': {'added': 0, 'modified': 0, 'deleted': 0}}
+
+    def incremental_update(self, force_rebuild=False):
+        return self._run(('full', force_rebuild))
+
+    def update_files(self, changes):
+        return self._run(('watch', frozenset(changes)))
+
+    def compact(self, force=False):
+        return self._run(('compact', force))
+
+class TestUpdateQueue:
+    """更新任务队列测试类"""
+
+    def test_coalesces_and_prioritizes(self):
+        """测试执行期间到达的请求按类型合并，手动更新优先，全量更新顺带完成文件监控任务"""
+        updater = BlockingUpdater()
+        queue = UpdateQueue(updater)
+        first = queue.submit('scheduled')
+        assert updater.started.wait(5)
+
+        futures = [
+            queue.submit('watch', {("a.md", "modified")}),
+            queue.submit('scheduled'),
+            queue.submit('watch', {("b.md", "created")}),
+            queue.submit('manual', force_rebuild=True),
+        ]
+        updater.release.set()
+        assert queue.join(timeout=5)
+
+        assert updater.calls == [('full', False), ('full', True)]
+        assert all(future.result(timeout=1)['status'] == 'no_changes' for future in [first] + futures)
+        assert queue.stats['executed'] == 2
+        assert queue.stats['coalesced'] == 3
+        queue.stop()
+
+    def test_watch_runs_before_scheduled(self):
+        """测试文件监控任务优先于排队中的定时更新"""
+        updater = BlockingUpdater()
+        queue = UpdateQueue(updater)
+        queue.submit('manual')
+        assert updater.started.wait(5)
+
+        queue.submit('scheduled')
+        queue.submit('watch', {("a.md", "modified")})
+        updater.release.set()
+        assert queue.join(timeout=5)
+
+        assert updater.calls[1] == ('watch', frozenset({("a.md", "modified")}))
+        assert updater.calls[2] == ('full', False)
+        queue.stop()
+
+    def test_compact_runs_when_idle(self):
+        """测试索引压缩排在所有更新之后执行"""
+        updater = BlockingUpdater()
+        queue = UpdateQueue(updater)
+        queue.submit('scheduled')
+        assert updater.started.wait(5)
+
+        queue.submit('compact')
+        queue.submit('watch', {("a.md", "modified")})
+        queue.submit('compact')
+        updater.release.set()
+        assert queue.join(timeout=5)
+
+        assert updater.calls[1:] == [('watch', frozenset({("a.md", "modified")})), ('compact', False)]
+        queue.stop()
+
+    def test_stop_cancels_pending(self):
+        """测试停止队列时等待当前任务结束并取消排队中的任务"""
+        updater = BlockingUpdater()
+        queue = UpdateQueue(updater)
+        running = queue.submit('manual')
+        assert updater.started.wait(5)
+        pending = queue.submit('scheduled')
+
+        threading.Timer(0.05, updater.release.set).start()
+        queue.stop(timeout=5)
+
+        assert running.result(timeout=1)['status'] == 'no_changes'
+        assert pending.cancelled()
+        assert queue.submit('manual').exception(timeout=1) is not None
+
+class TestFileLock:
+    """跨进程文件锁测试类"""
+
+    def test_serializes_holders(self, tmp_path):
+        """测试同一时间只有一个持有者"""
+        lock_path = str(tmp_path / "update.lock")
+        events = []
+
+        def holder(name):
+            with file_lock(lock_path):
+                events.append((name, 'enter'))
+                time.sleep(0.05)
+                events.append((name, 'exit'))
+
+        threads = [threading.Thread(target=holder, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i in range(0, len(events), 2):
+            assert events[i][0] == events[i + 1][0]
+            assert events[i][1] == 'enter' and events[i + 1][1] == 'exit'
+
+class TestAdaptiveDebounce:
+    """自适应防抖测试类"""
+
+    def test_single_event_uses_min_quiet(self, updater, tmp_path):
+        """测试单次变更只等待最短静默时间"""
+        watcher = KnowledgeBaseWatcher(updater, debounce_seconds=30, min_quiet_seconds=2)
+        watcher.on_modified(event(str(tmp_path / "a.md")))
+        watcher.cancel()
+
+        assert watcher.flush_delay(watcher.last_event_time) == pytest.approx(2)
+
+    def test_quiet_period_follows_event_rate(self, updater, tmp_path):
+        """测试持续写入时等待时间随事件间隔增大，但不超过上限"""
+        watcher = KnowledgeBaseWatcher(updater, debounce_seconds=30, min_quiet_seconds=2, max_delay_seconds=600)
+        with watcher.lock:
+            watcher.pending_updates.add(("a.md", "modified"))
+            watcher.first_event_time = 1000.0
+            watcher.event_gap = 5.0
+            assert watcher.flush_delay(1000.0) == pytest.approx(10)
+            watcher.event_gap = 60.0
+            assert watcher.flush_delay(1000.0) == pytest.approx(30)
+
+    def test_max_delay_bounds_trickle(self, updater, tmp_path):
+        """测试事件不断到达时，最早的变更超过最长延迟后仍会提交更新"""
+        watcher = KnowledgeBaseWatcher(updater, debounce_seconds=0.2, min_quiet_seconds=0.2, max_delay_seconds=0.3)
+        deadline = time.time() + 1.0
+        while time.time() < deadline and not updater.update_files.called:
+            watcher.on_modified(event(str(tmp_path / "a.md")))
+            time.sleep(0.05)
+        watcher.cancel()
+        assert watcher.job_queue.join(timeout=5)
+
+        assert updater.update_files.called
+
+    def test_batch_size_flushes_immediately(self, updater, tmp_path):
+        """测试待处理路径达到批量上限时立即提交"""
+        watcher = KnowledgeBaseWatcher(updater, debounce_seconds=60, min_quiet_seconds=60, max_batch_size=3)
+        for name in ("a.md", "b.md", "c.md"):
+            watcher.on_created(event(str(tmp_path / name)))
+        time.sleep(0.2)
+        assert watcher.job_queue.join(timeout=5)
+
+        assert len(updater.update_files.call_args[0][0]) == 3
+        assert not watcher.pending_updates
+
+    def test_default_config_applies_throttling(self):
+        """测试未指定配置文件时使用随项目提供的scheduler_config.json中的资源调节配置"""
+        from scripts.update_scheduler import UpdateScheduler
+        from scripts.incremental_update import SCHEDULER_CONFIG_PATH
+
+        with open(SCHEDULER_CONFIG_PATH, encoding='utf-8') as f:
+            throttling = json.load(f)['throttling']
+        with patch('scripts.update_scheduler.IncrementalUpdater'):
+            scheduler = UpdateScheduler()
+
+        assert scheduler.governor.max_cpu_percent == throttling['max_cpu_percent']
+        assert scheduler.governor.api_url == throttling['api_url']
+        assert scheduler.governor.worker_nice == throttling['worker_nice']
+        assert scheduler.governor.quiet_hours == (throttling['quiet_hours']['start'], throttling['quiet_hours']['end'])
+        assert scheduler.config['compaction']['orphan_ratio'] > 0
+        scheduler.job_queue.stop()
+
+    def test_freshness_metric(self, tmp_path):
+        """测试从文件变更到更新完成的延迟被记录并写入指标文件"""
+        from scripts.update_scheduler import UpdateScheduler
+
+        with patch('scripts.update_scheduler.IncrementalUpdater') as updater_class:
+            updater_class.return_value.update_files.return_value = {
+                'status': 'success', 'duration': 0.1,
+                'changes': {'added': 1, 'modified': 0, 'deleted': 0}
+            }
+            scheduler = UpdateScheduler()
+        scheduler.config['monitoring'] = {'enabled': True, 'metrics_file': str(tmp_path / "metrics.json")}
+
+        scheduler.job_queue.submit('watch', {("a.md", "created")}, changed_at=time.time() - 5).result(timeout=5)
+
+        with open(tmp_path / "metrics.json", encoding='utf-8') as f:
+            metrics = json.load(f)
+        assert metrics['updates']['file_watch_updates'] == 1
+        assert metrics['freshness_seconds']['samples'] == 1
+        assert metrics['freshness_seconds']['last'] >= 5
+        scheduler.job_queue.stop()